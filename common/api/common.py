@@ -8,6 +8,7 @@ import time
 import uuid
 
 from django.core.cache import cache
+from django.http import HttpResponse
 from django.utils import translation
 from drf_spectacular.plumbing import build_object_type, build_basic_type, build_array_type
 from drf_spectacular.types import OpenApiTypes
@@ -17,6 +18,7 @@ from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 
 from common.cache.storage import CommonResourceIDsCache
+from common.core.metrics import metrics_registry
 from common.core.response import ApiResponse
 from common.models import Monitor
 from common.swagger.utils import get_default_response_schema
@@ -135,3 +137,12 @@ class HealthCheckAPIView(GenericAPIView):
             'redis_time': redis_time,
         }
         return Response(data)
+
+
+class MetricsAPIView(GenericAPIView):
+    """监控指标"""
+
+    @extend_schema(responses={200: OpenApiResponse(build_basic_type(OpenApiTypes.STR))})
+    def get(self, request):
+        """获取所有进程汇总的监控指标，prometheus 文本格式"""
+        return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
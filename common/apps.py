@@ -15,6 +15,7 @@ class CommonConfig(AppConfig):
         from .celery import heatbeat  # noqa
         from . import signal_handlers  # noqa
         from . import tasks  # noqa
+        from .core.db import lookups  # noqa  在创建数据库连接之前注册 sqlite 函数
         from .swagger.utils import OpenApiAuthenticationScheme, OpenApiPrimaryKeyRelatedField  # noqa
         from .signals import django_ready
         excludes = ['migrate', 'compilemessages', 'makemigrations', 'stop']
@@ -6,15 +6,28 @@
 # date : 6/2/2023
 
 
+import fnmatch
+import hashlib
+import re
+import threading
 import time
+from collections import OrderedDict, Counter
+from concurrent.futures import Future
 from functools import wraps, WRAPPER_ASSIGNMENTS
 from importlib import import_module
 
+from django.conf import settings
 from django.core.cache import cache
 from django.db import close_old_connections, connection
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from django.utils.functional import LazyObject
 
+from common.cache.compress import CompressedContent, GZIP
+from common.cache.storage import GenerationCache
 from common.utils import get_logger
+from server.utils import get_current_request
 
 logger = get_logger(__name__)
 
@@ -143,14 +156,136 @@ def magic_call_in_times(call_time=24 * 3600, call_limit=6, key=None):
     return decorator
 
 
+class LocalLRUCache(object):
+    """
+    进程内缓存，超过最大条数按照最近最少使用淘汰，每条数据带有过期时间
+    """
+
+    def __init__(self, max_size=4096, timeout=300):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.version = 0  # 每次删除数据版本号加1，避免读取过程中数据失效后又写入旧数据
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                self._data.pop(key, None)
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, timeout=None, version=None):
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        if timeout <= 0:
+            return
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._data[key] = (time.time() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            self.version += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def delete_pattern(self, pattern):
+        with self._lock:
+            self.version += 1
+            for key in [key for key in self._data if fnmatch.fnmatchcase(key, pattern)]:
+                self._data.pop(key, None)
+
+    def delete_if(self, func):
+        with self._lock:
+            self.version += 1
+            for key in [key for key, item in self._data.items() if func(item[1])]:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._data.clear()
+
+
+class SingleFlight(object):
+    """
+    同一进程内相同key同时只执行一次，其他线程等待执行结果
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            future = self._futures.get(key)
+            leader = future is None
+            if leader:
+                future = self._futures[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._futures.pop(key, None)
+
+
+class MagicLocalCache(LazyObject):
+    def _setup(self):
+        self._wrapped = LocalLRUCache(settings.MAGIC_CACHE_LOCAL_MAX_SIZE, settings.MAGIC_CACHE_LOCAL_TIMEOUT)
+
+
+class MagicCacheSubPub(LazyObject):
+    def _setup(self):
+        from common.utils.connection import RedisPubSub
+        self._wrapped = RedisPubSub('magic_cache_data_invalid')
+
+
+magic_local_cache = MagicLocalCache()
+magic_cache_pub_sub = MagicCacheSubPub()
+magic_single_flight = SingleFlight()
+
+
 class MagicCacheData(object):
+    _stats = Counter()
+    _stats_lock = threading.Lock()
+
+    @classmethod
+    def incr_stats(cls, name, status):
+        with cls._stats_lock:
+            cls._stats[(name, status)] += 1
+
+    @classmethod
+    def get_stats(cls):
+        """
+        当前进程的缓存统计，{(func_name, local|hit|miss): count}，local 为命中进程内缓存
+        """
+        with cls._stats_lock:
+            return dict(cls._stats)
+
     @staticmethod
-    def make_cache(timeout=60 * 10, invalid_time=0, key_func=None, timeout_func=None):
+    def make_cache(timeout=60 * 10, invalid_time=0, key_func=None, timeout_func=None, generation_func=None):
         """
+        一级缓存为进程内缓存，二级缓存为redis，缓存失效通过redis发布订阅通知所有进程
         :param timeout_func:
         :param timeout:  数据缓存的时候，单位秒
         :param invalid_time: 数据缓存提前失效时间，单位秒。该cache有效时间为 cache_time-invalid_time
         :param key_func: cache唯一标识，默认为所装饰函数名称
+        :param generation_func: 缓存所属的命名空间列表，命名空间版本号变化后缓存失效
         :return:
         """
 
@@ -164,57 +299,172 @@ class MagicCacheData(object):
                 cache_time = timeout
                 if timeout_func:
                     cache_time = timeout_func(*args, **kwargs)
-                n_time = time.time()
-                res = cache.get(cache_key)
-                if res:
-                    while not res or res.get('status') != 'ok':
-                        time.sleep(0.5)
-                        logger.warning(
-                            f'exec {func} wait. data status is not ok. cache_time:{cache_time} cache_key:{cache_key}  cache data exist result:{res}')
-                        res = cache.get(cache_key)
-                with cache.lock(f"locker_{cache_key}", timeout=cache_time - invalid_time):
-                    if res and n_time - res.get('c_time', n_time) < cache_time - invalid_time:
-                        logger.debug(
-                            f"exec {func} finished. cache_time:{cache_time} cache_key:{cache_key} cache data exist result:{res}")
-                        return res['data']
-                    else:
-                        res = {'c_time': n_time, 'data': '', 'status': 'ready'}
-                        cache.set(cache_key, res, cache_time)
-                        try:
-                            res['data'] = func(*args, **kwargs)
-                            logger.debug(
-                                f"exec {func} finished. time:{time.time() - n_time} cache_time:{cache_time} cache_key:{cache_key} result:{res}")
-                        except Exception as e:
-                            logger.error(
-                                f"exec {func} failed. time:{time.time() - n_time}  cache_time:{cache_time} cache_key:{cache_key} Exception:{e}")
-
-                        res['status'] = 'ok'
-                        cache.set(cache_key, res, cache_time)
-
-                        return res['data']
+
+                res = magic_local_cache.get(cache_key)
+                if res is not None:
+                    MagicCacheData.incr_stats(func.__name__, 'local')
+                    return res['data']
+                namespaces = generation_func(*args, **kwargs) if generation_func else []
+                return magic_single_flight.do(cache_key, MagicCacheData.load_cache_data, func, cache_key,
+                                              cache_time, cache_time - invalid_time, namespaces, args, kwargs)
 
             return wrapper
 
         return decorator
 
+    @staticmethod
+    def get_valid_cache(cache_key, expire_time, namespaces):
+        data, generations = GenerationCache.get_many_with_generations([cache_key], namespaces)
+        res = data.get(cache_key)
+        if (res and res.get('status') == 'ok' and time.time() - res.get('c_time', 0) < expire_time
+                and res.get('generations', {}) == generations):
+            return res, generations
+        return None, generations
+
+    @staticmethod
+    def load_cache_data(func, cache_key, cache_time, expire_time, namespaces, args, kwargs):
+        version = magic_local_cache.version
+        res, generations = MagicCacheData.get_valid_cache(cache_key, expire_time, namespaces)
+        if res is None:
+            # 其他进程正在执行时，阻塞等待锁释放，然后直接读取缓存数据
+            with cache.lock(f"locker_{cache_key}", timeout=expire_time):
+                res, generations = MagicCacheData.get_valid_cache(cache_key, expire_time, namespaces)
+                if res is None:
+                    MagicCacheData.incr_stats(func.__name__, 'miss')
+                    n_time = time.time()
+                    # 记录执行前的版本号，执行期间版本号变化，下次读取的时候缓存失效
+                    res = {'c_time': n_time, 'data': '', 'status': 'ok', 'generations': generations}
+                    try:
+                        res['data'] = func(*args, **kwargs)
+                        logger.debug(
+                            f"exec {func} finished. time:{time.time() - n_time} cache_time:{cache_time} cache_key:{cache_key} result:{res}")
+                    except Exception as e:
+                        logger.error(
+                            f"exec {func} failed. time:{time.time() - n_time}  cache_time:{cache_time} cache_key:{cache_key} Exception:{e}")
+                    cache.set(cache_key, res, cache_time)
+                else:
+                    MagicCacheData.incr_stats(func.__name__, 'hit')
+        else:
+            MagicCacheData.incr_stats(func.__name__, 'hit')
+        magic_local_cache.set(cache_key, res, res['c_time'] + expire_time - time.time(), version)
+        return res['data']
+
+    @staticmethod
+    def publish_invalid(keys=None, pattern=None, namespaces=None):
+        data = {'keys': keys or [], 'pattern': pattern, 'namespaces': namespaces or []}
+        MagicCacheData.handle_invalid(data)
+        try:
+            magic_cache_pub_sub.publish(data)
+        except Exception as e:
+            logger.error(f"publish invalid cache failed. {data} Exception:{e}")
+
+    @staticmethod
+    def handle_invalid(data):
+        if data.get('pattern'):
+            magic_local_cache.delete_pattern(data['pattern'])
+        if data.get('keys'):
+            magic_local_cache.delete_many(data['keys'])
+        if data.get('namespaces'):
+            namespaces = set(data['namespaces'])
+            magic_local_cache.delete_if(lambda res: namespaces & set(res.get('generations', {}).keys()))
+
+    @staticmethod
+    def subscribe_invalid():
+        magic_cache_pub_sub.subscribe(MagicCacheData.handle_invalid)
+
+    @staticmethod
+    def invalid_generations(namespaces):
+        """
+        命名空间版本号加1，所有记录该命名空间的缓存失效，包括 MagicCacheData 和 MagicCacheResponse
+        """
+        namespaces = list(namespaces)
+        if not namespaces:
+            return
+        GenerationCache.bump_generations(namespaces)
+        MagicCacheData.publish_invalid(namespaces=namespaces)
+        logger.info(f"invalid cache generations namespace:{namespaces[0]}... {len(namespaces)} count")
+
     @staticmethod
     def invalid_cache(key):
         cache_key = f'magic_cache_data_{key}'
         count = cache.delete_pattern(cache_key)
+        MagicCacheData.publish_invalid(pattern=cache_key)
         logger.warning(f"invalid_cache cache_key:{cache_key} count:{count}")
 
     @staticmethod
     def invalid_caches(keys):
         delete_keys = [f'magic_cache_data_{key}' for key in keys]
         count = cache.delete_many(delete_keys)
+        MagicCacheData.publish_invalid(keys=delete_keys)
         logger.warning(
             f"invalid_cache_data cache_key:{delete_keys[0]}... {len(delete_keys)} count. delete count:{count}")
 
+
+class MagicCacheResponseRefresher(object):
+    """
+    注册到 response 的 _resource_closers 中，响应发送完成之后再刷新缓存，不影响本次请求的响应时间
+    """
+
+    def __init__(self, cache_response, locker, **kwargs):
+        self.cache_response = cache_response
+        self.locker = locker
+        self.kwargs = kwargs
+
+    def close(self):
+        try:
+            self.cache_response.render_and_cache(**self.kwargs)
+        except Exception as e:
+            logger.error(f"refresh response cache failed. cache_key:{self.kwargs.get('cache_key')} Exception:{e}")
+        finally:
+            release_locker(self.locker)
+
+
+def release_locker(locker):
+    try:
+        locker.release()
+    except Exception as e:
+        logger.warning(f"release locker failed. Exception:{e}")
+
+
 class MagicCacheResponse(object):
-    def __init__(self, timeout=60 * 10, invalid_time=0, key_func=None):
+    _stats = Counter()
+    _stats_lock = threading.Lock()
+
+    accept_gzip_re = re.compile(r'\bgzip\b')
+
+    def __init__(self, timeout=60 * 10, invalid_time=0, key_func=None, stale_time=60 * 10, lock_timeout=60,
+                 generation_func=None, compress=GZIP, compress_min_length=1024):
+        """
+        :param timeout: 缓存有效时间，单位秒
+        :param invalid_time: 缓存提前失效时间，单位秒
+        :param key_func: cache唯一标识
+        :param stale_time: 缓存过期之后，继续返回旧数据的时间，同时由一个进程在请求结束之后刷新缓存
+        :param lock_timeout: 刷新缓存的锁超时时间，缓存不存在时，相同key的请求最多等待该时间
+        :param generation_func: 缓存所属的命名空间列表，命名空间版本号变化后缓存失效，下一次请求重新执行
+        :param compress: 缓存内容压缩方式，gzip，zlib，lzma，为 None 不压缩。gzip 压缩的内容可直接返回给支持 gzip 的客户端
+        :param compress_min_length: 内容超过该长度才压缩
+        """
         self.timeout = timeout
         self.key_func = key_func
+        self.generation_func = generation_func
+        self.compress = compress
+        self.compress_min_length = compress_min_length
         self.invalid_time = invalid_time
+        self.stale_time = stale_time
+        self.lock_timeout = lock_timeout
+
+    @classmethod
+    def incr_stats(cls, name, status):
+        with cls._stats_lock:
+            cls._stats[(name, status)] += 1
+
+    @classmethod
+    def get_stats(cls):
+        """
+        当前进程的缓存统计，{(func_name, hit|miss|stale): count}
+        """
+        with cls._stats_lock:
+            return dict(cls._stats)
 
     @staticmethod
     def invalid_cache(key):
@@ -244,6 +494,91 @@ class MagicCacheResponse(object):
 
         return inner
 
+    @staticmethod
+    def get_request_id():
+        return str(getattr(get_current_request(), 'request_uuid', ""))
+
+    @staticmethod
+    def make_etag(content, request_id):
+        # 响应中的 requestId 每次请求都不一样，计算 ETag 时需要排除
+        if request_id:
+            content = content.replace(request_id.encode('utf-8'), b'')
+        return quote_etag(hashlib.sha1(content).hexdigest())
+
+    @staticmethod
+    def is_not_modified(request, etag):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if not etag or not if_none_match:
+            return False
+        etags = parse_etags(if_none_match)
+        # If-None-Match 使用弱比较，gzip 编码的 ETag 和原始内容的 ETag 视为同一个
+        return '*' in etags or etag in {tag.removeprefix('W/').replace('-gzip"', '"') for tag in etags}
+
+    @staticmethod
+    def set_etag_headers(response, etag):
+        if etag:
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'
+
+    def build_cache_response(self, view_instance, request, res):
+        etag = res.get('etag')
+        content_encoding = None
+        if self.is_not_modified(request, etag):
+            response = HttpResponseNotModified()
+        else:
+            content, status, headers = res['data']
+            request_id = self.get_request_id()
+            if isinstance(content, CompressedContent):
+                if content.gzip_enabled and self.accept_gzip_re.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+                    # 客户端支持 gzip，直接返回压缩数据，无需解压
+                    content_encoding = GZIP
+                    content = content.get_gzip_content(request_id)
+                else:
+                    content = content.get_content(request_id)
+            elif res.get('request_id') and request_id:
+                content = content.replace(res['request_id'].encode('utf-8'), request_id.encode('utf-8'))
+            response = HttpResponse(content=content, status=status)
+            for k, v in headers.values():
+                response[k] = v
+            if content_encoding:
+                response['Content-Encoding'] = content_encoding
+        response.renderer_context = view_instance.get_renderer_context()
+        if etag and content_encoding:
+            # 不同编码的内容使用不同的 ETag
+            etag = f'{etag[:-1]}-{content_encoding}"'
+        self.set_etag_headers(response, etag)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def render_and_cache(self, view_instance, view_method, request, args, kwargs, cache_key, timeout, generations):
+        n_time = time.time()
+        response = view_method(view_instance, request, *args, **kwargs)
+        response = view_instance.finalize_response(request, response, *args, **kwargs)
+        response.render()
+
+        if not response.status_code >= 400 and not getattr(request, 'no_cache', False):
+            content = response.rendered_content
+            request_id = self.get_request_id()
+            etag = self.make_etag(content, request_id)
+            if self.compress and len(content) >= self.compress_min_length:
+                content = CompressedContent.compress(content, self.compress, request_id)
+            data = (
+                content,
+                response.status_code,
+                {k: (k, v) for k, v in response.items()}
+            )
+            res = {'c_time': n_time, 'data': data, 'generations': generations, 'etag': etag,
+                   'request_id': request_id}
+            cache.set(cache_key, res, timeout + self.stale_time)
+            logger.debug(f"exec {cache_key} finished. time:{time.time() - n_time}  result:{res}")
+            if self.is_not_modified(request, etag):
+                renderer_context = response.renderer_context
+                response = HttpResponseNotModified()
+                response.renderer_context = renderer_context
+            self.set_etag_headers(response, etag)
+            patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
     def process_cache_response(self,
                                view_instance,
                                view_method,
@@ -264,36 +599,61 @@ class MagicCacheResponse(object):
         else:
             cache_key = f'{cache_key}_{func_name}'
         timeout = self.calculate_timeout(view_instance=view_instance)
-        n_time = time.time()
-        if getattr(request, 'no_cache', False):
-            res = None
+        fresh_time = timeout - self.invalid_time
+        namespaces = self.calculate_generations(
+            view_instance=view_instance,
+            view_method=view_method,
+            request=request,
+            args=args,
+            kwargs=kwargs
+        )
+
+        def get_cache():
+            data, generations = GenerationCache.get_many_with_generations([cache_key], namespaces)
+            res = data.get(cache_key)
+            if res and res.get('generations', {}) != generations:
+                # 版本号已变化，说明数据已被修改，旧数据不能再返回，按照缓存不存在处理
+                res = None
+            fresh = bool(res and time.time() - res.get('c_time', 0) < fresh_time)
+            return res, fresh, generations
+
+        no_cache = getattr(request, 'no_cache', False)
+        if no_cache:
+            res, fresh, generations = None, False, GenerationCache.get_generations(namespaces)
         else:
-            res = cache.get(cache_key)
-        if res and n_time - res.get('c_time', n_time) < timeout - self.invalid_time:
+            res, fresh, generations = get_cache()
+        render_kwargs = dict(view_instance=view_instance, view_method=view_method, request=request, args=args,
+                             kwargs=kwargs, cache_key=cache_key, timeout=timeout, generations=generations)
+        if fresh:
+            self.incr_stats(func_name, 'hit')
             logger.info(f"exec {func_name} finished. cache_key:{cache_key}  cache data exist")
-            content, status, headers = res['data']
-            response = HttpResponse(content=content, status=status)
-            response.renderer_context = view_instance.get_renderer_context()
-            for k, v in headers.values():
-                response[k] = v
+            response = self.build_cache_response(view_instance, request, res)
+        elif res:
+            # 缓存已过期但版本号未变化，直接返回旧数据，获取到锁的请求在响应结束后刷新缓存
+            self.incr_stats(func_name, 'stale')
+            response = self.build_cache_response(view_instance, request, res)
+            locker = cache.lock(f"locker_{cache_key}", timeout=self.lock_timeout)
+            if locker.acquire(blocking=False):
+                refresher = MagicCacheResponseRefresher(self, locker, **render_kwargs)
+                response._resource_closers.append(refresher.close)
+        elif no_cache:
+            self.incr_stats(func_name, 'miss')
+            response = self.render_and_cache(**render_kwargs)
         else:
-            response = view_method(view_instance, request, *args, **kwargs)
-            response = view_instance.finalize_response(request, response, *args, **kwargs)
-            response.render()
-
-            if not response.status_code >= 400 and not getattr(request, 'no_cache', False):
-                data = (
-                    response.rendered_content,
-                    response.status_code,
-                    {k: (k, v) for k, v in response.items()}
-                )
-                res = {'c_time': n_time, 'data': data}
-                cache.set(cache_key, res, timeout)
-                logger.debug(
-                    f"exec {func_name} finished. time:{time.time() - n_time}  cache_key:{cache_key} result:{res}")
-
-        if not hasattr(response, '_closable_objects'):
-            response._closable_objects = []
+            # 缓存不存在，相同key的请求只有一个执行，其他请求等待执行完成之后读取缓存
+            self.incr_stats(func_name, 'miss')
+            locker = cache.lock(f"locker_{cache_key}", timeout=self.lock_timeout)
+            acquired = locker.acquire(blocking_timeout=self.lock_timeout)
+            try:
+                res, fresh, generations = get_cache()
+                render_kwargs['generations'] = generations
+                if fresh:
+                    response = self.build_cache_response(view_instance, request, res)
+                else:
+                    response = self.render_and_cache(**render_kwargs)
+            finally:
+                if acquired:
+                    release_locker(locker)
 
         return response
 
@@ -316,6 +676,26 @@ class MagicCacheResponse(object):
                 kwargs=kwargs,
             )
 
+    def calculate_generations(self,
+                              view_instance,
+                              view_method,
+                              request,
+                              args,
+                              kwargs):
+        if isinstance(self.generation_func, str):
+            generation_func = getattr(view_instance, self.generation_func)
+        else:
+            generation_func = self.generation_func
+        if generation_func:
+            return generation_func(
+                view_instance=view_instance,
+                view_method=view_method,
+                request=request,
+                args=args,
+                kwargs=kwargs,
+            )
+        return []
+
     def calculate_timeout(self, view_instance, **_):
         if isinstance(self.timeout, str):
             self.timeout = getattr(view_instance, self.timeout)
@@ -372,12 +752,21 @@ def timeit(func):
 
 
 class SQLCounter:
+    """
+    通过 connection.execute_wrapper 统计 SQL 执行次数和执行时间
+    """
+
     def __init__(self):
         self.count = 0
+        self.time = 0
 
     def __call__(self, execute, sql, params, many, context):
         self.count += 1
-        return execute(sql, params, many, context)
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - start_time
 
 
 def count_sql_queries(func):
@@ -386,7 +775,7 @@ def count_sql_queries(func):
         sql_counter = SQLCounter()
         with connection.execute_wrapper(sql_counter):
             result = func(*args, **kwargs)
-        logger.info(f"{func.__name__} sql queries count: {sql_counter.count}")
+        logger.info(f"{func.__name__} sql queries count: {sql_counter.count} time: {sql_counter.time}")
         return result
 
     return wrapper
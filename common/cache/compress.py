@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# project : xadmin-server
+# filename : compress
+# author : ly_13
+# date : 10/18/2026
+import lzma
+import pickle
+import struct
+import zlib
+
+GZIP = 'gzip'
+ZLIB = 'zlib'
+LZMA = 'lzma'
+
+# gzip 头部，不带文件名和时间
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+# 响应中 requestId 之后的内容超过该长度，不再拆分存储，无法直接返回 gzip 数据
+TAIL_MAX_LENGTH = 1024
+
+
+def compress_bytes(data: bytes, method: str) -> bytes:
+    if method == GZIP:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    if method == ZLIB:
+        return zlib.compress(data)
+    if method == LZMA:
+        return lzma.compress(data)
+    raise ValueError(f"unsupported compress method {method}")
+
+
+def decompress_bytes(data: bytes, method: str) -> bytes:
+    if method == GZIP:
+        return zlib.decompressobj(31).decompress(data)
+    if method == ZLIB:
+        return zlib.decompress(data)
+    if method == LZMA:
+        return lzma.decompress(data)
+    raise ValueError(f"unsupported compress method {method}")
+
+
+class CompressedValue(object):
+    """
+    压缩之后的缓存数据，读取缓存之后通过 decompress_value 还原
+    """
+
+    def __init__(self, method, data):
+        self.method = method
+        self.data = data
+
+    def load(self):
+        return pickle.loads(decompress_bytes(self.data, self.method))
+
+
+def compress_value(value, method=None, min_length=1024):
+    if not method:
+        return value
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(data) < min_length:
+        return value
+    return CompressedValue(method, compress_bytes(data, method))
+
+
+def decompress_value(value):
+    if isinstance(value, CompressedValue):
+        return value.load()
+    return value
+
+
+class CompressedContent(object):
+    """
+    压缩之后的响应内容
+    gzip 压缩时，按照 request_id 拆分为已压缩的前半部分和未压缩的后半部分，返回给客户端时只需要压缩后半部分，
+    就可以替换成当前请求的 request_id 并直接返回 gzip 数据
+    """
+
+    def __init__(self, method, body, request_id='', tail=None, crc=0, size=0):
+        self.method = method
+        self.body = body
+        self.request_id = request_id
+        self.tail = tail
+        self.crc = crc
+        self.size = size
+
+    @classmethod
+    def compress(cls, content: bytes, method: str, request_id: str = ''):
+        if method != GZIP:
+            return cls(method, compress_bytes(content, method), request_id)
+        index = content.rfind(request_id.encode('utf-8')) if request_id else -1
+        tail = content[index:] if index >= 0 else b''
+        if len(tail) > TAIL_MAX_LENGTH:
+            return cls(method, compress_bytes(content, method), request_id)
+        prefix = content[:len(content) - len(tail)]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        body = GZIP_HEADER + compressor.compress(prefix) + compressor.flush(zlib.Z_FULL_FLUSH)
+        return cls(method, body, request_id, tail, zlib.crc32(prefix), len(prefix))
+
+    def get_tail(self, request_id):
+        if self.request_id and request_id:
+            return self.tail.replace(self.request_id.encode('utf-8'), request_id.encode('utf-8'))
+        return self.tail
+
+    @property
+    def gzip_enabled(self):
+        return self.method == GZIP and self.tail is not None
+
+    def get_gzip_content(self, request_id='') -> bytes:
+        tail = self.get_tail(request_id)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        trailer = struct.pack('<II', zlib.crc32(tail, self.crc) & 0xffffffff, (self.size + len(tail)) & 0xffffffff)
+        return self.body + compressor.compress(tail) + compressor.flush() + trailer
+
+    def get_content(self, request_id='') -> bytes:
+        content = decompress_bytes(self.body, self.method)
+        if self.tail is not None:
+            return content + self.get_tail(request_id)
+        if self.request_id and request_id:
+            content = content.replace(self.request_id.encode('utf-8'), request_id.encode('utf-8'))
+        return content
@@ -4,16 +4,22 @@
 # filename : storage
 # author : ly_13
 # date : 6/2/2023
+import time
 
 from django.conf import settings
 from django.core.cache import cache
 
+from common.cache.compress import compress_value, decompress_value, ZLIB
 from common.utils import get_logger
 
 logger = get_logger(__name__)
 
 
 class RedisCacheBase(object):
+    # 缓存数据压缩方式，zlib，lzma，gzip，为 None 不压缩，数据序列化之后超过 compress_min_length 才会压缩
+    compress = None
+    compress_min_length = 1024
+
     def __init__(self, cache_key, timeout=600):
         self.cache_key = cache_key
         self._timeout = timeout
@@ -25,15 +31,15 @@ class RedisCacheBase(object):
         return super().__getattribute__(item)
 
     def get_storage_cache(self, defaults=None):
-        return cache.get(self.cache_key, defaults)
+        return decompress_value(cache.get(self.cache_key, defaults))
 
     def get_storage_key_and_cache(self):
-        return self.cache_key, cache.get(self.cache_key)
+        return self.cache_key, decompress_value(cache.get(self.cache_key))
 
     def set_storage_cache(self, value, timeout=0):
         if isinstance(timeout, int) and timeout == 0:
             timeout = self._timeout
-        return cache.set(self.cache_key, value, timeout)
+        return cache.set(self.cache_key, compress_value(value, self.compress, self.compress_min_length), timeout)
 
     def append_storage_cache(self, value, timeout=None):
         with cache.lock(f"{self.cache_key}_lock", timeout=60, blocking_timeout=60):
@@ -94,6 +100,8 @@ class BlackAccessTokenCache(RedisCacheBase):
 
 
 class UserSystemConfigCache(RedisCacheBase):
+    compress = ZLIB
+
     def __init__(self, prefix_key):
         self.cache_key = f"{settings.CACHE_KEY_TEMPLATE.get('config_key')}_{prefix_key}"
         super().__init__(self.cache_key)
@@ -103,3 +111,92 @@ class CommonResourceIDsCache(RedisCacheBase):
     def __init__(self, prefix_key):
         self.cache_key = f"{settings.CACHE_KEY_TEMPLATE.get('common_resource_ids_key')}_{prefix_key}"
         super().__init__(self.cache_key)
+
+
+class DataPermissionRulesCache(RedisCacheBase):
+    def __init__(self, prefix_key):
+        self.cache_key = f"{settings.CACHE_KEY_TEMPLATE.get('data_permission_rules_key')}_{prefix_key}"
+        super().__init__(self.cache_key, timeout=3600 * 24)
+
+
+class GenerationCache(RedisCacheBase):
+    """
+    缓存命名空间版本号，缓存数据中记录生成时的版本号，版本号变化后缓存自动失效，失效只需要一次 INCR
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.cache_key = f"{settings.CACHE_KEY_TEMPLATE.get('cache_generation_key')}_{namespace}"
+        super().__init__(self.cache_key, timeout=None)
+
+    def get_generation(self):
+        return self.get_storage_cache(0)
+
+    def bump_generation(self):
+        return self.bump_generations([self.namespace])[0]
+
+    @classmethod
+    def get_many_with_generations(cls, cache_keys, namespaces):
+        """
+        一次请求同时获取缓存数据和命名空间版本号
+        :return: ({cache_key: value}, {namespace: generation})
+        """
+        generation_keys = {cls(namespace).cache_key: namespace for namespace in namespaces}
+        data = cache.get_many(list(cache_keys) + list(generation_keys.keys()))
+        generations = {namespace: data.pop(key, 0) for key, namespace in generation_keys.items()}
+        return data, generations
+
+    @classmethod
+    def get_generations(cls, namespaces):
+        return cls.get_many_with_generations([], namespaces)[1]
+
+    @classmethod
+    def bump_generations(cls, namespaces):
+        """
+        版本号不存在时使用毫秒时间戳初始化，避免版本号被淘汰之后重新从1开始，导致旧缓存重新生效
+        """
+        client = cache.client.get_client(write=True)
+        init_value = int(time.time() * 1000)
+        with client.pipeline(transaction=False) as pipe:
+            for namespace in namespaces:
+                key = cache.client.make_key(cls(namespace).cache_key)
+                pipe.set(key, init_value, nx=True)
+                pipe.incr(key)
+            result = pipe.execute()
+        return result[1::2]
+
+
+class MetricsCache(RedisCacheBase):
+    """
+    所有进程共享的监控指标，使用 redis hash 存储，各进程定期把增量累加到对应字段
+    """
+
+    def __init__(self):
+        self.cache_key = f"{settings.CACHE_KEY_TEMPLATE.get('metrics_key')}"
+        super().__init__(self.cache_key, timeout=None)
+
+    def incr_many(self, values):
+        client = cache.client.get_client(write=True)
+        key = cache.client.make_key(self.cache_key)
+        with client.pipeline(transaction=False) as pipe:
+            for field, value in values.items():
+                pipe.hincrbyfloat(key, field, value)
+            pipe.execute()
+
+    def get_all(self):
+        client = cache.client.get_client()
+        data = client.hgetall(cache.client.make_key(self.cache_key))
+        return {field.decode('utf-8'): float(value) for field, value in data.items()}
+
+    def clear(self):
+        cache.client.get_client(write=True).delete(cache.client.make_key(self.cache_key))
+
+
+class QuerySetCountCache(RedisCacheBase):
+    """
+    分页查询的总数缓存，key 为查询语句的 md5，带有权限过滤条件的查询，不同用户的缓存自然分开
+    """
+
+    def __init__(self, sql_md5):
+        self.cache_key = f"{settings.CACHE_KEY_TEMPLATE.get('queryset_count_key')}_{sql_md5}"
+        super().__init__(self.cache_key)
@@ -4,17 +4,24 @@
 # filename : config
 # author : ly_13
 # date : 12/15/2023
-# 修改下面配置之后，记得清理一下redis缓存： python manage.py expire_caches 'config_*'
+# 修改下面配置之后，记得清理一下配置缓存： python manage.py expire_config_caches
 
 
+import copy
 import json
 import re
+import threading
+import time
+from collections import defaultdict
 
+from django.db import transaction, router
 from django.template import Context, Template, TemplateSyntaxError
-from django.template.base import VariableNode
+from django.template.base import VariableNode, Variable
+from django.utils.functional import LazyObject
 from rest_framework import serializers
 
-from common.cache.storage import UserSystemConfigCache
+from common.cache.compress import decompress_value
+from common.cache.storage import UserSystemConfigCache, GenerationCache
 from common.utils import get_logger
 from server import settings
 from system.models import SystemConfig, UserPersonalConfig
@@ -28,20 +35,255 @@ class SystemConfigSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
-def get_render_context(tmp: str, context: dict) -> str:
-    template = Template(tmp)
-    for node in template.nodelist:
-        if isinstance(node, VariableNode):
-            v_key = re.findall(r'<Variable Node: (.*)>', str(node))
-            if v_key and v_key[0].isupper():
-                context[v_key[0]] = getattr(SysConfig, v_key[0])
-    context = Context(context)
-    return template.render(context)
+def get_template_variables(template: Template) -> set:
+    """
+    获取模板中引用的变量名，包括 if/for 等标签内部的变量
+    """
+    variables = set()
+    for node in template.nodelist.get_nodes_by_type(VariableNode):
+        var = node.filter_expression.var
+        if isinstance(var, Variable) and var.lookups:
+            variables.add(var.lookups[0])
+    return variables
+
+
+def load_render_value(value: str):
+    value = value.replace('"(', '').replace(')"', '')  # 支持"({{ h }})"， 为了转换变量，h不能为字符串
+    try:
+        value = json.loads(value)
+    except Exception as e:
+        logger.warning(f"db config - json loads failed {e}")
+    return value
+
+
+class ConfigCompiler(object):
+    """
+    系统配置模板编译器，所有激活的配置只加载和解析一次，根据模板变量构建依赖图，
+    按照拓扑顺序渲染并缓存结果，配置变更时只重新渲染变更配置及依赖它的配置
+    """
+
+    def __init__(self, namespace='config_system'):
+        self.namespace = namespace
+        self.generation = None
+        self.loaded = False
+        self.raw = {}  # key: 配置的json字符串
+        self.templates = {}  # key: 编译之后的模板
+        self.dependencies = {}  # key: 模板中引用的变量
+        self.cycles = set()  # 处于循环引用中的配置 key
+        self.rendered = {}  # key: 渲染之后的配置值
+        self._lock = threading.RLock()
+
+    def parse(self, key, str_value):
+        self.raw[key] = str_value
+        try:
+            self.templates[key] = Template(str_value)
+            self.dependencies[key] = get_template_variables(self.templates[key])
+        except TemplateSyntaxError as e:
+            logger.warning(f"db config - parse {key} template failed {e}")
+            self.templates.pop(key, None)
+            self.dependencies[key] = set()
+
+    def load(self):
+        self.raw.clear()
+        self.templates.clear()
+        self.dependencies.clear()
+        self.rendered.clear()
+        for key, value in SystemConfig.objects.filter(is_active=True).values_list('key', 'value'):
+            self.parse(key, json.dumps(value))  # 将dict转换为json字符串进行渲染
+        self.cycles = self.find_cycles()
+        self.loaded = True
+
+    def get_render_dependencies(self, key):
+        """
+        大写变量使用渲染之后的配置值，需要先渲染被依赖的配置；小写变量直接使用配置的json字符串
+        """
+        return [dep for dep in self.dependencies.get(key, ()) if dep[0].isupper() and dep in self.raw]
+
+    def is_self_reference(self, key):
+        return key in self.dependencies.get(key, ())
+
+    def find_cycles(self):
+        """
+        迭代的三色深度优先遍历，返回所有处于环上的配置 key
+        """
+        cycles = set()
+        state = {}  # 1: 遍历中，2: 遍历完成
+        for root in self.raw:
+            if root in state:
+                continue
+            path = [root]
+            stack = [iter(self.get_render_dependencies(root))]
+            state[root] = 1
+            while stack:
+                dep = next(stack[-1], None)
+                if dep is None:
+                    state[path.pop()] = 2
+                    stack.pop()
+                elif state.get(dep) == 2:
+                    continue
+                elif state.get(dep) == 1:
+                    cycle = path[path.index(dep):]
+                    logger.warning(f"db config - render cycle found {' -> '.join(cycle + [dep])}")
+                    cycles.update(cycle)
+                else:
+                    state[dep] = 1
+                    path.append(dep)
+                    stack.append(iter(self.get_render_dependencies(dep)))
+        return cycles
+
+    def get_dependants(self, key):
+        """
+        获取直接或者间接依赖 key 的所有配置
+        """
+        dependants = set()
+        queue = [key]
+        while queue:
+            current = queue.pop()
+            for k, deps in self.dependencies.items():
+                if current in deps and k not in dependants:
+                    dependants.add(k)
+                    queue.append(k)
+        return dependants
+
+    def topological_order(self, variables):
+        """
+        返回渲染 variables 所需配置的拓扑顺序，被依赖的配置在前，已渲染和循环引用的配置不再展开
+        """
+        order = []
+        visited = set()
+        for root in variables:
+            stack = [(root, False)]
+            while stack:
+                key, expanded = stack.pop()
+                if expanded:
+                    order.append(key)
+                    continue
+                if key in visited or key not in self.raw or key in self.rendered or key in self.cycles:
+                    continue
+                visited.add(key)
+                stack.append((key, True))
+                stack.extend((dep, False) for dep in self.get_render_dependencies(key))
+        return order
+
+    def check_generation(self):
+        generation = GenerationCache.get_generations([self.namespace]).get(self.namespace)
+        with self._lock:
+            if not self.loaded or generation != self.generation:
+                self.load()
+                self.generation = generation
+
+    def invalidate(self, key='*', generation=None):
+        """
+        配置变更之后调用，generation 为变更之后的命名空间版本号，用于和定期校验保持一致
+        """
+        with self._lock:
+            if generation is not None and generation == self.generation:
+                # 当前进程已经处理过该变更
+                return
+            if not self.loaded or not key or '*' in key:
+                self.loaded = False
+                return
+            for k in self.get_dependants(key) | {key}:
+                self.rendered.pop(k, None)
+            values = list(SystemConfig.objects.filter(is_active=True, key=key).values_list('value', flat=True)[:1])
+            if values:
+                self.parse(key, json.dumps(values[0]))
+            else:
+                self.raw.pop(key, None)
+                self.templates.pop(key, None)
+                self.dependencies.pop(key, None)
+            self.cycles = self.find_cycles()
+            if generation is not None:
+                self.generation = generation
+
+    def get_context(self, variables):
+        context = {}
+        for v_key in variables:
+            if v_key[0].isupper():
+                if v_key in self.rendered:
+                    context[v_key] = self.rendered[v_key]
+                elif v_key not in self.raw or self.is_self_reference(v_key):
+                    # 数据库中不存在或者引用自身的配置，使用配置类中定义的默认值
+                    context[v_key] = getattr(SysConfig, v_key)
+            elif v_key in self.raw and not self.is_self_reference(v_key):
+                context[v_key] = self.raw[v_key]
+        return context
+
+    def render_template(self, template: Template, variables) -> str:
+        return template.render(Context(self.get_context(variables)))
+
+    def render(self, value: str) -> str:
+        self.check_generation()
+        template = Template(value)
+        variables = get_template_variables(template)
+        with self._lock:
+            for key in self.topological_order(variables):
+                try:
+                    if key in self.templates:
+                        str_value = self.render_template(self.templates[key], self.dependencies[key])
+                    else:
+                        str_value = self.raw[key]
+                except Exception as e:
+                    logger.warning(f"db config - render {key} failed {e}")
+                    str_value = self.raw[key]
+                self.rendered[key] = load_render_value(str_value)
+            return self.render_template(template, variables)
+
+
+config_compiler = ConfigCompiler()
+
+
+class ConfigSubPub(LazyObject):
+    def _setup(self):
+        from common.utils.connection import RedisPubSub
+        self._wrapped = RedisPubSub('config_cache_invalid')
+
+
+config_pub_sub = ConfigSubPub()
+
+
+class ConfigSnapshot(object):
+    """
+    进程内配置快照，配置失效时通过发布订阅通知清理，同时定期校验命名空间版本号，避免丢失通知
+    """
+
+    def __init__(self, check_interval=60):
+        self.check_interval = check_interval
+        self.generations = None
+        self._data = {}
+        self._checked_time = 0
+        self._lock = threading.Lock()
+
+    def check_generations(self, namespaces):
+        if time.time() - self._checked_time < self.check_interval:
+            return
+        generations = GenerationCache.get_generations(namespaces)
+        with self._lock:
+            self._checked_time = time.time()
+            if generations != self.generations:
+                self._data.clear()
+                self.generations = generations
+
+    def get(self, key, namespaces):
+        self.check_generations(namespaces)
+        data = self._data.get(key)
+        # 返回副本，避免调用方修改快照数据
+        return copy.deepcopy(data) if data is not None else None
+
+    def set(self, key, data):
+        with self._lock:
+            if data.get('generations') == self.generations:
+                self._data[key] = copy.deepcopy(data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._checked_time = 0
 
 
 class ConfigCacheBase(object):
     def __init__(self, px='system', model=SystemConfig, cache=UserSystemConfigCache, serializer=SystemConfigSerializer,
-                 timeout=60 * 60 * 24 * 30, filter_kwargs=None):
+                 timeout=60 * 60 * 24 * 30, filter_kwargs=None, snapshot=None):
         if filter_kwargs is None:
             filter_kwargs = {}
         self.px = px
@@ -50,44 +292,49 @@ class ConfigCacheBase(object):
         self.timeout = timeout
         self.serializer = serializer
         self.filter_kwargs = filter_kwargs
+        self.snapshot = snapshot
+
+    def get_generation_namespaces(self):
+        return [f'config_{self.px}']
 
     def invalid_config_cache(self, key='*'):
-        UserSystemConfigCache(f'{self.px}_{key}').del_many()
+        """
+        配置之间可以通过模板互相引用，所以使该命名空间的所有缓存失效，并通知所有进程清理配置快照
+        在事务提交之后执行，否则其他进程重新读取到的仍是提交前的数据，并以新的版本号缓存
+        """
+        transaction.on_commit(lambda: self.publish_invalid_config_cache(key), using=router.db_for_write(self.model))
+
+    def publish_invalid_config_cache(self, key='*'):
+        generation = GenerationCache(self.get_generation_namespaces()[-1]).bump_generation()
+        if self.snapshot is not None:
+            self.snapshot.clear()
+        if self.model is SystemConfig:
+            config_compiler.invalidate(key, generation)
+        try:
+            config_pub_sub.publish({'px': self.px, 'key': key, 'generation': generation})
+        except Exception as e:
+            logger.error(f"publish config invalid failed. {self.px} {key} Exception:{e}")
+
+    @staticmethod
+    def is_valid_cache(cache_data, key, generations):
+        return (cache_data is not None and cache_data.get('key', '') == key
+                and cache_data.get('generations', {}) == generations)
 
     def get_render_value(self, value: str) -> dict:
         if value:
             try:
-                context_dict = {}
-                for sys_obj_dict in self.model.objects.filter(is_active=True).values().all():
-                    str_value = json.dumps(sys_obj_dict['value'])  # 将dict转换为json字符串进行匹配
-                    if re.findall('{{.*%s.*}}' % sys_obj_dict['key'], str_value):
-                        logger.warning(f"get same render key. so continue")
-                        continue
-                    context_dict[sys_obj_dict['key']] = str_value
-                try:
-                    value = get_render_context(value, context_dict)
-                except TemplateSyntaxError as e:
-                    res_list = re.findall("Could not parse the remainder: '{{(.*?)}}'", str(e))
-                    for res in res_list:
-                        r_value = self.get_render_value(f'{{{{{res}}}}}')
-                        value = value.replace(f'{{{{{res}}}}}', f'{r_value}')
-                    value = self.get_render_value(value)
-                except Exception as e:
-                    logger.warning(f"db config - render failed {e}")
+                value = config_compiler.render(value)
+            except TemplateSyntaxError as e:
+                res_list = re.findall("Could not parse the remainder: '{{(.*?)}}'", str(e))
+                for res in res_list:
+                    r_value = self.get_render_value(f'{{{{{res}}}}}')
+                    value = value.replace(f'{{{{{res}}}}}', f'{r_value}')
+                value = self.get_render_value(value)
             except Exception as e:
                 logger.warning(f"db config - render failed {e}")
-        value = value.replace('"(', '').replace(')"', '')  # 支持"({{ h }})"， 为了转换变量，h不能为字符串
-        try:
-            value = json.loads(value)
-        except Exception as e:
-            logger.warning(f"db config - json loads failed {e}")
-        # if isinstance(value, str):
-        #     if value.isdigit():
-        #         return int(value)
-        #     v_group = re.findall('"(.*?)"', value)
-        #     if v_group and len(v_group) == 1 and v_group[0].isdigit():
-        #         return int(v_group[0])
-        return value
+        if not isinstance(value, str):
+            return value
+        return load_render_value(value)
 
     def get_value_from_db(self, key):  # 取得数据是激活的数据，如果数据未激活，则取默认数据
         data = self.serializer(self.model.objects.filter(is_active=True, key=key, **self.filter_kwargs).first()).data
@@ -108,9 +355,17 @@ class ConfigCacheBase(object):
         return data
 
     def get_data(self, key, default_data=None, ignore_access=True):
+        if self.snapshot is not None:
+            cache_data = self.snapshot.get(key, self.get_generation_namespaces())
+            if cache_data is not None:
+                return cache_data if ignore_access or cache_data.get('access') else {}
         cache = self.cache(f'{self.px}_{key}')
-        cache_data = cache.get_storage_cache()
-        if cache_data is not None and cache_data.get('key', '') == key:
+        data, generations = GenerationCache.get_many_with_generations([cache.cache_key],
+                                                                      self.get_generation_namespaces())
+        cache_data = decompress_value(data.get(cache.cache_key))
+        if self.is_valid_cache(cache_data, key, generations):
+            if self.snapshot is not None:
+                self.snapshot.set(key, cache_data)
             if ignore_access or cache_data.get('access'):
                 return cache_data
         db_data = self.get_value_from_db(key)
@@ -122,7 +377,10 @@ class ConfigCacheBase(object):
                 db_data['key'] = key
                 db_data['access'] = True
         db_data['value'] = self.get_render_value(json.dumps(db_data['value']))
+        db_data['generations'] = generations
         cache.set_storage_cache(db_data, timeout=self.timeout)
+        if self.snapshot is not None:
+            self.snapshot.set(key, db_data)
         if ignore_access or db_data.get('access'):
             return db_data
         return {}
@@ -140,7 +398,7 @@ class ConfigCacheBase(object):
 
     def set_value(self, key, value, is_active=None, description=None, **kwargs):
         obj = self.save_db(key, value, is_active, description, **kwargs)
-        self.cache(f'{self.px}_{key}').del_storage_cache()
+        self.invalid_config_cache(key)
         return obj
 
     def set_default_value(self, key, **kwargs):
@@ -148,7 +406,7 @@ class ConfigCacheBase(object):
 
     def del_value(self, key, **kwargs):
         self.delete_db(key, **kwargs)
-        self.cache(f'{self.px}_{key}').del_storage_cache()
+        self.invalid_config_cache(key)
 
     def __getattribute__(self, name):
         if name == 'shape':
@@ -191,7 +449,17 @@ class ConfigCache(BaseConfCache, MessagePushConfCache):
         super(ConfigCache, self).__init__(*args, **kwargs)
 
 
-SysConfig = ConfigCache()
+SysConfig = ConfigCache(snapshot=ConfigSnapshot())
+
+
+def handle_config_invalid(data):
+    if data.get('px') == SysConfig.px:
+        SysConfig.snapshot.clear()
+        config_compiler.invalidate(data.get('key', '*'), data.get('generation'))
+
+
+def subscribe_config_invalid():
+    config_pub_sub.subscribe(handle_config_invalid)
 
 
 class UserConfigSerializer(serializers.ModelSerializer):
@@ -209,9 +477,49 @@ class UserPersonalConfigCache(ConfigCache):
             self.filter_kwargs = {'owner_id': self.user_obj}
         else:
             key = user_obj.pk
+        self.user_key = key
         super().__init__(f'user_{key}', UserPersonalConfig, UserSystemConfigCache, UserConfigSerializer,
                          filter_kwargs=self.filter_kwargs)
 
+    def get_generation_namespaces(self):
+        # 所有用户共用 config_user 命名空间，用于批量失效所有用户的配置缓存
+        if self.user_key == '*':
+            return ['config_user']
+        return ['config_user', f'config_user_{self.user_key}']
+
+    @classmethod
+    def get_many(cls, keys, owners, defaults=None):
+        """
+        批量获取多个用户的多个配置，缓存全部命中时只需要一次 redis 请求
+        :param keys: 配置 key 列表
+        :param owners: 用户或者用户 pk 列表
+        :param defaults: 配置默认值 {key: default}
+        :return: {owner_pk: {key: value}}
+        """
+        if defaults is None:
+            defaults = {}
+        configs = {}
+        for owner in owners:
+            owner_pk = getattr(owner, 'pk', owner)
+            configs[owner_pk] = cls(owner_pk)
+        cache_keys = {}
+        namespaces = set()
+        for owner_pk, config in configs.items():
+            namespaces.update(config.get_generation_namespaces())
+            for key in keys:
+                cache_keys[config.cache(f'{config.px}_{key}').cache_key] = (owner_pk, key)
+        data, generations = GenerationCache.get_many_with_generations(cache_keys.keys(), namespaces)
+        result = defaultdict(dict)
+        for cache_key, (owner_pk, key) in cache_keys.items():
+            config = configs[owner_pk]
+            cache_data = decompress_value(data.get(cache_key))
+            config_generations = {n: generations[n] for n in config.get_generation_namespaces()}
+            if config.is_valid_cache(cache_data, key, config_generations):
+                result[owner_pk][key] = cache_data.get('value')
+            else:
+                result[owner_pk][key] = config.get_value(key, defaults.get(key))
+        return result
+
     def get_default_data(self, key, default_data):
         data = SysConfig.get_data(key, default_data)
         if data and data.get('inherit'):
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# project : xadmin-server
+# filename : lookups
+# author : ly_13
+# date : 10/18/2026
+from ipaddress import ip_address
+
+from django.db import models, NotSupportedError
+from django.db.backends.signals import connection_created
+from django.db.models import Lookup
+from django.dispatch import receiver
+
+
+def format_ip_key(version, value):
+    """
+    ip 转换为定长字符串，保证字符串比较和整数比较结果一致
+    """
+    return f"{version}:{value:032x}"
+
+
+def ip_to_key(value):
+    try:
+        ip = ip_address(value)
+    except (TypeError, ValueError):
+        return None
+    return format_ip_key(ip.version, int(ip))
+
+
+IPV4_PATTERN = r'^((25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])$'
+IPV6_HEX = '[0-9a-fA-F]{1,4}'
+# 不包含内嵌 ipv4 的 ipv6 地址，匹配的数据都可以转换为 inet
+IPV6_PATTERN = (
+    f'^(({IPV6_HEX}:){{7}}{IPV6_HEX}|({IPV6_HEX}:){{1,7}}:|({IPV6_HEX}:){{1,6}}:{IPV6_HEX}'
+    f'|({IPV6_HEX}:){{1,5}}(:{IPV6_HEX}){{1,2}}|({IPV6_HEX}:){{1,4}}(:{IPV6_HEX}){{1,3}}'
+    f'|({IPV6_HEX}:){{1,3}}(:{IPV6_HEX}){{1,4}}|({IPV6_HEX}:){{1,2}}(:{IPV6_HEX}){{1,5}}'
+    f'|{IPV6_HEX}:(:{IPV6_HEX}){{1,6}}|:((:{IPV6_HEX}){{1,7}}|:))$'
+)
+
+
+class IPInRange(Lookup):
+    """
+    ip 区间查询，rhs 为 common.utils.ip.get_ip_range 返回的 (version, start, end) 整数区间
+    每个区间只生成一个范围比较，不再展开网段内所有的 ip
+    """
+    lookup_name = 'ip_range'
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        # ip 字符串按照字典序比较结果不正确，例如 '10.0.0.9' > '10.0.0.10'
+        raise NotSupportedError(f"{self.lookup_name} lookup is not supported on {connection.vendor}")
+
+    def as_postgresql(self, compiler, connection):
+        version, start, end = self.rhs
+        lhs_sql, lhs_params = self.process_lhs(compiler, connection)
+        lhs_params = list(lhs_params)
+        params = [str(ip_address(start)), str(ip_address(end))]
+        if isinstance(self.lhs.output_field, models.GenericIPAddressField):
+            # GenericIPAddressField 在 postgresql 中为 inet 类型，直接使用 inet 比较
+            return f"({lhs_sql})::inet BETWEEN %s::inet AND %s::inet", lhs_params + params
+        # 字符字段中可能存在空字符串等非 ip 数据，直接转换为 inet 会导致整个查询报错，只转换格式正确的数据
+        pattern = IPV4_PATTERN if version == 4 else IPV6_PATTERN
+        sql = f"CASE WHEN ({lhs_sql}) ~ %s THEN ({lhs_sql})::inet END BETWEEN %s::inet AND %s::inet"
+        return sql, lhs_params + [pattern] + lhs_params + params
+
+    def as_mysql(self, compiler, connection):
+        version, start, end = self.rhs
+        lhs_sql, lhs_params = self.process_lhs(compiler, connection)
+        lhs_params = list(lhs_params)
+        if version == 4:
+            return f"INET_ATON({lhs_sql}) BETWEEN %s AND %s", lhs_params + [start, end]
+        lhs_sql = f"INET6_ATON({lhs_sql})"
+        params = lhs_params + lhs_params + [ip_address(start).packed, ip_address(end).packed]
+        # INET6_ATON 转换 ipv4 地址的结果为 4 字节，需要排除
+        return f"LENGTH({lhs_sql}) = 16 AND {lhs_sql} BETWEEN %s AND %s", params
+
+    def as_sqlite(self, compiler, connection):
+        # ip_to_key 函数在创建数据库连接时注册
+        version, start, end = self.rhs
+        lhs_sql, lhs_params = self.process_lhs(compiler, connection)
+        params = list(lhs_params) + [format_ip_key(version, start), format_ip_key(version, end)]
+        return f"ip_to_key({lhs_sql}) BETWEEN %s AND %s", params
+
+
+@receiver(connection_created)
+def register_sqlite_functions(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function('ip_to_key', 1, ip_to_key, deterministic=True)
+
+
+models.CharField.register_lookup(IPInRange)
+models.GenericIPAddressField.register_lookup(IPInRange)
@@ -4,13 +4,15 @@
 # filename : utils
 # author : ly_13
 # date : 12/18/2023
-import ipaddress
 import re
 from contextlib import contextmanager
 
 from django.db import connections, transaction, connection
 from django.db.models import Q
 
+from common.core.db.lookups import IPInRange
+from common.utils.ip import get_ip_range
+
 
 class RelatedManager:
     def __init__(self, instance, field):
@@ -27,27 +29,21 @@ class RelatedManager:
         q = Q()
         if isinstance(val, str):
             val = [val]
-        if ['*'] in val:
+        if '*' in val:
             return Q()
         for ip in val:
             if not ip:
                 continue
-            try:
-                if '/' in ip:
-                    network = ipaddress.ip_network(ip)
-                    ips = network.hosts()
-                    q |= Q(**{"{}__in".format(name): ips})
-                elif '-' in ip:
-                    start_ip, end_ip = ip.split('-')
-                    start_ip = ipaddress.ip_address(start_ip)
-                    end_ip = ipaddress.ip_address(end_ip)
-                    q |= Q(**{"{}__range".format(name): (start_ip, end_ip)})
-                elif len(ip.split('.')) == 4:
-                    q |= Q(**{"{}__exact".format(name): ip})
-                else:
-                    q |= Q(**{"{}__startswith".format(name): ip})
-            except ValueError:
+            ip_range = get_ip_range(ip)
+            if ip_range is not None:
+                # 192.168.1.0/24 或 10.1.1.1-10.1.1.20 只生成一个区间比较
+                q |= Q(**{"{}__{}".format(name, IPInRange.lookup_name): ip_range})
+            elif '/' in ip or '-' in ip:
                 continue
+            elif len(ip.split('.')) == 4:
+                q |= Q(**{"{}__exact".format(name): ip})
+            else:
+                q |= Q(**{"{}__startswith".format(name): ip})
         return q
 
     @classmethod
@@ -8,12 +8,14 @@ from functools import partial
 
 import phonenumbers
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db import models
 from django.db.models import Model
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 from rest_framework.fields import ChoiceField
 from rest_framework.request import Request
+from rest_framework.relations import ManyRelatedField
 from rest_framework.serializers import RelatedField, MultipleChoiceField
 
 from common.core.filter import get_filter_queryset
@@ -92,11 +94,21 @@ class BasePrimaryKeyRelatedField(RelatedField):
         self.input_type = kwargs.pop("input_type", '')
         self.many = kwargs.get("many", False)
         super().__init__(**kwargs)
-        self.request: Request = get_current_request()
+        self.request: Request = None  # 使用时再获取当前请求，避免每个字段实例化时都查找一次
         self.ignore_field_permission = ignore_field_permission
+        self._allow_fields = {}  # 关联模型: 允许展示的字段，同一个字段实例内权限不变，避免每条数据重复计算
+
+    def __copy__(self):
+        # 序列化器复用缓存的字段原型时浅复制字段，请求和字段权限需要重新获取
+        field = self.__class__.__new__(self.__class__)
+        field.__dict__.update(self.__dict__)
+        field.request = None
+        field._allow_fields = {}
+        return field
 
     def use_pk_only_optimization(self):
-        return False
+        # 没有定义 attrs 时只返回主键，直接使用外键字段的值，不需要查询关联数据
+        return self.attrs is None
 
     def __add_request(self):
         if not self.request:
@@ -125,11 +137,7 @@ class BasePrimaryKeyRelatedField(RelatedField):
             queryset = queryset[:cutoff]
 
         if is_column:
-            result = []
-            for item in queryset:
-                data = self.to_representation(item)
-                data['value'] = data.get("pk")
-                result.append(data)
+            result = [self.to_choice(item) for item in queryset]
         else:
             result = {}
             for item in queryset:
@@ -139,10 +147,41 @@ class BasePrimaryKeyRelatedField(RelatedField):
                 result[key] = self.display_value(item)
         return result
 
+    def to_choice(self, item):
+        data = self.to_representation(item)
+        if not isinstance(data, dict):  # 没有 attrs 时只返回了主键
+            data = {'pk': data, 'label': self.display_value(item)}
+        data['value'] = data.get("pk")
+        return data
+
+    def get_search_fields(self, model):
+        """
+        关联数据可以搜索的字段，只搜索有权限展示的字符字段
+        """
+        allow_fields = self.get_allow_fields(model) or set()
+        attrs = self.attrs if isinstance(self.attrs, (list, tuple)) else sorted(allow_fields)
+        search_fields = []
+        for attr in attrs:
+            if attr not in allow_fields:
+                continue
+            try:
+                model_field = model._meta.get_field(attr)
+            except FieldDoesNotExist:
+                continue
+            if isinstance(model_field, (models.CharField, models.TextField)):
+                search_fields.append(attr)
+        return search_fields
+
     def get_allow_fields(self, value):
         self.__add_request()
         if self.attrs is None:  # 默认没写attrs, 返回默认pk
             return self.attrs
+        label = value._meta.label_lower
+        if label not in self._allow_fields:
+            self._allow_fields[label] = self._get_allow_fields(value)
+        return self._allow_fields[label]
+
+    def _get_allow_fields(self, value):
         fields = [x.name for x in value._meta.fields]
 
         if not isinstance(self.attrs, (list, set)):  # 如果存在，且不是列表，则返回所有字段
@@ -190,17 +229,62 @@ class BasePrimaryKeyRelatedField(RelatedField):
                     data["label"] = data.get("pk")
         return data
 
+    def get_pk_value(self, data):
+        if isinstance(data, Model):
+            return data.pk
+        if not isinstance(data, dict):
+            return data
+        return data.get("id") or data.get("pk") or data.get(self.attrs[0])
+
+    def get_prefetch_key(self):
+        # many=True 时，当前字段为 ManyRelatedField 的 child_relation，使用父字段的名称
+        field = self.parent if isinstance(self.parent, ManyRelatedField) else self
+        return field.field_name
+
+    def prefetch(self, values):
+        """
+        批量导入时，一次查询出这批数据引用的全部对象，结果放到序列化的 context['prefetched_objects'] 中
+        """
+        queryset = self.get_queryset()
+        if queryset is None:
+            return None
+        pk_field = queryset.model._meta.pk
+        pks = set()
+        for value in values:
+            try:
+                pk = pk_field.to_python(self.get_pk_value(value))
+            except (DjangoValidationError, TypeError, ValueError):
+                continue  # 错误的数据在校验时返回错误信息
+            if pk is not None and not isinstance(value, bool):
+                pks.add(pk)
+        if not pks:
+            return {}
+        return {str(pk): obj for pk, obj in queryset.in_bulk(pks).items()}
+
+    def get_prefetched_object(self, prefetched, data):
+        pk = self.get_pk_value(data)
+        try:
+            if isinstance(data, bool):
+                raise TypeError
+            obj = prefetched.get(str(self.queryset.model._meta.pk.to_python(pk)))
+        except (DjangoValidationError, TypeError, ValueError):
+            self.fail("incorrect_type", data_type=type(pk).__name__)
+        if obj is None:
+            self.fail("does_not_exist", pk_value=pk)
+        return obj
+
     def to_internal_value(self, data):
+        prefetched = self.context.get('prefetched_objects', {}).get(self.get_prefetch_key())
+        if prefetched is not None:
+            return self.get_prefetched_object(prefetched, data)
+
         queryset = self.get_queryset()
         if queryset is None:
             return self.fail("queryset_none")
         if isinstance(data, Model):
             return queryset.get(pk=data.pk)
 
-        if not isinstance(data, dict):
-            pk = data
-        else:
-            pk = data.get("id") or data.get("pk") or data.get(self.attrs[0])
+        pk = self.get_pk_value(data)
 
         try:
             if isinstance(data, bool):
@@ -20,7 +20,7 @@ from rest_framework.exceptions import NotAuthenticated
 from rest_framework.filters import BaseFilterBackend
 
 from common.base.magic import timeit, count_sql_queries
-from common.cache.storage import CommonResourceIDsCache
+from common.cache.storage import CommonResourceIDsCache, DataPermissionRulesCache, GenerationCache
 from common.core.db.utils import RelatedManager
 from common.utils import get_logger
 from system.models import UserInfo, DataPermission, ModeTypeAbstract, DeptInfo, ModelLabelField
@@ -28,7 +28,19 @@ from system.models import UserInfo, DataPermission, ModeTypeAbstract, DeptInfo,
 logger = get_logger(__name__)
 
 
-def get_filter_q_base(model, permission, user_obj=None, dept_obj=None):
+# 与当前时间相关的规则，编译后保留原始值，每次请求时再进行计算
+TIME_RELATED_KEYS = [
+    ModelLabelField.KeyChoices.DATE,
+    ModelLabelField.KeyChoices.DATETIME_RANGE,
+    ModelLabelField.KeyChoices.DATETIME,
+]
+
+
+def compile_filter_rules(model, permission, user_obj=None, dept_obj=None):
+    """
+    将数据权限规则编译为可序列化的规则列表，部门递归、JSON解析等操作在此处完成
+    :return: True 表示全部数据，False 表示没有数据，否则返回 [{'mode': mode, 'rules': rules}]
+    """
     results = []
     for obj in permission:
         rules = []
@@ -45,9 +57,8 @@ def get_filter_q_base(model, permission, user_obj=None, dept_obj=None):
                 rules.append(rule)
         if rules:
             results.append({'mode': obj.mode_type, 'rules': rules})
-    or_qs = []
     if not results:
-        return Q(id=0)
+        return False
     for result in results:
         for rule in result.get('rules'):
             f_type = rule.get('type')
@@ -64,13 +75,13 @@ def get_filter_q_base(model, permission, user_obj=None, dept_obj=None):
             elif f_type == ModelLabelField.KeyChoices.OWNER_DEPARTMENTS:
                 rule['match'] = 'in'
                 if dept_obj:
-                    rule['value'] = DeptInfo.recursion_dept_info(dept_obj.pk)
+                    rule['value'] = DeptInfo.get_descendant_pks(dept_obj.pk)
                 else:
                     rule['value'] = []
             elif f_type == ModelLabelField.KeyChoices.DEPARTMENTS:
                 rule['match'] = 'in'
                 if dept_obj:
-                    rule['value'] = DeptInfo.recursion_dept_info(json.loads(rule['value']))
+                    rule['value'] = DeptInfo.get_descendant_pks(json.loads(rule['value']))
                 else:
                     rule['value'] = []
             elif f_type == ModelLabelField.KeyChoices.ALL:
@@ -78,20 +89,7 @@ def get_filter_q_base(model, permission, user_obj=None, dept_obj=None):
                 if ModeTypeAbstract.ModeChoices.OR == result.get('mode'):
                     if (dept_obj and dept_obj.mode_type == ModeTypeAbstract.ModeChoices.OR) or not dept_obj:
                         logger.info(f"{model._meta.label_lower} : all queryset")
-                        return Q()  # 全部数据直接返回 queryset
-            elif f_type == ModelLabelField.KeyChoices.DATE:
-                val = json.loads(rule['value'])
-                if val < 0:
-                    rule['value'] = timezone.now() - datetime.timedelta(seconds=-val)
-                else:
-                    rule['value'] = timezone.now() + datetime.timedelta(seconds=val)
-            elif f_type == ModelLabelField.KeyChoices.DATETIME_RANGE:
-                if isinstance(rule['value'], list) and len(rule['value']) == 2:
-                    rule['value'] = [from_current_timezone(parse_datetime(rule['value'][0])),
-                                     from_current_timezone(parse_datetime(rule['value'][1]))]
-            elif f_type == ModelLabelField.KeyChoices.DATETIME:
-                if isinstance(rule['value'], str):
-                    rule['value'] = from_current_timezone(parse_datetime(rule['value']))
+                        return True  # 全部数据直接返回 queryset
             elif f_type in [ModelLabelField.KeyChoices.TABLE_USER,
                             ModelLabelField.KeyChoices.TABLE_MENU, ModelLabelField.KeyChoices.TABLE_ROLE,
                             ModelLabelField.KeyChoices.TABLE_DEPT]:
@@ -104,10 +102,46 @@ def get_filter_q_base(model, permission, user_obj=None, dept_obj=None):
                 rule['value'] = value
             elif f_type == ModelLabelField.KeyChoices.JSON:
                 rule['value'] = json.loads(rule['value'])
-            rule.pop('type', None)
+            if f_type not in TIME_RELATED_KEYS:
+                rule.pop('type', None)
+    return results
+
+
+def resolve_filter_rule(rule):
+    """
+    计算与当前时间相关的规则值，返回新的规则，不修改编译后的缓存数据
+    """
+    rule = dict(rule)
+    f_type = rule.pop('type', None)
+    if f_type == ModelLabelField.KeyChoices.DATE:
+        val = json.loads(rule['value'])
+        if val < 0:
+            rule['value'] = timezone.now() - datetime.timedelta(seconds=-val)
+        else:
+            rule['value'] = timezone.now() + datetime.timedelta(seconds=val)
+    elif f_type == ModelLabelField.KeyChoices.DATETIME_RANGE:
+        if isinstance(rule['value'], list) and len(rule['value']) == 2:
+            rule['value'] = [from_current_timezone(parse_datetime(rule['value'][0])),
+                             from_current_timezone(parse_datetime(rule['value'][1]))]
+    elif f_type == ModelLabelField.KeyChoices.DATETIME:
+        if isinstance(rule['value'], str):
+            rule['value'] = from_current_timezone(parse_datetime(rule['value']))
+    return rule
 
+
+def build_filter_q_base(model, results, dept_mode=None):
+    """
+    根据编译后的规则构建 Q 查询，该过程不会查询数据库
+    :param dept_mode: 用户部门的数据权限模式，没有部门则为 None
+    """
+    if results is True:
+        return Q()
+    if results is False:
+        return Q(id=0)
+    or_qs = []
+    for result in results:
         #  ((0, '或模式'), (1, '且模式'))
-        qs = RelatedManager.get_filter_attrs_qs(result.get('rules'))
+        qs = RelatedManager.get_filter_attrs_qs([resolve_filter_rule(rule) for rule in result.get('rules')])
         q = Q()
         if result.get('mode') == ModeTypeAbstract.ModeChoices.AND:
             for a in set(qs):
@@ -122,12 +156,12 @@ def get_filter_q_base(model, permission, user_obj=None, dept_obj=None):
                 q |= a
         or_qs.append(q)
     q1 = Q()
-    if not dept_obj:
+    if dept_mode is None:
         for q in set(or_qs):
             q1 |= q
     else:
         for q in set(or_qs):
-            if dept_obj.mode_type == ModeTypeAbstract.ModeChoices.AND:
+            if dept_mode == ModeTypeAbstract.ModeChoices.AND:
                 if q == Q():
                     continue
                 q1 &= q
@@ -135,12 +169,87 @@ def get_filter_q_base(model, permission, user_obj=None, dept_obj=None):
                 if q == Q():
                     return q
                 q1 |= q
-        if dept_obj.mode_type == ModeTypeAbstract.ModeChoices.AND and q1 == Q():
+        if dept_mode == ModeTypeAbstract.ModeChoices.AND and q1 == Q():
             return Q(id=0)
     logger.info(f"{model._meta.label_lower} : {q1}")
     return q1
 
 
+def get_filter_q_base(model, permission, user_obj=None, dept_obj=None):
+    results = compile_filter_rules(model, permission, user_obj, dept_obj)
+    return build_filter_q_base(model, results, dept_obj.mode_type if dept_obj else None)
+
+
+def compile_filter_queryset(model, user_obj):
+    """
+    编译用户在该模型上的全部数据权限规则，包含部门规则和个人规则
+    """
+    dept_obj = user_obj.dept
+    dq = Q(menu__isnull=True) | Q(menu__isnull=False, menu__pk=getattr(user_obj, 'menu', None))
+    compiled = {'dept_mode': None, 'depts': [], 'user': None}
+    if dept_obj:
+        compiled['dept_mode'] = dept_obj.mode_type
+        # 存在部门，通过闭包表获取所有上级部门，部门权限需要且模式，将获取到的所有部门的数据规则通过且操作
+        ancestor_query = DeptInfo.objects.filter(pk__in=DeptInfo.ancestor_subquery(dept_obj.pk), is_active=True)
+        for p_dept_obj in ancestor_query:
+            # 获取对应的数据权限
+            permission = DataPermission.objects.filter(is_active=True).filter(deptinfo=p_dept_obj).filter(dq)
+            compiled['depts'].append(compile_filter_rules(model, permission, user_obj, dept_obj))
+    # 获取个人单独授权规则
+    permission = DataPermission.objects.filter(is_active=True).filter(userinfo=user_obj).filter(dq)
+    if permission.exists():
+        compiled['user'] = compile_filter_rules(model, permission, user_obj, dept_obj)
+    return compiled
+
+
+def build_filter_q(model, compiled):
+    """
+    :return: None 表示没有任何授权
+    """
+    dept_mode = compiled['dept_mode']
+    q = Q()
+    has_dept = False
+    if dept_mode is not None:
+        for results in compiled['depts']:
+            # 将数据权限且操作
+            q &= build_filter_q_base(model, results, dept_mode)
+            has_dept = True
+        if not has_dept and q == Q():
+            q = Q(id=0)
+        if has_dept and q == Q():
+            return q
+    # 不存在个人单独授权，则返回部门规则授权
+    if compiled['user'] is None:
+        if has_dept:
+            return q
+        return None
+    q1 = build_filter_q_base(model, compiled['user'], dept_mode)
+    if q1 == Q():
+        q = q1
+    else:
+        q |= q1  # 存在部门规则和个人规则，或操作
+    return q
+
+
+def get_data_permission_generation(user_pk):
+    """
+    全局版本号和用户版本号，数据权限相关数据变化后，版本号递增，旧的编译缓存自然失效
+    """
+    generations = GenerationCache.get_generations(['data_permission', f'data_permission_{user_pk}'])
+    return ".".join([str(generation) for generation in generations.values()])
+
+
+def get_compiled_filter_rules(model, user_obj):
+    generation = get_data_permission_generation(user_obj.pk)
+    menu = getattr(user_obj, 'menu', None)
+    rules_cache = DataPermissionRulesCache(f"{user_obj.pk}_{model._meta.label_lower}_{menu}_{generation}")
+    compiled = rules_cache.get_storage_cache()
+    if compiled is None:
+        compiled = compile_filter_queryset(model, user_obj)
+        rules_cache.set_storage_cache(compiled)
+    return compiled
+
+
 @timeit
 @count_sql_queries
 def get_filter_queryset(queryset: QuerySet, user_obj: UserInfo):
@@ -153,6 +262,7 @@ def get_filter_queryset(queryset: QuerySet, user_obj: UserInfo):
     b.判断外层规则 【如果规则数量为一个，则模式该规则链为或模式】
         若模式为或模式，并存在全部数据，则直接返回queryset
         若模式为且模式，则 返回queryset.filter(规则)
+    编译后的规则按照 (用户, 模型, 菜单, 版本号) 进行缓存，规则未变化时不会查询数据库
     """
     if not settings.PERMISSION_DATA_ENABLED or queryset is None:
         return queryset
@@ -161,38 +271,11 @@ def get_filter_queryset(queryset: QuerySet, user_obj: UserInfo):
         logger.info(f"superuser: {user_obj.username}. return all queryset {queryset.model._meta.label_lower}")
         return queryset
 
-    dept_obj = user_obj.dept
-    q = Q()
-    dq = Q(menu__isnull=True) | Q(menu__isnull=False, menu__pk=getattr(user_obj, 'menu', None))
-    has_dept = False
-    if dept_obj:
-        # 存在部门，递归获取部门，类似树结构，部门权限需要且模式，将获取到的所有部门的数据规则通过且操作
-        dept_pks = DeptInfo.recursion_dept_info(dept_obj.pk, is_parent=True)
-        for p_dept_obj in DeptInfo.objects.filter(pk__in=dept_pks, is_active=True):
-            # 获取对应的数据权限
-            permission = DataPermission.objects.filter(is_active=True).filter(deptinfo=p_dept_obj).filter(dq)
-            # 将数据权限且操作
-            q &= get_filter_q_base(queryset.model, permission, user_obj, dept_obj)
-            has_dept = True
-        if not has_dept and q == Q():
-            q = Q(id=0)
-        if has_dept and q == Q():
-            return queryset
-    # 获取个人单独授权规则
-    permission = DataPermission.objects.filter(is_active=True).filter(userinfo=user_obj).filter(dq)
-    # 不存在个人单独授权，则返回部门规则授权
-    if not permission.count():
-        logger.info(f"get filter end. {queryset.model._meta.label} : {q}")
-        if has_dept:
-            return queryset.filter(q)
-        else:
-            return queryset.none()  # 没有任何授权，返回 none
-    q1 = get_filter_q_base(queryset.model, permission, user_obj, dept_obj)
-    if q1 == Q():
-        q = q1
-    else:
-        q |= q1  # 存在部门规则和个人规则，或操作
+    compiled = get_compiled_filter_rules(queryset.model, user_obj)
+    q = build_filter_q(queryset.model, compiled)
     logger.info(f"get filter end. {queryset.model._meta.label} : {q}")
+    if q is None:
+        return queryset.none()  # 没有任何授权，返回 none
     return queryset.filter(q)
 
 
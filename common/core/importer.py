@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# project : xadmin-server
+# filename : importer
+# author : ly_13
+# date : 10/18/2026
+# 批量导入，按批次预取关联数据并校验，每个批次在一个事务中使用 bulk_create/bulk_update 写入数据库
+import itertools
+
+from django.contrib.auth.base_user import AbstractBaseUser
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction, router, connections, DatabaseError
+from django.db.models import Model, UniqueConstraint
+from django.db.models.signals import pre_save, post_save, m2m_changed
+from django.utils.translation import gettext_lazy as _
+from rest_framework import mixins
+from rest_framework.exceptions import ValidationError
+from rest_framework.relations import ManyRelatedField
+from rest_framework.serializers import ModelSerializer
+from rest_framework.utils import model_meta
+from rest_framework.validators import UniqueValidator, UniqueTogetherValidator
+
+from common.core.fields import BasePrimaryKeyRelatedField
+from common.utils import get_logger
+
+logger = get_logger(__name__)
+
+# 只是在父类 save 基础上增加了无关数据库写入的逻辑，可以使用批量写入
+BULK_SAFE_SAVE_METHODS = (Model.save, AbstractBaseUser.save)
+
+
+class BulkImporter(object):
+    """
+    批量导入数据
+    1. 每个批次中关联字段引用的数据，每个字段只查询一次数据库
+    2. 更新模式下，每个批次的待更新数据只查询一次数据库
+    3. 序列化器，视图，模型没有自定义保存逻辑时，使用 bulk_create/bulk_update 写入，并手动发送 pre_save/post_save 信号，
+       保留 creator, dept_belong, modifier 的自动填充和缓存清理等逻辑；否则逐条调用 perform_create/perform_update 保存
+    """
+
+    def __init__(self, view, act, ignore_error=False, batch_size=500, row_offset=0, row_indexes=None):
+        """
+        :param row_offset: 当前数据在上传文件中的起始序号
+        :param row_indexes: 每条数据在上传文件中的序号，数据被重新排序之后使用，优先于 row_offset
+        """
+        self.view = view
+        self.act = act
+        self.created = act == 'create'
+        self.ignore_error = ignore_error
+        self.batch_size = batch_size
+        self.row_offset = row_offset
+        self.row_indexes = row_indexes
+        self.count = 0
+        self.errors = []  # 每行的错误信息 [{'row': 1, 'errors': {...}}]
+
+        self.context = view.get_serializer_context()
+        self.context['prefetched_objects'] = {}
+        self.serializer = view.get_serializer(partial=not self.created, context=self.context)
+        self.model = self.serializer.Meta.model
+        self.using = router.db_for_write(self.model)
+        self.queryset = None if self.created else view.filter_queryset(view.get_queryset())
+        self.bulk = self.is_bulk_supported()
+        self.unique_together = self.get_unique_together() if self.bulk else []
+
+    def get_relation_fields(self):
+        for field_name, field in self.serializer.fields.items():
+            if field.read_only:
+                continue
+            if isinstance(field, ManyRelatedField) and isinstance(field.child_relation, BasePrimaryKeyRelatedField):
+                yield field_name, field.child_relation, True
+            elif isinstance(field, BasePrimaryKeyRelatedField):
+                yield field_name, field, False
+
+    def get_many_to_many_fields(self):
+        info = model_meta.get_field_info(self.model)
+        return {field_name for field_name, relation_info in info.relations.items() if relation_info.to_many}
+
+    def is_bulk_supported(self):
+        """
+        自定义了保存逻辑的序列化器、视图、模型，以及无法批量写入的多对多字段，改为逐条保存
+        """
+        if self.created:
+            if type(self.serializer).create is not ModelSerializer.create:
+                return False
+            if type(self.view).perform_create is not mixins.CreateModelMixin.perform_create:
+                return False
+            # 没有返回自增主键的数据库，无法在 bulk_create 之后发送信号和保存多对多数据
+            pk_field = self.model._meta.pk
+            if not connections[self.using].features.can_return_rows_from_bulk_insert and not pk_field.has_default():
+                return False
+        else:
+            if type(self.serializer).update is not ModelSerializer.update:
+                return False
+            if type(self.view).perform_update is not mixins.UpdateModelMixin.perform_update:
+                return False
+        if self.model.save not in BULK_SAFE_SAVE_METHODS:
+            return False
+        sources = {field.source for field in self.serializer.fields.values() if not field.read_only}
+        for field_name in self.get_many_to_many_fields() & sources:
+            field = self.model._meta.get_field(field_name)
+            if not field.many_to_many or field.auto_created or not field.remote_field.through._meta.auto_created:
+                return False
+        return True
+
+    def get_unique_together(self):
+        """
+        需要在批次内校验重复的唯一字段组合，包括单个唯一字段，unique_together 和没有条件的 UniqueConstraint
+        """
+        opts = self.model._meta
+        unique_together = [(field.name,) for field in opts.concrete_fields if field.unique and not field.primary_key]
+        unique_together.extend(tuple(fields) for fields in opts.unique_together)
+        for constraint in opts.constraints:
+            if isinstance(constraint, UniqueConstraint) and constraint.fields and not constraint.condition \
+                    and not constraint.expressions:
+                unique_together.append(tuple(constraint.fields))
+        return unique_together
+
+    def check_duplicates(self, index, instance, attrs, seen):
+        """
+        数据库唯一校验只能查询已存在的数据，同一批次中重复的唯一值需要在写入之前检查，否则批量写入会抛出 IntegrityError
+        :param seen: {唯一字段组合: {已出现的值}}
+        """
+        sources = {field.source: field_name for field_name, field in self.serializer.fields.items()}
+        opts = self.model._meta
+        for fields in self.unique_together:
+            if not any(name in attrs for name in fields):
+                continue
+            values = []
+            for name in fields:
+                if name in attrs:
+                    value = attrs[name]
+                elif instance is not None:
+                    value = getattr(instance, opts.get_field(name).attname)
+                else:
+                    value = None
+                values.append(value.pk if isinstance(value, Model) else value)
+            if None in values:
+                continue
+            values = tuple(values)
+            if values in seen.setdefault(fields, set()):
+                if len(fields) == 1:
+                    errors = {sources.get(fields[0], fields[0]): [str(UniqueValidator.message)]}
+                else:
+                    message = str(UniqueTogetherValidator.message)
+                    errors = {'non_field_errors': [
+                        message.format(field_names=', '.join(sources.get(name, name) for name in fields))
+                    ]}
+                self.add_error(index, errors)
+                return False
+            seen[fields].add(values)
+        return True
+
+    def add_error(self, index, errors):
+        row = self.row_indexes[index] if self.row_indexes else self.row_offset + index
+        self.errors.append({'row': row + 1, 'errors': errors})
+
+    def check_errors(self):
+        if self.errors and not self.ignore_error:
+            raise ValidationError({
+                'detail': _("Import data failed. Abnormal data in row {}").format(self.errors[0]['row']),
+                'errors': self.errors
+            })
+
+    def prefetch(self, rows):
+        """
+        一次查询出这批数据中每个关联字段引用的全部对象
+        """
+        prefetched = {}
+        for field_name, field, many in self.get_relation_fields():
+            values = []
+            for row in rows:
+                value = row.get(field_name) if isinstance(row, dict) else None
+                if many and isinstance(value, (list, tuple)):
+                    values.extend(value)
+                elif not many and value not in (None, ''):
+                    values.append(value)
+            objects = field.prefetch(values)
+            if objects is not None:
+                prefetched[field.get_prefetch_key()] = objects
+        self.context['prefetched_objects'] = prefetched
+
+    def get_instances(self, rows):
+        pk_field = self.model._meta.pk
+        pks = set()
+        for row in rows:
+            try:
+                pk = pk_field.to_python(row.get('pk'))
+            except (DjangoValidationError, TypeError, ValueError, AttributeError):
+                continue
+            if pk is not None:
+                pks.add(pk)
+        if not pks:
+            return {}
+        return {str(pk): obj for pk, obj in self.queryset.in_bulk(pks).items()}
+
+    def get_instance(self, instances, row):
+        try:
+            return instances.get(str(self.model._meta.pk.to_python(row.get('pk'))))
+        except (DjangoValidationError, TypeError, ValueError, AttributeError):
+            return None
+
+    def run(self, rows):
+        for index, batch in enumerate(itertools.batched(rows, self.batch_size)):
+            self.import_batch(index * self.batch_size, batch)
+        return self.count
+
+    def import_batch(self, start, rows):
+        self.prefetch(rows)
+        instances = {} if self.created else self.get_instances(rows)
+        validated = []
+        seen = {}
+        for index, row in enumerate(rows, start):
+            instance = None
+            if not self.created:
+                instance = self.get_instance(instances, row)
+                if not instance:
+                    continue
+            if self.bulk:
+                attrs = self.validate(index, instance, row)
+                if attrs is not None and self.check_duplicates(index, instance, attrs, seen):
+                    validated.append((index, instance, attrs))
+            else:
+                serializer = self.view.get_serializer(instance, data=row, partial=not self.created,
+                                                      context=self.context)
+                if serializer.is_valid():
+                    validated.append((index, instance, serializer))
+                else:
+                    self.add_error(index, serializer.errors)
+
+        self.check_errors()
+        if not validated:
+            return
+
+        if self.bulk:
+            self.bulk_save(validated)
+        else:
+            self.save_rows(validated)
+
+    def validate(self, index, instance, row):
+        """
+        复用同一个序列化器校验数据，避免每行重新构建序列化字段
+        """
+        self.serializer.instance = instance
+        self.serializer.initial_data = row
+        try:
+            return self.serializer.run_validation(row)
+        except ValidationError as e:
+            self.add_error(index, e.detail)
+
+    def save_rows(self, validated):
+        with transaction.atomic(using=self.using):
+            for index, instance, serializer in validated:
+                try:
+                    with transaction.atomic(using=self.using):
+                        if self.created:
+                            self.view.perform_create(serializer)
+                        else:
+                            self.view.perform_update(serializer)
+                except DatabaseError as e:
+                    if not self.ignore_error:
+                        raise
+                    self.add_error(index, {'non_field_errors': [str(e)]})
+                    continue
+                self.count += 1
+
+    def build_objects(self, validated):
+        many_to_many_fields = self.get_many_to_many_fields()
+        objs, fields = [], set()
+        for index, instance, attrs in validated:
+            many_to_many = {name: attrs.pop(name) for name in many_to_many_fields if name in attrs}
+            obj = self.model(**attrs) if self.created else instance
+            if not self.created:
+                for attr, value in attrs.items():
+                    setattr(obj, attr, value)
+                fields.update(attrs)
+            objs.append((index, obj, many_to_many))
+        return objs, fields
+
+    def get_update_fields(self, fields):
+        names = set(fields)
+        for field in self.model._meta.concrete_fields:
+            if getattr(field, 'auto_now', False) or field.name in ('creator', 'dept_belong', 'modifier'):
+                names.add(field.name)
+        return [name for name in names if not self.model._meta.get_field(name).primary_key]
+
+    def bulk_save(self, validated):
+        objs, fields = self.build_objects(validated)
+        update_fields = None if self.created else self.get_update_fields(fields)
+        try:
+            with transaction.atomic(using=self.using):
+                self.write_objects([obj for index, obj, many_to_many in objs], update_fields)
+                self.set_many_to_many(objs)
+        except DatabaseError as e:
+            # 批量写入失败，例如和数据库中的数据交换了唯一值，则逐条写入找出错误数据
+            logger.warning(f"bulk import {self.model._meta.label} failed, retry one by one. Exception:{e}")
+            with transaction.atomic(using=self.using):
+                self.save_objects(objs, update_fields)
+                self.check_errors()
+            return
+        self.count += len(objs)
+
+    def write_objects(self, objs, update_fields):
+        for obj in objs:
+            pre_save.send(sender=self.model, instance=obj, raw=False, using=self.using, update_fields=update_fields)
+        if self.created:
+            self.model._default_manager.using(self.using).bulk_create(objs, batch_size=self.batch_size)
+        else:
+            for obj in objs:
+                for field in self.model._meta.concrete_fields:
+                    if getattr(field, 'auto_now', False):
+                        field.pre_save(obj, False)
+            if update_fields:
+                self.model._default_manager.using(self.using).bulk_update(objs, update_fields,
+                                                                          batch_size=self.batch_size)
+        for obj in objs:
+            post_save.send(sender=self.model, instance=obj, created=self.created, update_fields=update_fields,
+                           raw=False, using=self.using)
+
+    def set_many_to_many(self, objs):
+        values = {}
+        for index, obj, many_to_many in objs:
+            for field_name, value in many_to_many.items():
+                values.setdefault(field_name, []).append((obj, value))
+
+        for field_name, items in values.items():
+            if not self.created:
+                for obj, value in items:
+                    getattr(obj, field_name).set(value)
+                continue
+            # 新增的数据没有多对多关系，直接批量写入中间表
+            field = self.model._meta.get_field(field_name)
+            through = field.remote_field.through
+            source = through._meta.get_field(field.m2m_field_name()).attname
+            target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+            signal_kwargs = {'sender': through, 'reverse': False, 'model': field.related_model, 'using': self.using}
+            rows = []
+            for obj, value in items:
+                pk_set = {item.pk if isinstance(item, Model) else item for item in value}
+                m2m_changed.send(instance=obj, action='pre_add', pk_set=pk_set, **signal_kwargs)
+                rows.extend(through(**{source: obj.pk, target: pk}) for pk in pk_set)
+            through._default_manager.using(self.using).bulk_create(rows, batch_size=self.batch_size)
+            for obj, value in items:
+                pk_set = {item.pk if isinstance(item, Model) else item for item in value}
+                m2m_changed.send(instance=obj, action='post_add', pk_set=pk_set, **signal_kwargs)
+
+    def save_objects(self, objs, update_fields):
+        for index, obj, many_to_many in objs:
+            try:
+                with transaction.atomic(using=self.using):
+                    if self.created:
+                        obj.pk = None if not self.model._meta.pk.has_default() else obj.pk
+                        obj._state.adding = True
+                        obj.save(force_insert=True, using=self.using)
+                    else:
+                        obj.save(update_fields=update_fields, using=self.using)
+                    for field_name, value in many_to_many.items():
+                        getattr(obj, field_name).set(value)
+            except DatabaseError as e:
+                self.add_error(index, {'non_field_errors': [str(e)]})
+                continue
+            self.count += 1
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# project : xadmin-server
+# filename : metrics
+# author : ly_13
+# date : 10/18/2026
+# 监控指标，请求中只累加进程内计数，各进程定期把增量同步到 redis，导出时汇总所有进程的数据
+
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+from common.cache.storage import MetricsCache
+from common.utils import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# 指标名称: (类型, 说明)
+METRICS = {
+    'http_requests_total': ('counter', 'Total number of HTTP requests'),
+    'http_request_duration_seconds': ('histogram', 'HTTP request latency in seconds'),
+    'db_queries_total': ('counter', 'Total number of SQL queries'),
+    'db_query_duration_seconds_total': ('counter', 'Total SQL query execution time in seconds'),
+    'magic_cache_response_total': ('counter', 'MagicCacheResponse lookups by result'),
+    'magic_cache_data_total': ('counter', 'MagicCacheData lookups by result'),
+    'operation_log_total': ('counter', 'Operation log records by result'),
+}
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(f'{k}="{escape_label_value(v)}"' for k, v in labels)
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def get_stats_collectors():
+    """
+    各模块的进程内累计统计，同步时计算增量，避免在缓存等热点代码中直接依赖监控模块
+    """
+    from common.base.magic import MagicCacheResponse, MagicCacheData
+    from common.core.middleware import operation_log_writer
+
+    def collect():
+        values = {}
+        for (func_name, status), count in MagicCacheResponse.get_stats().items():
+            values[('magic_cache_response_total', (('func', func_name), ('result', status)))] = count
+        for (func_name, status), count in MagicCacheData.get_stats().items():
+            values[('magic_cache_data_total', (('func', func_name), ('result', status)))] = count
+        for status, count in operation_log_writer.get_stats().items():
+            values[('operation_log_total', (('result', status),))] = count
+        return values
+
+    return [collect]
+
+
+class MetricsRegistry(object):
+    """
+    进程内指标，histogram 按照分桶分别计数，导出时再转换为累计值
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, flush_interval=10):
+        self.buckets = buckets
+        self.flush_interval = flush_interval
+        self._values = defaultdict(float)  # (name, labels): 未同步的增量
+        self._collected = {}  # (name, labels): 上次同步时的累计值
+        self._collectors = None
+        self._flush_time = time.time()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._values[(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        le = str(self.buckets[index]) if index < len(self.buckets) else '+Inf'
+        with self._lock:
+            self._values[(f'{name}_bucket', labels + (('le', le),))] += 1
+            self._values[(f'{name}_sum', labels)] += value
+            self._values[(f'{name}_count', labels)] += 1
+
+    def observe_request(self, request, response, exec_time, sql_counter):
+        resolver_match = getattr(request, 'resolver_match', None)
+        route = resolver_match.route if resolver_match else 'unmatched'
+        labels = (('method', request.method), ('route', route))
+        self.observe('http_request_duration_seconds', labels, exec_time)
+        with self._lock:
+            self._values[('http_requests_total', labels + (('status', f'{response.status_code // 100}xx'),))] += 1
+            self._values[('db_queries_total', labels)] += sql_counter.count
+            self._values[('db_query_duration_seconds_total', labels)] += sql_counter.time
+        if time.time() - self._flush_time > self.flush_interval:
+            self.flush()
+
+    def collect_deltas(self, values):
+        if self._collectors is None:
+            self._collectors = get_stats_collectors()
+        for collector in self._collectors:
+            for series, count in collector().items():
+                delta = count - self._collected.get(series, 0)
+                if delta:
+                    values[series] += delta
+                    self._collected[series] = count
+
+    @staticmethod
+    def encode(name, labels):
+        return json.dumps([name, labels], separators=(',', ':'))
+
+    @staticmethod
+    def decode(field):
+        name, labels = json.loads(field)
+        return name, tuple(tuple(label) for label in labels)
+
+    def flush(self):
+        """
+        把当前进程的增量累加到 redis，同步失败的增量直接丢弃
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork 之前未同步的增量由父进程负责同步
+                self._pid = os.getpid()
+                self._values.clear()
+            self._flush_time = time.time()
+            values, self._values = self._values, defaultdict(float)
+            try:
+                self.collect_deltas(values)
+            except Exception as e:
+                logger.warning(f"collect metrics stats failed. Exception:{e}")
+        values = {self.encode(name, labels): value for (name, labels), value in values.items() if value}
+        if not values:
+            return
+        try:
+            MetricsCache().incr_many(values)
+        except Exception as e:
+            logger.warning(f"flush {len(values)} metrics failed. Exception:{e}")
+
+    def get_all(self):
+        self.flush()
+        return {self.decode(field): value for field, value in MetricsCache().get_all().items()}
+
+    def render(self):
+        """
+        导出 prometheus 文本格式
+        """
+        families = defaultdict(dict)
+        for (name, labels), value in self.get_all().items():
+            for suffix in ['_bucket', '_sum', '_count']:
+                family = name[:-len(suffix)]
+                if name.endswith(suffix) and METRICS.get(family, [''])[0] == 'histogram':
+                    break
+            else:
+                family = name
+            families[family][(name, labels)] = value
+
+        lines = []
+        for family in sorted(families):
+            metric_type, metric_help = METRICS.get(family, ('untyped', family))
+            lines.append(f'# HELP {family} {metric_help}')
+            lines.append(f'# TYPE {family} {metric_type}')
+            series = families[family]
+            if metric_type == 'histogram':
+                lines.extend(self.render_histogram(family, series))
+                continue
+            for (name, labels), value in sorted(series.items()):
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def render_histogram(self, family, series):
+        buckets = defaultdict(dict)
+        for (name, labels), value in series.items():
+            if name.endswith('_bucket'):
+                le = dict(labels)['le']
+                buckets[tuple(label for label in labels if label[0] != 'le')][le] = value
+        lines = []
+        for labels in sorted({labels for (name, labels) in series if not name.endswith('_bucket')}):
+            cumulative = 0
+            for bound in self.buckets:
+                cumulative += buckets[labels].get(str(bound), 0)
+                lines.append(f'{family}_bucket{format_labels(labels + (("le", str(bound)),))} {format_value(cumulative)}')
+            count = series.get((f'{family}_count', labels), 0)
+            lines.append(f'{family}_bucket{format_labels(labels + (("le", "+Inf"),))} {format_value(count)}')
+            lines.append(f'{family}_sum{format_labels(labels)} {format_value(series.get((f"{family}_sum", labels), 0))}')
+            lines.append(f'{family}_count{format_labels(labels)} {format_value(count)}')
+        return lines
+
+
+metrics_registry = MetricsRegistry(flush_interval=getattr(settings, 'METRICS_FLUSH_INTERVAL', 10))
+atexit.register(metrics_registry.flush)
@@ -5,11 +5,18 @@
 # author : ly_13
 # date : 6/27/2023
 
+import atexit
 import json
+import os
+import queue
+import threading
 import time
+from collections import Counter
 
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.db import close_old_connections
+from django.utils import timezone
 from django.utils.deprecation import MiddlewareMixin
 from rest_framework.utils import encoders
 
@@ -21,6 +28,104 @@ from system.models import OperationLog
 logger = get_logger(__name__)
 
 
+class OperationLogWriter(object):
+    """
+    操作日志异步批量写入，请求中只把日志放入有界队列，由后台线程批量写入数据库，队列满时丢弃日志并计数
+    """
+
+    def __init__(self, max_size=10000, batch_size=100, flush_interval=2):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def start(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # fork 之后的子进程需要重新创建队列和写入线程
+                self._queue = queue.Queue(maxsize=self.max_size)
+                self._pid = os.getpid()
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self.run, name='operation-log-writer', daemon=True)
+            self._thread.start()
+
+    def put(self, info):
+        self.start()
+        try:
+            self._queue.put_nowait(info)
+            self._stats['queued'] += 1
+        except queue.Full:
+            self._stats['dropped'] += 1
+            logger.warning(f"operation log queue is full, dropped:{self._stats['dropped']}")
+
+    def get_batch(self, timeout=None):
+        """
+        timeout 为空时只获取队列中已有的日志，否则最多等待 timeout 秒凑满一批
+        """
+        batch = []
+        deadline = time.time() + (timeout or 0)
+        while len(batch) < self.batch_size:
+            try:
+                if timeout is None:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=max(deadline - time.time(), 0.001)))
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        try:
+            close_old_connections()
+            OperationLog.objects.bulk_create([OperationLog(**info) for info in batch], batch_size=self.batch_size)
+            self._stats['written'] += len(batch)
+        except Exception as e:  # sqlite3 数据库因为锁表可能会导致日志记录失败
+            self._stats['failed'] += len(batch)
+            logger.warning(f"write {len(batch)} operation logs failed. Exception:{e}")
+
+    def run(self):
+        while not self._stop_event.is_set():
+            batch = self.get_batch(self.flush_interval)
+            if batch:
+                self.write(batch)
+
+    def flush(self):
+        """
+        进程退出时停止后台线程，并写入队列中剩余的日志
+        """
+        if self._queue is None or self._pid != os.getpid():
+            return
+        self._stop_event.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(self.flush_interval + 1)
+        while True:
+            batch = self.get_batch()
+            if not batch:
+                break
+            self.write(batch)
+
+    def get_stats(self):
+        """
+        :return: {'queued': count, 'written': count, 'dropped': count, 'failed': count}
+        """
+        return {key: self._stats[key] for key in ['queued', 'written', 'dropped', 'failed']}
+
+
+operation_log_writer = OperationLogWriter(getattr(settings, 'API_LOG_QUEUE_SIZE', 10000),
+                                          getattr(settings, 'API_LOG_BATCH_SIZE', 100),
+                                          getattr(settings, 'API_LOG_FLUSH_INTERVAL', 2))
+atexit.register(operation_log_writer.flush)
+
+
 class ApiLoggingMiddleware(MiddlewareMixin):
 
     def __init__(self, get_response=None):
@@ -28,7 +133,7 @@ class ApiLoggingMiddleware(MiddlewareMixin):
         self.enable = getattr(settings, 'API_LOG_ENABLE', None) or False
         self.methods = getattr(settings, 'API_LOG_METHODS', None) or set()
         self.ignores = getattr(settings, 'API_LOG_IGNORE', None) or {}
-        self.operation_log_id = '__operation_log_id'
+        self.operation_log = '__operation_log'
 
     @classmethod
     def __handle_request(cls, request):
@@ -43,9 +148,8 @@ class ApiLoggingMiddleware(MiddlewareMixin):
         if exec_time > 1:
             logger.warning(
                 f"exec time {exec_time} over 1s. {request.method} {request.path} {getattr(request, 'request_data', {})}")
-        # 判断有无log_id属性，使用All记录时，会出现此情况
-        operation_log_id = getattr(request, self.operation_log_id, None)
-        if operation_log_id is None:
+        # 判断有无log属性，使用All记录时，会出现此情况
+        if not getattr(request, self.operation_log, False):
             return
 
         body = getattr(request, 'request_data', {})
@@ -55,7 +159,7 @@ class ApiLoggingMiddleware(MiddlewareMixin):
         if not hasattr(response, 'data') or not isinstance(response.data, dict):
             response.data = {}
         try:
-            if not response.data and response.content:
+            if not response.data and not response.streaming and response.content:
                 content = json.loads(response.content.decode().replace('\\', ''))
                 response.data = content if isinstance(content, dict) else {}
         except Exception:
@@ -87,14 +191,11 @@ class ApiLoggingMiddleware(MiddlewareMixin):
             'status_code': response.data.get('code'),
             'request_uuid': getattr(request, 'request_uuid', None),
             'exec_time': time.time() - request_start_time,
+            'created_time': timezone.now(),
             'response_result': json.dumps({"code": response.data.get('code'), "data": response.data.get('data'),
                                            "detail": response.data.get('detail')}, cls=encoders.JSONEncoder),
         }
-        try:
-            OperationLog.objects.update_or_create(defaults=info, id=operation_log_id)
-        except Exception:  # sqlite3 数据库因为锁表可能会导致日志记录失败
-            pass
-        del info['request_uuid']
+        operation_log_writer.put(info)
         logger.debug(f"request end. {request.method} {request.path} {getattr(request, 'request_data', {})} log:{info}")
         return True
 
@@ -110,9 +211,7 @@ class ApiLoggingMiddleware(MiddlewareMixin):
                         v = settings.API_MODEL_MAP.get(request.path, v)
                         if not v and model:
                             v = model._meta.label
-                    log = OperationLog(module=v)
-                    log.save()
-                    setattr(request, self.operation_log_id, log.id)
+                    setattr(request, self.operation_log, True)
                     setattr(request, 'request_module', v)
 
         return
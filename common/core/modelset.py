@@ -10,10 +10,16 @@ import uuid
 from hashlib import md5
 from typing import Callable
 
-import math
+from asgiref.sync import sync_to_async
+from celery import chain, group
 from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.handlers.asgi import ASGIRequest
 from django.db import transaction
+from django.db.models import Prefetch, Q
+from django.db.models.constants import LOOKUP_SEP
 from django.forms.widgets import SelectMultiple, DateTimeInput
+from django.http import StreamingHttpResponse
 from django.utils.translation import gettext_lazy as _
 from django_filters.utils import get_model_field
 from django_filters.widgets import DateRangeWidget
@@ -24,24 +30,33 @@ from rest_framework import mixins
 from rest_framework.decorators import action
 from rest_framework.fields import CharField
 from rest_framework.parsers import MultiPartParser
-from rest_framework.utils import encoders
+from rest_framework.serializers import BaseSerializer
 from rest_framework.viewsets import GenericViewSet
 
-from common.base.magic import cache_response
+from common.base.magic import MagicCacheData
 from common.base.utils import get_choices_dict
 from common.core.config import SysConfig
+from common.core.importer import BulkImporter
+from common.core.pagination import PageNumber
+from common.core.planner import get_query_plan, apply_query_plan, assert_constant_queries, get_attrs_lookups
+from common.core.registry import metadata_registry
 from common.core.response import ApiResponse
-from common.core.serializers import BasePrimaryKeyRelatedField
-from common.core.utils import has_self_fields, topological_sort
+from common.core.serializers import BasePrimaryKeyRelatedField, BaseModelSerializer
+from common.core.utils import has_self_fields, topological_levels
 from common.drf.renders.csv import CSVFileRenderer
 from common.drf.renders.excel import ExcelFileRenderer
 from common.swagger.utils import get_default_response_schema
-from common.tasks import background_task_view_set_job
+from common.tasks import background_task_view_set_job, background_task_export_view_set_job, \
+    publish_view_task_result, push_view_task_error
 from common.utils import get_logger
 
 logger = get_logger(__name__)
 
-def run_view_by_celery_task(view, request, kwargs, data, batch_length=100):
+def run_view_by_celery_task(view, request, kwargs, data, batch_length=100, levels=False):
+    """
+    :param levels: data 为按依赖层级分组的数据，同一层级的批次并行执行，上一层级的任务全部完成后才执行下一层级
+                   每条数据为 (原始序号, 数据)，原始序号随任务传递，导入出错时报告上传文件中的行号
+    """
     task = kwargs.get("task", request.query_params.get('task', 'true').lower() in ['true', '1', 'yes'])  # 默认为任务异步导入
     if task:
         view_str = f"{view.__class__.__module__}.{view.__class__.__name__}"
@@ -49,18 +64,81 @@ def run_view_by_celery_task(view, request, kwargs, data, batch_length=100):
         task_id = uuid.uuid4()
         if isinstance(data, dict):
             data = [data]
-        meta["task_count"] = math.ceil(len(data) / batch_length)
         meta["action"] = view.action
-        for index, batch in enumerate(itertools.batched(data, batch_length)):
-            meta["task_id"] = f"{task_id}_{index}"
-            meta["task_index"] = index
-            res = background_task_view_set_job.apply_async(args=(view_str, meta, json.dumps(batch), view.action_map),
-                                                           task_id=meta["task_id"])
-            logger.info(f"add {view_str} task success. {res}")
+        # data 可以是生成器，边读取边分批添加任务，任务数量在分批结束之后写入
+        task_count = task_offset = dispatched = 0
+        level_groups = []
+        try:
+            for level in (data if levels else [data]):
+                signatures = []
+                for batch in itertools.batched(level, batch_length):
+                    meta["task_id"] = f"{task_id}_{task_count}"
+                    meta["task_index"] = task_count
+                    meta["task_offset"] = task_offset
+                    if levels:
+                        meta["task_rows"] = [index for index, item in batch]
+                        batch = [item for index, item in batch]
+                    signature = background_task_view_set_job.si(view_str, dict(meta), json.dumps(batch),
+                                                                view.action_map).set(task_id=meta["task_id"])
+                    if levels:
+                        signatures.append(signature)
+                    else:
+                        res = signature.apply_async()
+                        dispatched += 1
+                        logger.info(f"add {view_str} task success. {res}")
+                    task_count += 1
+                    task_offset += len(batch)
+                if signatures:
+                    level_groups.append(group(signatures))
+            if level_groups:
+                # group 之后的任务会等待 group 中的任务全部完成后再执行，作为层级之间的屏障
+                res = chain(*level_groups).apply_async()
+                dispatched = task_count
+                logger.info(f"add {view_str} {len(level_groups)} levels {task_count} tasks success. {res}")
+        except Exception as e:
+            # 文件解析出错时，已添加的任务仍会执行，错误通过任务通知报告，保证任务数量写入后能够发送通知
+            if dispatched:
+                push_view_task_error(meta, dispatched, str(getattr(e, 'detail', e)))
+                dispatched += 1
+            raise
+        finally:
+            if dispatched:
+                publish_view_task_result(view_str, meta, request.user, dispatched)
         return ApiResponse(detail=_("Task add success"))
 
 
-class CacheDetailResponseMixin(object):
+def run_export_by_celery_task(view, request):
+    view_str = f"{view.__class__.__module__}.{view.__class__.__name__}"
+    meta = request.META
+    meta["task_id"] = str(uuid.uuid4())
+    meta["action"] = view.action
+    res = background_task_export_view_set_job.apply_async(args=(view_str, meta, view.action_map),
+                                                          task_id=meta["task_id"])
+    logger.info(f"add {view_str} export task success. {res}")
+    return ApiResponse(detail=_("Task add success"), task_id=meta["task_id"])
+
+
+class CacheResponseGenerationMixin(object):
+    """
+    响应缓存按照 视图_方法、视图_方法_用户、用户 三个命名空间失效
+    """
+
+    def get_cache_generations(self, view_instance, view_method, request, args, kwargs):
+        func_name = f'{view_instance.__class__.__name__}_{view_method.__name__}'
+        return [func_name, f"{func_name}_{request.user.pk}", f"user_{request.user.pk}"]
+
+    @classmethod
+    def invalid_cache_generations(cls, pk, methods):
+        """
+        :param pk: 用户pk，为 * 的时候，失效该视图所有用户的缓存
+        """
+        namespaces = []
+        for method in methods:
+            namespaces.append(f'{cls.__name__}_{method}' if pk == '*' else f'{cls.__name__}_{method}_{pk}')
+        MagicCacheData.invalid_generations(namespaces)
+
+
+class CacheDetailResponseMixin(CacheResponseGenerationMixin):
     def get_cache_key(self, view_instance, view_method, request, args, kwargs):
         func_name = f'{view_instance.__class__.__name__}_{view_method.__name__}'
         return f"{func_name}_{request.user.pk}"
@@ -69,11 +147,10 @@ class CacheDetailResponseMixin(object):
     def invalid_cache(cls, pk, methods=None):
         if methods is None:
             methods = ['retrieve', 'get']
-        for method in methods:
-            cache_response.invalid_cache(f'{cls.__name__}_{method}_{pk}')
+        cls.invalid_cache_generations(pk, methods)
 
 
-class CacheListResponseMixin(object):
+class CacheListResponseMixin(CacheResponseGenerationMixin):
     def get_cache_key(self, view_instance, view_method, request, args, kwargs):
         func_name = f'{view_instance.__class__.__name__}_{view_method.__name__}'
         return f"{func_name}_{request.user.pk}_{md5(json.dumps(request.query_params, sort_keys=True).encode('utf-8')).hexdigest()}"
@@ -82,8 +159,7 @@ class CacheListResponseMixin(object):
     def invalid_cache(cls, pk, methods=None):
         if methods is None:
             methods = ['list']
-        for method in methods:
-            cache_response.invalid_cache(f'{cls.__name__}_{method}_{pk}')
+        cls.invalid_cache_generations(pk, methods)
 
 
 class UploadFileAction(object):
@@ -211,62 +287,108 @@ class SearchFieldsAction(object):
         """获取{cls}的查询字段"""
         results = []
         try:
-            filterset_class = self.filterset_class.get_filters()
-            filter_fields = self.filterset_class.get_fields().keys()
-            for field_name, value in filterset_class.items():
-                if field_name not in filter_fields: continue
-                widget = value.field.widget
-                if isinstance(widget, SelectMultiple):
-                    widget.input_type = 'select-multiple'
-                if isinstance(widget, DateRangeWidget):
-                    widget.input_type = 'datetimerange'
-                if isinstance(widget, DateTimeInput):
-                    widget.input_type = 'datetime'
-                # if hasattr(value.field, 'queryset'):  # 将一些具有关联的字段的数据置空
-                #     widget.input_type = 'text'
-                #     widget.choices = []
-                if hasattr(value, 'input_type'): widget.input_type = value.input_type
-                choices = list(getattr(widget, 'choices', []))
-                if choices and len(choices) > 0 and choices[0][0] == "":
-                    choices.pop(0)
-                field = get_model_field(self.filterset_class._meta.model, value.field_name)
-                results.append({
-                    'key': field_name,
-                    'label': value.label if value.label else (
-                        getattr(field, 'verbose_name', field.name) if field else field_name),
-                    'help_text': value.field.help_text if value.field.help_text else getattr(field, 'help_text', None),
-                    'input_type': widget.input_type,
-                    'choices': get_choices_dict(choices),
-                    'default': [] if 'multiple' in widget.input_type else ""
-                })
-            order_choices = []
-            ordering_fields = list(getattr(self, 'ordering_fields', []))
-            for choice in ordering_fields:
-                is_des = False
-                if choice.startswith('-'):
-                    choice = choice[1:]
-                    is_des = True
-                label = choice
-                field = get_model_field(self.filterset_class._meta.model, choice)
-                if field:
-                    label = getattr(field, 'verbose_name', choice)
-                des = (f"-{choice}", f"{label} descending")
-                ase = (choice, f"{label} ascending")
-                if is_des:
-                    des, ase = ase, des
-                order_choices.extend([des, ase])
-            if order_choices:
-                results.append({
-                    'label': 'ordering',
-                    'key': "ordering",
-                    'input_type': 'select-ordering',
-                    'choices': get_choices_dict(order_choices),
-                    'default': order_choices[0][0]
-                })
+            metadata_key, builder = self.get_search_fields_builder()
+            fields, related_keys = metadata_registry.get(metadata_key, builder)
+            base_filters = self.filterset_class.base_filters
+            for info in fields:
+                if info['key'] in related_keys:
+                    # 关联数据的选项需要实时查询
+                    info = dict(info, choices=get_choices_dict(get_widget_choices(base_filters[info['key']])))
+                results.append(info)
         except Exception as e:
             logger.error(f"get search-field failed {e}")
         return ApiResponse(data=results)
 
+    def get_search_fields_builder(self):
+        return (self.__class__, 'search_fields'), self.build_search_fields
+
+    def build_search_fields(self):
+        """
+        查询字段只和 filterset_class, ordering_fields 相关，关联字段的选项在请求时查询
+        :return: (查询字段, 关联字段的key)
+        """
+        results, related_keys = [], set()
+        filterset_class = self.filterset_class.get_filters()
+        filter_fields = self.filterset_class.get_fields().keys()
+        for field_name, value in filterset_class.items():
+            if field_name not in filter_fields: continue
+            widget = value.field.widget
+            if isinstance(widget, SelectMultiple):
+                widget.input_type = 'select-multiple'
+            if isinstance(widget, DateRangeWidget):
+                widget.input_type = 'datetimerange'
+            if isinstance(widget, DateTimeInput):
+                widget.input_type = 'datetime'
+            # if hasattr(value.field, 'queryset'):  # 将一些具有关联的字段的数据置空
+            #     widget.input_type = 'text'
+            #     widget.choices = []
+            if hasattr(value, 'input_type'): widget.input_type = value.input_type
+            if hasattr(value.field, 'queryset'):
+                related_keys.add(field_name)
+                choices = []
+            else:
+                choices = get_widget_choices(value)
+            field = get_model_field(self.filterset_class._meta.model, value.field_name)
+            results.append({
+                'key': field_name,
+                'label': value.label if value.label else (
+                    getattr(field, 'verbose_name', field.name) if field else field_name),
+                'help_text': value.field.help_text if value.field.help_text else getattr(field, 'help_text', None),
+                'input_type': widget.input_type,
+                'choices': get_choices_dict(choices),
+                'default': [] if 'multiple' in widget.input_type else ""
+            })
+        order_choices = []
+        ordering_fields = list(getattr(self, 'ordering_fields', []))
+        for choice in ordering_fields:
+            is_des = False
+            if choice.startswith('-'):
+                choice = choice[1:]
+                is_des = True
+            label = choice
+            field = get_model_field(self.filterset_class._meta.model, choice)
+            if field:
+                label = getattr(field, 'verbose_name', choice)
+            des = (f"-{choice}", f"{label} descending")
+            ase = (choice, f"{label} ascending")
+            if is_des:
+                des, ase = ase, des
+            order_choices.extend([des, ase])
+        if order_choices:
+            results.append({
+                'label': 'ordering',
+                'key': "ordering",
+                'input_type': 'select-ordering',
+                'choices': get_choices_dict(order_choices),
+                'default': order_choices[0][0]
+            })
+        return results, related_keys
+
+
+def get_widget_choices(value):
+    choices = list(getattr(value.field.widget, 'choices', []))
+    if choices and len(choices) > 0 and choices[0][0] == "":
+        choices.pop(0)
+    return choices
+
+
+def get_related_field(field):
+    """
+    序列化字段对应的 BasePrimaryKeyRelatedField，多对多字段返回 child_relation
+    """
+    field = getattr(field, 'child_relation', field)
+    if isinstance(field, BasePrimaryKeyRelatedField):
+        return field
+
+
+RELATED_CHOICE_SCHEMA = build_object_type(
+    properties={
+        'pk': build_basic_type(OpenApiTypes.STR),
+        'value': build_basic_type(OpenApiTypes.STR),
+        'label': build_basic_type(OpenApiTypes.STR),
+    }
+)
+
 
 class SearchColumnsAction(object):
     filterset_class: Callable
@@ -288,14 +410,14 @@ class SearchColumnsAction(object):
                             'multiple': build_basic_type(OpenApiTypes.BOOL),
                             'max_length': build_basic_type(OpenApiTypes.NUMBER),
                             'table_show': build_basic_type(OpenApiTypes.NUMBER),
-                            'choices': build_array_type(
-                                build_object_type(
-                                    properties={
-                                        'pk': build_basic_type(OpenApiTypes.STR),
-                                        'value': build_basic_type(OpenApiTypes.STR),
-                                        'label': build_basic_type(OpenApiTypes.STR),
-                                    }
-                                )
+                            'choices': build_array_type(RELATED_CHOICE_SCHEMA),
+                            'related': build_object_type(
+                                properties={
+                                    'model': build_basic_type(OpenApiTypes.STR),
+                                    'url': build_basic_type(OpenApiTypes.STR),
+                                    'field': build_basic_type(OpenApiTypes.STR),
+                                    'search_fields': build_array_type(build_basic_type(OpenApiTypes.STR)),
+                                }
                             )
                         }
                     )
@@ -307,54 +429,184 @@ class SearchColumnsAction(object):
     def search_columns(self, request, *args, **kwargs):
         """获取{cls}的展示字段"""
         results = []
+        metadata_key, builder = self.get_search_columns_builder()
+        columns = metadata_registry.get(metadata_key, builder)
+        metadata_class = self.metadata_class()
+        serializer = self.get_serializer()
+        # 序列化器只包含字段权限允许的字段，这里只合并字段默认值和关联字段描述等和请求相关的部分
+        for key, value in getattr(serializer, 'fields', {}).items():
+            info = columns.get(key)
+            if info is None:
+                info = self.get_column_info(metadata_class, serializer, key, value)
+            info = dict(info)
+            default = metadata_class.get_field_default(value)
+            if default is not None:
+                info['default'] = default
+            if info['input_type'] and info['input_type'].endswith('related_field'):
+                related = self.get_related_descriptor(request, key, get_related_field(value))
+                if related:
+                    info['related'] = related
+            results.append(info)
+        return ApiResponse(data=results)
+
+    def get_search_columns_builder(self):
+        serializer_class = self.get_serializer_class()
+        return (self.__class__, 'search_columns', serializer_class), lambda: self.build_search_columns(serializer_class)
+
+    def build_search_columns(self, serializer_class):
+        """
+        序列化类全部字段的展示信息，嵌套的序列化器字段和请求的字段权限相关，在请求时计算
+        """
+        kwargs = {'ignore_field_permission': True} if issubclass(serializer_class, BaseModelSerializer) else {}
+        serializer = self.get_serializer(**kwargs)
+        metadata_class = self.metadata_class()
+        columns = {}
+        for key, value in getattr(serializer, 'fields', {}).items():
+            if isinstance(value, BaseSerializer):
+                columns[key] = None
+            else:
+                columns[key] = self.get_column_info(metadata_class, serializer, key, value)
+                columns[key].pop('default', None)  # 模型中函数类型的默认值每次都不同，在请求时获取
+        return columns
 
+    @staticmethod
+    def get_column_info(metadata_class, serializer, key, value):
         def get_input_type(value, info):
             if hasattr(value, 'child_relation') and isinstance(value.child_relation, BasePrimaryKeyRelatedField):
                 info['multiple'] = True
-                setattr(value.child_relation, 'is_column', True)
                 tp = value.child_relation.input_type if value.child_relation.input_type else info['type']
             else:
                 tp = info['type']
             if tp and tp.endswith('related_field'):
-                setattr(value, 'is_column', True)
-                info['choices'] = json.loads(json.dumps(value.choices, cls=encoders.JSONEncoder))
-                # info['choices'] = [{'value': k, 'label': v} for k, v in value.choices.items()]
+                # 关联数据可能很多，不再返回全部可选数据，前端通过 related-choices 分页搜索
+                info['choices'] = []
             return tp
 
-        metadata_class = self.metadata_class()
-        serializer = self.get_serializer()
-        fields = getattr(serializer, 'fields', [])
         meta = getattr(serializer, 'Meta', {})
         table_fields = getattr(meta, 'table_fields', [])
-        for key, value in fields.items():
-            info = metadata_class.get_field_info(value)
-            if hasattr(meta, 'model'):
-                field = get_model_field(meta.model, value.source)
-            else:
-                field = None
-            info['key'] = key
-            if info.get("help_text", None) is None and hasattr(field, 'help_text'):
-                info['help_text'] = field.help_text
+        info = metadata_class.get_field_info(value)
+        if hasattr(meta, 'model'):
+            field = get_model_field(meta.model, value.source)
+        else:
+            field = None
+        info['key'] = key
+        if info.get("help_text", None) is None and hasattr(field, 'help_text'):
+            info['help_text'] = field.help_text
+
+        if value.field_name.replace('_', ' ').capitalize() == info['label'] and hasattr(field, 'verbose_name'):
+            info['label'] = field.verbose_name
+
+        if isinstance(value, CharField) and value.style.get('base_template', '') == 'textarea.html':
+            info['input_type'] = 'textarea'
+        else:
+            info['input_type'] = get_input_type(value, info)
+        del info['type']
+        if not table_fields:
+            info['table_show'] = 1
+        if key in table_fields:
+            info['table_show'] = (table_fields.index(key)) + 1
+        return info
+
+    @staticmethod
+    def get_related_descriptor(request, field_name, field):
+        """
+        关联字段的可选数据描述，前端根据 url 和 field 参数请求 related-choices 获取可选数据
+        """
+        if field is None or field.queryset is None:
+            return None
+        model = field.queryset.model
+        return {
+            'model': model._meta.label_lower,
+            'url': f"{request.path.rstrip('/').rsplit('/', 1)[0]}/related-choices",
+            'field': field_name,
+            'search_fields': field.get_search_fields(model),
+        }
 
-            if value.field_name.replace('_', ' ').capitalize() == info['label'] and hasattr(field, 'verbose_name'):
-                info['label'] = field.verbose_name
+    @staticmethod
+    def get_related_choices(field, search='', pks='', page='', size=''):
+        model = field.queryset.model
+        queryset = field.get_queryset()
+
+        allow_fields = field.get_allow_fields(model)
+        if allow_fields:
+            only_fields, select_related = get_attrs_lookups(model, allow_fields)
+            if select_related:
+                queryset = queryset.select_related(*select_related)
+            elif only_fields:
+                queryset = queryset.only(*only_fields)
+
+        pk_field = model._meta.pk
+        if pks:
+            values = []
+            for pk in pks.split(','):
+                try:
+                    values.append(pk_field.to_python(pk))
+                except DjangoValidationError:
+                    continue
+            queryset = queryset.filter(pk__in=values)
+        if search:
+            q = Q()
+            for name in field.get_search_fields(model):
+                q |= Q(**{f"{name}__icontains": search})
+            try:
+                q |= Q(pk=pk_field.to_python(search))
+            except DjangoValidationError:
+                pass
+            queryset = queryset.filter(q) if q else queryset.none()
+        if not queryset.ordered:
+            queryset = queryset.order_by('pk')
+
+        page = max(int(page), 1) if page.isdigit() else 1
+        size = min(max(int(size), 1), PageNumber.max_page_size) if size.isdigit() else PageNumber.page_size
+        results = [field.to_choice(item) for item in queryset[(page - 1) * size:page * size]]
+        return {'total': queryset.count(), 'results': results}
 
-            if isinstance(value, CharField) and value.style.get('base_template', '') == 'textarea.html':
-                info['input_type'] = 'textarea'
-            else:
-                info['input_type'] = get_input_type(value, info)
-            del info['type']
-            if not table_fields:
-                info['table_show'] = 1
-            if key in table_fields:
-                info['table_show'] = (table_fields.index(key)) + 1
-            results.append(info)
-        return ApiResponse(data=results)
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(name='field', required=True, type=str, description='search-columns 返回的关联字段'),
+            OpenApiParameter(name='search', required=False, type=str, description='搜索关键字'),
+            OpenApiParameter(name='pks', required=False, type=str, description='指定主键，多个用逗号分隔，用于回显已选择的数据'),
+            OpenApiParameter(name='page', required=False, type=int),
+            OpenApiParameter(name='size', required=False, type=int),
+        ],
+        responses=get_default_response_schema(
+            {
+                'data': build_object_type(
+                    properties={
+                        'total': build_basic_type(OpenApiTypes.NUMBER),
+                        'results': build_array_type(RELATED_CHOICE_SCHEMA),
+                    }
+                )
+            }
+        )
+    )
+    @action(methods=['get'], detail=False, url_path='related-choices')
+    def related_choices(self, request, *args, **kwargs):
+        """获取{cls}关联字段的可选数据"""
+        field_name = request.query_params.get('field', '')
+        field = get_related_field(self.get_serializer().fields.get(field_name))
+        if field is None or field.queryset is None:
+            return ApiResponse(code=1001, detail=_("Invalid field"))
+
+        params = {key: request.query_params.get(key, '').strip() for key in ['search', 'pks', 'page', 'size']}
+        user_pk = request.user.pk
+        view_str = f"{self.__class__.__module__}.{self.__class__.__name__}"
+        cache_key = md5(json.dumps([view_str, field_name, str(user_pk), params], sort_keys=True).encode('utf-8')).hexdigest()
+
+        # 可选数据和用户的字段权限、数据权限相关，权限变化时缓存失效
+        @MagicCacheData.make_cache(timeout=settings.RELATED_CHOICES_CACHE_TTL, key_func=lambda: cache_key,
+                                   generation_func=lambda: [f"user_{user_pk}", 'data_permission',
+                                                            f'data_permission_{user_pk}'])
+        def related_choices():
+            return self.get_related_choices(field, **params)
+
+        return ApiResponse(data=related_choices() or {'total': 0, 'results': []})
 
 
 class BaseViewSet(object):
     action: Callable
     extra_filter_class = []
+    query_plan_actions = ['list', 'retrieve', 'export_data']  # 根据序列化字段自动优化查询的 action
 
     def perform_destroy(self, instance):
         return instance.delete()
@@ -367,7 +619,68 @@ class BaseViewSet(object):
     def get_queryset(self):
         if getattr(self, 'values_queryset', None):
             return self.values_queryset
-        return super().get_queryset()
+        queryset = super().get_queryset()
+        if getattr(self, 'action', None) in self.query_plan_actions:
+            queryset = self.plan_queryset(queryset)
+        return queryset
+
+    def plan_queryset(self, queryset):
+        """
+        根据序列化字段自动 select_related/prefetch_related，指定了返回字段时，只查询需要的数据库字段
+        序列化字段已按照字段权限过滤，没有权限的字段不会关联查询
+        """
+        serializer_class = self.get_serializer_class()
+        if not issubclass(serializer_class, BaseModelSerializer) or serializer_class.Meta.model is not queryset.model:
+            return queryset
+        serializer = self.get_serializer()
+        queryset = apply_query_plan(queryset, get_query_plan(serializer_class), set(serializer.fields))
+        if self.get_sparse_fields():
+            queryset = self.only_sparse_fields(queryset, serializer)
+        return queryset
+
+    def get_sparse_fields(self):
+        """
+        list 和 retrieve 可以通过 fields 和 omit 参数指定返回和不返回的字段，多个字段用逗号分隔
+        """
+        request = getattr(self, 'request', None)
+        if request is None or getattr(self, 'action', None) not in ['list', 'retrieve']:
+            return {}
+        sparse_fields = {}
+        for param, key in [('fields', 'fields'), ('omit', 'omit_fields')]:
+            value = request.query_params.get(param)
+            if value:
+                sparse_fields[key] = [field.strip() for field in value.split(',') if field.strip()]
+        return sparse_fields
+
+    def get_serializer(self, *args, **kwargs):
+        if issubclass(self.get_serializer_class(), BaseModelSerializer):
+            for key, value in self.get_sparse_fields().items():
+                kwargs.setdefault(key, value)
+            if settings.QUERY_PLAN_DEBUG_ASSERT and self.action == 'list' and kwargs.get('many') and args:
+                kwargs.setdefault('context', self.get_serializer_context())
+                assert_constant_queries(self.get_serializer_class(), args[0], **kwargs)
+        return super().get_serializer(*args, **kwargs)
+
+    @staticmethod
+    def only_sparse_fields(queryset, serializer):
+        """
+        只查询返回字段需要的数据库字段，select_related 和 prefetch_related 需要的外键字段同时保留
+        """
+        if queryset.query.deferred_loading[0] or queryset.query.select_related is True:
+            return queryset
+        only_fields = serializer.get_only_fields()
+        if only_fields is None:
+            return queryset
+        opts = queryset.model._meta
+        lookups = list(queryset.query.select_related or [])
+        for lookup in queryset._prefetch_related_lookups:
+            lookups.append(lookup.prefetch_through if isinstance(lookup, Prefetch) else lookup)
+        for lookup in lookups:
+            name = lookup.split(LOOKUP_SEP)[0]
+            model_field = opts.get_field(name)
+            if model_field.concrete and not model_field.many_to_many:
+                only_fields.add(name)
+        return queryset.only(*only_fields)
 
     def paginate_queryset(self, queryset):
         # 文件导出的时候，忽略 paginate_queryset
@@ -419,7 +732,14 @@ class CreateAction(mixins.CreateModelMixin):
         return ApiResponse(data=data)
 
 
+SPARSE_FIELDS_PARAMETERS = [
+    OpenApiParameter(name='fields', required=False, type=str, description='返回的字段，多个字段用逗号分隔'),
+    OpenApiParameter(name='omit', required=False, type=str, description='不返回的字段，多个字段用逗号分隔'),
+]
+
+
 class DetailAction(mixins.RetrieveModelMixin):
+    @extend_schema(parameters=SPARSE_FIELDS_PARAMETERS)
     def retrieve(self, request, *args, **kwargs):
         """获取{cls}的详情"""
         data = super().retrieve(request, *args, **kwargs).data
@@ -427,6 +747,7 @@ class DetailAction(mixins.RetrieveModelMixin):
 
 
 class ListAction(mixins.ListModelMixin):
+    @extend_schema(parameters=SPARSE_FIELDS_PARAMETERS)
     def list(self, request, *args, **kwargs):
         """获取{cls}的列表"""
         data = super().list(request, *args, **kwargs).data
@@ -454,9 +775,73 @@ class UpdateAction(mixins.UpdateModelMixin):
 
 
 class OnlyExportDataAction(ListAction):
+    filter_queryset: Callable
+    get_queryset: Callable
+    get_serializer: Callable
+
+    @staticmethod
+    def get_export_data_chunks(serializer, queryset, chunk_size):
+        """
+        使用数据库游标分块读取数据，每块数据序列化之后返回，内存占用和导出数据总量无关
+        """
+        chunk = []
+        for instance in queryset.iterator(chunk_size=chunk_size):
+            chunk.append(instance)
+            if len(chunk) >= chunk_size:
+                yield serializer.to_representation(chunk)
+                chunk = []
+        if chunk:
+            yield serializer.to_representation(chunk)
+
+    @staticmethod
+    def iter_export_progress(data_chunks, total, progress):
+        count = 0
+        for data in data_chunks:
+            count += len(data)
+            yield data
+            progress(count, total)
+
+    @staticmethod
+    async def aiter_streaming_content(content):
+        """
+        ASGI 下同步迭代器会被 sync_to_async(list) 一次性读取到内存中，因此转换为异步迭代器，每次只在线程中读取一块数据
+        """
+        content = iter(content)
+        try:
+            while True:
+                chunk = await sync_to_async(next)(content, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            # 客户端断开连接时，关闭同步迭代器，释放数据库游标
+            await sync_to_async(content.close)()
+
+    def is_stream_export(self, request):
+        return (self.format_kwarg in ['csv', 'xlsx'] and request.query_params.get('template', 'export') == 'export'
+                and not getattr(self, 'export_as_zip', False))
+
+    def stream_export_data(self, request, renderer, progress=None):
+        """
+        :param progress: 导出进度回调函数，参数为已导出数量和总数量
+        """
+        queryset = self.filter_queryset(self.get_queryset())[:settings.EXPORT_MAX_LIMIT]
+        # 序列化器在请求中创建，字段权限在此时确定，分块序列化时复用
+        serializer = self.get_serializer(many=True)
+        response = StreamingHttpResponse(content_type=renderer.media_type)
+        data_chunks = self.get_export_data_chunks(serializer, queryset, settings.EXPORT_CHUNK_SIZE)
+        if progress is not None:
+            data_chunks = self.iter_export_progress(data_chunks, queryset.count(), progress)
+        streaming_content = renderer.stream_render(data_chunks, request, response, self)
+        if isinstance(request._request, ASGIRequest):
+            streaming_content = self.aiter_streaming_content(streaming_content)
+        response.streaming_content = streaming_content
+        return response
+
     @extend_schema(
         parameters=[
             OpenApiParameter(name='type', required=True, enum=['xlsx', 'csv']),
+            OpenApiParameter(name='task', required=False, type=bool, description='后台任务导出，完成之后通知下载'),
         ],
         responses={
             200: OpenApiResponse(build_basic_type(OpenApiTypes.BINARY))
@@ -465,8 +850,14 @@ class OnlyExportDataAction(ListAction):
     @action(methods=['get'], detail=False, url_path='export-data')
     def export_data(self, request, *args, **kwargs):
         """导出{cls}数据"""
+        task = kwargs.get("task", request.query_params.get('task', 'false').lower() in ['true', '1', 'yes'])
+        if task:
+            return run_export_by_celery_task(self, request)
         self.format_kwarg = request.query_params.get('type', 'xlsx')
         request.no_cache = True  # 防止自定义缓存数据
+        if self.is_stream_export(request):
+            renderer = CSVFileRenderer() if self.format_kwarg == 'csv' else ExcelFileRenderer()
+            return self.stream_export_data(request, renderer, kwargs.get('progress'))
         self.renderer_classes = [ExcelFileRenderer, CSVFileRenderer]
         request.accepted_renderer = None
         data = self.list(request, *args, **kwargs)
@@ -496,45 +887,33 @@ class ImportExportDataAction(CreateAction, UpdateAction, OnlyExportDataAction):
 
         task = kwargs.get("task", request.query_params.get('task', 'true').lower() in ['true', '1', 'yes'])  # 默认为任务异步导入
         if task:
-            # 如果包含自关联数据，则对数据进行排序，将依赖数据先导入，并且取消批量导入任务
+            # 如果包含自关联数据，则按照依赖层级分批导入，将依赖数据先导入
             datas = request.data
             if isinstance(datas, dict):
                 datas = [datas]
             self_field = has_self_fields(self.queryset.model)
             if self_field:
-                batch_length = 99999999
-                datas = topological_sort(datas, parent=self_field)
+                levels = topological_levels(list(datas), parent=self_field, with_index=True)
+                response = run_view_by_celery_task(self, request, kwargs, levels, levels=True)
             else:
-                batch_length = 100
-            response = run_view_by_celery_task(self, request, kwargs, datas, batch_length)
+                response = run_view_by_celery_task(self, request, kwargs, datas)
             if response:
                 return response
 
         act = request.query_params.get('action')
         ignore_error = request.query_params.get('ignore_error', 'false') == 'true'
-        if act and request.data:
-            count = 0
-            if act == 'create':
-                for data in request.data:
-                    serializer = self.get_serializer(data=data)
-                    serializer.is_valid(raise_exception=not ignore_error)
-                    if serializer.errors and ignore_error:
-                        continue
-                    self.perform_create(serializer)
-                    count += 1
-            elif act == 'update':
-                queryset = self.filter_queryset(self.get_queryset())
-                for data in request.data:
-                    instance = queryset.filter(pk=data.get('pk')).first()
-                    if not instance:
-                        continue
-                    serializer = self.get_serializer(instance, data=data, partial=True)
-                    serializer.is_valid(raise_exception=not ignore_error)
-                    if serializer.errors and ignore_error:
-                        continue
-                    self.perform_update(serializer)
-                    count += 1
-            return ApiResponse(detail=_("Operation successful. Import {} data").format(count))
+        datas = request.data
+        if isinstance(datas, dict):
+            datas = [datas] if datas else []
+        # 上传文件时 request.data 为生成器，需要读取第一行判断是否有数据
+        rows = iter(datas or [])
+        first_row = next(rows, None)
+        if act in ['create', 'update'] and first_row is not None:
+            importer = BulkImporter(self, act, ignore_error, batch_size=settings.IMPORT_BATCH_SIZE,
+                                    row_offset=request.META.get('task_offset', 0),
+                                    row_indexes=request.META.get('task_rows'))
+            count = importer.run(itertools.chain([first_row], rows))
+            return ApiResponse(detail=_("Operation successful. Import {} data").format(count), errors=importer.errors)
         return ApiResponse(detail=_("Operation failed. Abnormal data"), code=1001)
 
 
@@ -6,13 +6,118 @@
 # date : 6/16/2023
 # -*- coding: utf-8 -*-
 
-
+import base64
+import datetime
+import json
 from collections import OrderedDict
+from functools import partial
+from hashlib import md5
 
+from django.conf import settings
+from django.core.paginator import Paginator as DjangoPaginator, EmptyPage, PageNotAnInteger
+from django.db import connections, transaction
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
 from drf_spectacular.plumbing import build_object_type, build_basic_type
 from drf_spectacular.types import OpenApiTypes
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from common.cache.storage import QuerySetCountCache
+from common.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+def get_planner_count(queryset):
+    """
+    使用数据库执行计划中的估算行数，不支持的数据库返回 None
+    """
+    connection = connections[queryset.db]
+    if connection.vendor not in ['postgresql', 'mysql']:
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    try:
+        # ATOMIC_REQUESTS 开启时，执行失败会导致 PostgreSQL 的请求事务中止，使用保存点隔离，失败后才能继续查询
+        with transaction.atomic(using=queryset.db), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                return int(plan[0]['Plan']['Plan Rows'])
+            cursor.execute(f'EXPLAIN {sql}', params)
+            columns = [column[0] for column in cursor.description]
+            plan = dict(zip(columns, cursor.fetchone()))
+            return int(float(plan.get('rows') or 0) * float(plan.get('filtered') or 100) / 100)
+    except Exception as e:
+        logger.warning(f"get planner count failed. Exception:{e}")
+
+
+def get_cached_count(queryset, timeout=None):
+    sql, params = queryset.order_by().query.sql_with_params()
+    cache = QuerySetCountCache(md5(f'{queryset.db}_{sql}_{params}'.encode('utf-8')).hexdigest())
+    count = cache.get_storage_cache()
+    if count is None:
+        count = queryset.count()
+        cache.set_storage_cache(count, timeout or settings.PAGINATION_COUNT_CACHE_TTL)
+    return count
+
+
+def get_queryset_count(queryset, count_mode='exact'):
+    """
+    :param count_mode: exact: 精确统计，estimate: 使用数据库执行计划估算，数据库不支持时使用缓存的统计结果，
+                       cache: 缓存统计结果，数据短时间内不准确
+    """
+    if count_mode == 'estimate':
+        count = get_planner_count(queryset)
+        if count is None:
+            return get_cached_count(queryset)
+        # 估算的数量较小时，精确统计的代价也很小
+        if count >= settings.PAGINATION_COUNT_ESTIMATE_THRESHOLD:
+            return count
+    elif count_mode == 'cache':
+        return get_cached_count(queryset)
+    return queryset.count()
+
+
+class CountModePaginator(DjangoPaginator):
+    """
+    总数可以估算或缓存的分页，总数不准确，因此不校验最大页码，超出范围时返回空数据
+    """
+
+    def __init__(self, *args, count_mode='exact', **kwargs):
+        self.count_mode = count_mode
+        super().__init__(*args, **kwargs)
+
+    @cached_property
+    def count(self):
+        if self.count_mode == 'exact' or not isinstance(self.object_list, QuerySet):
+            return super().count
+        return get_queryset_count(self.object_list, self.count_mode)
+
+    def validate_number(self, number):
+        if self.count_mode == 'exact':
+            return super().validate_number(number)
+        try:
+            if isinstance(number, float) and not number.is_integer():
+                raise ValueError
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(self.error_messages["invalid_page"])
+        if number < 1:
+            raise EmptyPage(self.error_messages["min_page"])
+        return number
+
+    def page(self, number):
+        if self.count_mode == 'exact':
+            return super().page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        return self._get_page(self.object_list[bottom:bottom + self.per_page], number, self)
 
 
 class PageNumber(PageNumberPagination):
@@ -20,6 +125,11 @@ class PageNumber(PageNumberPagination):
     page_size_query_param = 'size'  # URL中每页显示条数的参数
     page_query_param = 'page'  # URL中页码的参数
     max_page_size = 100  # 返回最大数据条数
+    count_mode = 'exact'  # 总数统计方式，参考 get_queryset_count
+
+    @property
+    def django_paginator_class(self):
+        return partial(CountModePaginator, count_mode=self.count_mode)
 
     def get_paginated_response(self, data):
         return Response(OrderedDict([
@@ -44,6 +154,123 @@ class PageNumber(PageNumberPagination):
         )
 
 
+class KeysetPageNumber(PageNumber):
+    """
+    游标分页，按照 ordering 字段的值定位下一页数据，不使用 offset，翻页越深不会越慢
+    请求中带有 cursor 参数时使用游标分页，第一页传空值，之后传上一页返回的 cursor，没有下一页时返回的 cursor 为 null
+    请求中没有 cursor 参数时，仍然使用页码分页，兼容前端翻页
+    游标分页固定按照 ordering 排序，不支持 OrderingFilter 的自定义排序，带有 cursor 参数时传入其他排序返回 400
+    """
+    cursor_query_param = 'cursor'
+    ordering = ('-created_time', '-pk')  # 最后一个字段必须唯一
+    count_mode = 'estimate'
+    invalid_cursor_message = _('Invalid cursor')
+    invalid_ordering_message = _('Cursor pagination does not support custom ordering')
+
+    keyset = False
+    cursor = None
+    queryset = None
+
+    def encode_cursor(self, instance):
+        position = []
+        for name in self.ordering:
+            value = getattr(instance, name.lstrip('-'))
+            if isinstance(value, (datetime.datetime, datetime.date)):
+                value = value.isoformat()  # 保留微秒，避免丢失精度导致数据重复或者遗漏
+            elif not isinstance(value, (int, float, bool)) and value is not None:
+                value = str(value)
+            position.append(value)
+        return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('utf-8')
+
+    def decode_cursor(self, cursor, model):
+        if not cursor:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+            if not isinstance(position, list) or len(position) != len(self.ordering):
+                raise ValueError
+            values = []
+            for name, value in zip(self.ordering, position):
+                name = name.lstrip('-')
+                field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+                values.append(field.to_python(value))
+            return values
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_position_filter(self, values):
+        """
+        (a, b) < (x, y) 转换为 a < x or (a = x and b < y)
+        """
+        condition = Q()
+        equals = Q()
+        for name, value in zip(self.ordering, values):
+            lookup = 'lt' if name.startswith('-') else 'gt'
+            name = name.lstrip('-')
+            condition |= equals & Q(**{f'{name}__{lookup}': value})
+            equals &= Q(**{name: value})
+        return condition
+
+    def check_ordering(self, request):
+        """
+        游标中只保存了 ordering 字段的值，其他排序会被覆盖导致数据错乱，因此直接拒绝
+        """
+        params = request.query_params.get(api_settings.ORDERING_PARAM)
+        if not params:
+            return
+        fields = [param.strip() for param in params.split(',') if param.strip()]
+        if fields and fields != list(self.ordering):
+            raise ValidationError({api_settings.ORDERING_PARAM: [self.invalid_ordering_message]})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.check_ordering(request)
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        self.queryset = queryset
+        queryset = queryset.order_by(*self.ordering)
+        values = self.decode_cursor(request.query_params.get(self.cursor_query_param), queryset.model)
+        if values:
+            queryset = queryset.filter(self.get_position_filter(values))
+        results = list(queryset[:page_size + 1])
+        self.cursor = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            self.cursor = self.encode_cursor(results[-1])
+        return results
+
+    def get_paginated_response(self, data):
+        if self.keyset:
+            total = get_queryset_count(self.queryset, self.count_mode)
+        else:
+            total = self.page.paginator.count
+        return Response(OrderedDict([
+            ('total', total),
+            ('cursor', self.cursor if self.keyset else None),
+            ('results', data)
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return build_object_type(
+            properties={
+                'code': build_basic_type(OpenApiTypes.NUMBER),
+                'detail': build_basic_type(OpenApiTypes.STR),
+                'data': build_object_type(
+                    properties={
+                        'total': build_basic_type(OpenApiTypes.NUMBER),
+                        'cursor': build_basic_type(OpenApiTypes.STR),
+                        'results': schema
+                    }
+                ),
+            }
+        )
+
+
 class DynamicPageNumber(object):
     def __init__(self, max_page_size=100, page_size=20):
         self.max_page_size = max_page_size
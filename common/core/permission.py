@@ -6,6 +6,7 @@
 # date : 6/6/2023
 import re
 import uuid
+from functools import lru_cache
 
 from django.conf import settings
 from django.db.models import Q
@@ -33,7 +34,8 @@ def get_user_menu_queryset(user_obj):
         return Menu.objects.filter(is_active=True).filter(q)
 
 
-@MagicCacheData.make_cache(timeout=10, key_func=lambda *args: f"{args[0].pk}_{args[1]}")
+@MagicCacheData.make_cache(timeout=10, key_func=lambda *args: f"{args[0].pk}_{args[1]}",
+                           generation_func=lambda *args: [f"user_{args[0].pk}"])
 def get_user_field_queryset(user_obj, menu):
     q = Q()
     data = {}
@@ -56,7 +58,8 @@ def get_user_field_queryset(user_obj, menu):
     return data
 
 
-@MagicCacheData.make_cache(timeout=3600 * 24, key_func=lambda x, y: f"{x.pk}_{y}")
+@MagicCacheData.make_cache(timeout=3600 * 24, key_func=lambda x, y: f"{x.pk}_{y}",
+                           generation_func=lambda x, y: [f"user_{x.pk}"])
 def get_user_permission(user_obj, method):
     menus = []
     menu_queryset = get_user_menu_queryset(user_obj)
@@ -66,22 +69,110 @@ def get_user_permission(user_obj, method):
     return dict([(menu[0], menu[1:]) for menu in menus])
 
 
+SEARCH_COLUMNS_RE = re.compile("(?P<url>.*)/(search-columns|related-choices)$")
+IMPORT_EXPORT_RE = re.compile("(?P<url>.*)/(export|import)-data$")
+NAMED_GROUP_RE = re.compile(r"\(\?P<\w+>")
+
+
+class PatternMatcher(object):
+    """
+    将多个正则合并为一个分支正则，每个分支使用 _下标 命名，通过 match.lastgroup 获取匹配的下标
+    分支按顺序尝试，结果和逐个 re.match 取第一个匹配一致
+    无法合并的正则（例如包含 (?P=name) 反向引用）单独编译，逐个匹配
+    """
+
+    def __init__(self, patterns):
+        self.combined = None
+        self.singles = []
+        merged = []
+        for index, pattern in enumerate(patterns):
+            # 分支中的命名分组可能重名，改为非捕获分组
+            new_pattern = NAMED_GROUP_RE.sub('(?:', pattern)
+            try:
+                re.compile(new_pattern)
+                merged.append((index, pattern, new_pattern))
+                continue
+            except re.error:
+                pass
+            try:
+                self.singles.append((index, re.compile(pattern)))
+            except re.error:
+                continue
+        if merged:
+            try:
+                self.combined = re.compile("|".join(f"(?P<_{index}>{new})" for index, _, new in merged))
+            except re.error:
+                self.singles.extend((index, re.compile(pattern)) for index, pattern, _ in merged)
+                self.singles.sort(key=lambda x: x[0])
+
+    def match(self, url):
+        """
+        :return: 第一个匹配的正则下标，没有匹配返回 None
+        """
+        result = None
+        if self.combined:
+            match = self.combined.match(url)
+            if match:
+                result = int(match.lastgroup[1:])
+        for index, pattern in self.singles:
+            if result is not None and index > result:
+                break
+            if pattern.match(url):
+                return index
+        return result
+
+
+def combine_patterns(patterns):
+    if patterns:
+        return PatternMatcher(patterns)
+
+
+def match_patterns(matcher, url):
+    if matcher:
+        return matcher.match(url)
+
+
+@lru_cache(maxsize=1024)
+def get_permission_matcher(paths):
+    """
+    相同权限集合的用户共用一个编译好的匹配器
+    """
+    return combine_patterns([f"/{path}" for path in paths])
+
+
+@lru_cache(maxsize=32)
+def get_white_url_matcher(method, white_urls):
+    return combine_patterns([w_url for w_url, methods in white_urls if '*' in methods or method in methods])
+
+
+def is_white_url(url, method):
+    white_urls = tuple((w_url, tuple(methods)) for w_url, methods in settings.PERMISSION_WHITE_URL.items())
+    return match_patterns(get_white_url_matcher(method, white_urls), url) is not None
+
+
 def get_import_export_permission(permission_data, url):
-    match_group = re.match("(?P<url>.*)/(export|import)-data$", url)
+    """
+    :param permission_data: [{'path': 菜单路径, ...}]
+    :return: 第一个匹配的权限数据
+    """
+    match_group = IMPORT_EXPORT_RE.match(url)
     if match_group:
         url = match_group.group('url')
-        for p_data in permission_data:
-            if re.match(f"/{p_data.get('path')}", url):
-                return p_data
+        paths = tuple(p_data.get('path') for p_data in permission_data)
+        index = match_patterns(get_permission_matcher(paths), url)
+        if index is not None:
+            return permission_data[index]
 
 
 def get_menu_pk(permission_data, url):
     # 1.直接get api/system/permission$   /api/system/config/system
     p_data = permission_data.get(f"{url[1:]}$")
     if not p_data:
-        for p_path, p_data in permission_data.items():
-            if re.match(f"/{p_path}", url):
-                return p_data
+        # 2.通过合并后的正则一次匹配
+        paths = tuple(permission_data.keys())
+        index = match_patterns(get_permission_matcher(paths), url)
+        if index is not None:
+            return permission_data[paths[index]]
     return p_data
 
 
@@ -100,20 +191,19 @@ class IsAuthenticated(BasePermission):
                 request.ignore_field_permission = True
                 return True
             url = request.path_info
-            for w_url, method in settings.PERMISSION_WHITE_URL.items():
-                if re.match(w_url, url) and ('*' in method or request.method in method):
-                    request.ignore_field_permission = True
-                    return True
+            if is_white_url(url, request.method):
+                request.ignore_field_permission = True
+                return True
             permission_data = get_user_permission(request.user, request.method)
-            # 处理search-columns字段权限和list权限一致
-            match_group = re.match("(?P<url>.*)/search-columns$", url)
+            # 处理search-columns和related-choices字段权限和list权限一致
+            match_group = SEARCH_COLUMNS_RE.match(url)
             if match_group:
                 url = match_group.group('url')
             p_data = p_data_new = get_menu_pk(permission_data, url)
 
             if p_data:
                 # 导入导出功能，若未绑定模型，则使用list, create菜单
-                match_group = re.match("(?P<url>.*)/(export|import)-data$", url)
+                match_group = IMPORT_EXPORT_RE.match(url)
                 if match_group and p_data[1] is None:
                     url = match_group.group('url')
                     p_data_new = get_menu_pk(permission_data, url)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# project : xadmin-server
+# filename : planner
+# author : ly_13
+# date : 10/18/2026
+# 根据序列化字段和关联字段的 attrs 生成 select_related/prefetch_related 查询计划，避免列表序列化时的 N+1 查询
+import copy
+import threading
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, router
+from django.db.models import Prefetch
+from django.db.models.constants import LOOKUP_SEP
+from rest_framework.relations import ManyRelatedField, RelatedField
+from rest_framework.serializers import ListSerializer
+
+from common.core.fields import BasePrimaryKeyRelatedField
+from common.core.serializers import BaseModelSerializer
+from common.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+class QueryPlan(object):
+    """
+    每个序列化字段需要的 select_related 路径和 Prefetch，请求时只应用实际返回字段的部分
+    """
+
+    def __init__(self):
+        self.select_related = {}  # 序列化字段名称: [select_related 路径]
+        self.prefetch_related = {}  # 序列化字段名称: [Prefetch]
+
+    def add_select_related(self, field_name, *paths):
+        self.select_related.setdefault(field_name, []).extend(paths)
+
+    def add_prefetch_related(self, field_name, *prefetches):
+        self.prefetch_related.setdefault(field_name, []).extend(prefetches)
+
+    def __repr__(self):
+        return f"<QueryPlan select_related={self.select_related} prefetch_related={self.prefetch_related}>"
+
+
+def get_forward_relation(model, name):
+    """
+    正向外键和一对一字段返回关联模型，可以使用 select_related
+    """
+    try:
+        model_field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    if model_field.concrete and (model_field.many_to_one or model_field.one_to_one):
+        return model_field.related_model
+
+
+def get_attrs_lookups(model, attrs):
+    """
+    BasePrimaryKeyRelatedField 的 attrs 在关联模型上需要的字段和 select_related 路径
+    :return: (only 字段，无法确定时为 None, select_related 路径)
+    """
+    if attrs is None:
+        return {'pk'}, []
+    if not isinstance(attrs, (list, set, tuple)):
+        return None, []
+    only_fields, select_related = {'pk'}, []
+    for attr in attrs:
+        names = attr.split(LOOKUP_SEP)
+        name = names[0]
+        if name.startswith('get_') and name.endswith('_display'):
+            name = name[4:-8]
+        try:
+            model_field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            if name in ['pk', 'label']:
+                continue
+            only_fields = None
+            continue
+        if model_field.many_to_many or not model_field.concrete:
+            only_fields = None
+            continue
+        if only_fields is not None:
+            only_fields.add(model_field.name)
+        related_model, path = model, []
+        for part in names[:-1]:
+            related_model = get_forward_relation(related_model, part)
+            if related_model is None:
+                break
+            path.append(part)
+        if path:
+            select_related.append(LOOKUP_SEP.join(path))
+    return only_fields, select_related
+
+
+def build_prefetch(lookup, related_model, attrs):
+    only_fields, select_related = get_attrs_lookups(related_model, attrs)
+    queryset = related_model._default_manager.all()
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+        only_fields = None  # select_related 的外键不能延迟加载
+    if only_fields:
+        queryset = queryset.only(*only_fields)
+    return Prefetch(lookup, queryset=queryset)
+
+
+def plan_field(plan, field_name, field, model, prefix=''):
+    source = field.source
+    if source == '*' or getattr(field, 'write_only', False):
+        return
+    parts = source.split('.')
+    related_model = model
+    path = []
+    for part in parts[:-1]:
+        related_model = get_forward_relation(related_model, part)
+        if related_model is None:
+            return
+        path.append(part)
+    if path:
+        plan.add_select_related(field_name, prefix + LOOKUP_SEP.join(path))
+    name = parts[-1]
+    lookup = prefix + LOOKUP_SEP.join(path + [name])
+
+    try:
+        model_field = related_model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return
+    if not model_field.is_relation:
+        return
+
+    if isinstance(field, ManyRelatedField):
+        child = field.child_relation
+        attrs = child.attrs if isinstance(child, BasePrimaryKeyRelatedField) else None
+        plan.add_prefetch_related(field_name, build_prefetch(lookup, model_field.related_model, attrs))
+    elif isinstance(field, BasePrimaryKeyRelatedField):
+        # attrs 为空时只返回主键，不需要查询关联数据
+        if field.attrs is None or not get_forward_relation(related_model, name):
+            return
+        plan.add_select_related(field_name, lookup)
+        for path in get_attrs_lookups(model_field.related_model, field.attrs)[1]:
+            plan.add_select_related(field_name, lookup + LOOKUP_SEP + path)
+    elif isinstance(field, RelatedField) and get_forward_relation(related_model, name):
+        plan.add_select_related(field_name, lookup)
+    elif isinstance(field, ListSerializer) and isinstance(field.child, BaseModelSerializer):
+        child_plan = build_query_plan(type(field.child))
+        queryset = apply_query_plan(model_field.related_model._default_manager.all(), child_plan)
+        plan.add_prefetch_related(field_name, Prefetch(lookup, queryset=queryset))
+    elif isinstance(field, BaseModelSerializer) and get_forward_relation(related_model, name):
+        plan.add_select_related(field_name, lookup)
+        for child_name, child_field in field.fields.items():
+            plan_field(plan, field_name, child_field, model_field.related_model, lookup + LOOKUP_SEP)
+
+
+def build_query_plan(serializer_class):
+    plan = QueryPlan()
+    serializer = serializer_class(ignore_field_permission=True)
+    model = serializer.Meta.model
+    for field_name, field in serializer.fields.items():
+        plan_field(plan, field_name, field, model)
+    return plan
+
+
+_query_plans = {}
+_query_plans_lock = threading.Lock()
+
+
+def get_query_plan(serializer_class):
+    """
+    每个序列化类只生成一次查询计划
+    """
+    plan = _query_plans.get(serializer_class)
+    if plan is None:
+        with _query_plans_lock:
+            plan = _query_plans.get(serializer_class)
+            if plan is None:
+                try:
+                    plan = build_query_plan(serializer_class)
+                except Exception as e:
+                    logger.warning(f"build {serializer_class.__name__} query plan failed. Exception:{e}")
+                    plan = QueryPlan()
+                _query_plans[serializer_class] = plan
+    return plan
+
+
+def apply_query_plan(queryset, plan, field_names=None):
+    """
+    :param field_names: 实际返回的序列化字段，为 None 时应用全部计划
+    """
+    select_related, prefetch_related = set(), {}
+    for field_name, paths in plan.select_related.items():
+        if field_names is None or field_name in field_names:
+            select_related.update(paths)
+    for field_name, prefetches in plan.prefetch_related.items():
+        if field_names is None or field_name in field_names:
+            for prefetch in prefetches:
+                prefetch_related.setdefault(prefetch.prefetch_to, prefetch)
+
+    # 已经设置了 only/defer 的查询，外键可能被延迟加载，不能再 select_related
+    if select_related and queryset.query.select_related is not True and not queryset.query.deferred_loading[0]:
+        queryset = queryset.select_related(*sorted(select_related))
+    existing = {
+        lookup.prefetch_to if isinstance(lookup, Prefetch) else lookup
+        for lookup in queryset._prefetch_related_lookups
+    }
+    prefetches = [copy.copy(prefetch) for lookup, prefetch in prefetch_related.items() if lookup not in existing]
+    if prefetches:
+        queryset = queryset.prefetch_related(*prefetches)
+    return queryset
+
+
+def assert_constant_queries(serializer_class, instances, **kwargs):
+    """
+    调试模式下检查列表接口，分别序列化第一条数据和其余数据，其余数据的查询次数更多时说明存在 N+1 查询
+    """
+    from django.test.utils import CaptureQueriesContext
+
+    kwargs.pop('many', None)
+    instances = list(instances)
+    if len(instances) < 3:
+        return
+    connection = connections[router.db_for_read(instances[0].__class__)]
+    with CaptureQueriesContext(connection) as single:
+        serializer_class(instances[:1], many=True, **kwargs).data
+    with CaptureQueriesContext(connection) as page:
+        serializer_class(instances[1:], many=True, **kwargs).data
+    if len(page) > len(single):
+        sqls = '\n'.join(query['sql'] for query in page.captured_queries[:5])
+        raise AssertionError(
+            f"{serializer_class.__name__} executed {len(single)} queries for 1 row but {len(page)} queries "
+            f"for {len(instances) - 1} rows, add select_related/prefetch_related for the related fields.\n{sqls}"
+        )
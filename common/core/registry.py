@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# project : xadmin-server
+# filename : registry
+# author : ly_13
+# date : 10/18/2026
+# search-fields 和 search-columns 中只和视图类、序列化类相关的静态数据，每个进程只计算一次，请求时只合并和权限相关的部分
+import threading
+
+from django.test import RequestFactory
+from django.urls import get_resolver, URLPattern, URLResolver
+from django.utils.translation import get_language
+
+from common.utils import get_logger
+
+logger = get_logger(__name__)
+
+METADATA_ACTIONS = ['search_fields', 'search_columns']
+
+
+class MetadataRegistry(object):
+    """
+    静态数据中的 label、help_text 等已经翻译为字符串，按照语言分别缓存
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+
+    def get(self, key, builder):
+        key = key + (get_language(),)
+        data = self._data.get(key)
+        if data is None:
+            with self._lock:
+                data = self._data.get(key)
+                if data is None:
+                    data = builder()
+                    self._data[key] = data
+        return data
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+metadata_registry = MetadataRegistry()
+
+
+def iter_metadata_views(patterns=None, prefix=''):
+    """
+    遍历路由中包含 search-fields 或 search-columns 的视图集
+    :return: (路由, 视图函数, action)
+    """
+    if patterns is None:
+        patterns = get_resolver().url_patterns
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            yield from iter_metadata_views(pattern.url_patterns, prefix + str(pattern.pattern))
+        elif isinstance(pattern, URLPattern):
+            actions = getattr(pattern.callback, 'actions', None) or {}
+            for action in set(actions.values()) & set(METADATA_ACTIONS):
+                yield prefix + str(pattern.pattern), pattern.callback, action
+
+
+def get_metadata_view(callback, action):
+    """
+    构造一个没有登录用户的视图实例，用于计算静态数据
+    """
+    view = callback.cls(**callback.initkwargs)
+    view.action_map = callback.actions
+    view.args, view.kwargs = (), {}
+    view.request = view.initialize_request(RequestFactory().get('/'))
+    view.format_kwarg = None
+    view.action = action
+    return view
+
+
+def warm_metadata(verify=False):
+    """
+    预先计算所有视图集的静态数据
+    :param verify: 重新计算并和注册表中的数据对比，不一致说明静态数据中包含了动态数据
+    :return: [(路由, action, 错误信息)]
+    """
+    errors = []
+    for route, callback, action in iter_metadata_views():
+        try:
+            view = get_metadata_view(callback, action)
+            key, builder = getattr(view, f"get_{action}_builder")()
+            data = metadata_registry.get(key, builder)
+            if verify and builder() != data:
+                errors.append((route, action, 'metadata changed between builds'))
+        except Exception as e:
+            logger.warning(f"warm {route} {action} metadata failed. Exception:{e}")
+            errors.append((route, action, str(e)))
+    return errors
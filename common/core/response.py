@@ -16,11 +16,12 @@ class ApiResponse(Response):
         dic = {
             'code': code,
             'detail': detail if detail else (_("Operation successful") if code == 1000 else _("Operation failed")),
-            'requestId': str(getattr(get_current_request(), 'request_uuid', ""))
         }
         if data is not None:
             dic['data'] = data
         dic.update(kwargs)
+        # requestId 放到最后，缓存压缩响应时，只需要重新压缩 requestId 之后的少量内容
+        dic['requestId'] = str(getattr(get_current_request(), 'request_uuid', ""))
         self._data = data
         # 对象来调用对象的绑定方法，会自动传值
         super().__init__(data=dic, status=status, headers=headers, content_type=content_type)
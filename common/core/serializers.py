@@ -4,17 +4,41 @@
 # filename : serializers
 # author : ly_13
 # date : 12/21/2023
+import copy
+import threading
 from inspect import isfunction
 
 from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
 from django.db.models.fields import NOT_PROVIDED
-from rest_framework.fields import empty
+from rest_framework.fields import empty, Field
 from rest_framework.request import Request
-from rest_framework.serializers import ModelSerializer
+from rest_framework.serializers import ModelSerializer, BaseSerializer
 
 from common.core.fields import BasePrimaryKeyRelatedField, LabeledChoiceField
 from server.utils import get_current_request
 
+_field_prototypes = {}  # 序列化类: (未绑定的字段原型, 模型中函数类型的默认值)
+_field_prototypes_lock = threading.RLock()  # 构建时会实例化嵌套的序列化器
+_field_sets = {}  # (序列化类, 字段权限, 展示字段, 不展示字段): 允许展示的字段名称
+FIELD_SETS_MAX_SIZE = 4096  # 展示字段来自请求参数，限制缓存的组合数量
+
+
+def copy_field(field):
+    """
+    复制字段原型，嵌套的序列化器需要根据当前请求重新过滤字段，仍然使用深复制
+    """
+    if isinstance(field, BaseSerializer):
+        return copy.deepcopy(field)
+    new_field = copy.copy(field)
+    for attr in ['child_relation', 'child']:
+        child = getattr(field, attr, None)
+        if isinstance(child, Field):
+            child = copy_field(child)
+            child.bind(field_name='', parent=new_field)
+            setattr(new_field, attr, child)
+    return new_field
+
 
 class BaseModelSerializer(ModelSerializer):
     serializer_related_field = BasePrimaryKeyRelatedField
@@ -33,48 +57,119 @@ class BaseModelSerializer(ModelSerializer):
         #     return html.parse_html_dict(dictionary, prefix=self.field_name) or empty
         return dictionary.get(self.field_name, empty)
 
+    def get_permission_fields(self, ignore_field_permission):
+        """
+        字段权限允许的字段，不限制时返回 None
+        """
+        if self.ignore_field_permission or ignore_field_permission or (
+                self.request and hasattr(self.request, "ignore_field_permission")):
+            return None
+
+        # 获取权限字段，如果没有配置，则为定义的所有字段
+        if self.request and settings.PERMISSION_FIELD_ENABLED:
+            if hasattr(self.request, "user") and self.request.user and self.request.user.is_superuser:
+                return None
+            if hasattr(self.request, "fields") and self.request.fields and isinstance(self.request.fields, dict):
+                return frozenset(self.request.fields.get(self.Meta.model._meta.label_lower, []))
+            return frozenset()
+        return None
+
     def get_allow_fields(self, fields, ignore_field_permission):
         """
         self.fields: 默认定义的字段
         fields: 需要展示的字段
         allow_fields: 字段权限允许的字段
         """
-        _fields = set(self.fields)
+        _fields = set(self.get_field_prototypes())
         if fields is None:
             fields = _fields
 
-        if self.ignore_field_permission or ignore_field_permission or (
-                self.request and hasattr(self.request, "ignore_field_permission")):
+        allow_fields = self.get_permission_fields(ignore_field_permission)
+        if allow_fields is None:
             return set(fields) & _fields
+        return set(fields) & _fields & set(allow_fields)
 
-        allow_fields = []
-        # 获取权限字段，如果没有配置，则为定义的所有字段
-        if self.request and settings.PERMISSION_FIELD_ENABLED and not self.ignore_field_permission:
-            if hasattr(self.request, "user") and self.request.user and self.request.user.is_superuser:
-                allow_fields = _fields
-            elif hasattr(self.request, "fields"):
-                if self.request.fields and isinstance(self.request.fields, dict):
-                    allow_fields = self.request.fields.get(self.Meta.model._meta.label_lower, [])
-        else:
-            allow_fields = _fields
+    def get_allow_field_names(self, fields, ignore_field_permission, omit_fields):
+        """
+        相同的序列化类和字段权限，允许展示的字段相同，按照字段权限等缓存字段名称
+        """
+        key = (type(self), self.get_permission_fields(ignore_field_permission),
+               None if fields is None else frozenset(fields), frozenset(omit_fields or []))
+        names = _field_sets.get(key)
+        if names is None:
+            allowed = self.get_allow_fields(fields, ignore_field_permission) - key[3]
+            names = tuple(name for name in self.get_field_prototypes() if name in allowed)
+            if len(_field_sets) >= FIELD_SETS_MAX_SIZE:
+                _field_sets.clear()
+            _field_sets[key] = names
+        return names
 
-        return set(fields) & _fields & set(allow_fields)
+    def get_field_prototypes(self):
+        """
+        每个序列化类只构建一次字段，之后实例化时只复制允许展示的字段
+        """
+        prototypes = _field_prototypes.get(type(self))
+        if prototypes is None:
+            with _field_prototypes_lock:
+                prototypes = _field_prototypes.get(type(self))
+                if prototypes is None:
+                    self._callable_defaults = {}
+                    prototypes = (super().get_fields(), self._callable_defaults)
+                    _field_prototypes[type(self)] = prototypes
+        return prototypes[0]
+
+    def get_fields(self):
+        prototypes = self.get_field_prototypes()
+        callable_defaults = _field_prototypes[type(self)][1]
+        names = prototypes.keys() if self._allow_field_names is None else self._allow_field_names
+        fields = {}
+        for name in names:
+            fields[name] = copy_field(prototypes[name])
+            if name in callable_defaults:
+                # 模型中函数类型的默认值，每次实例化时重新计算
+                fields[name].default = callable_defaults[name]()
+        return fields
 
-    def __init__(self, instance=None, data=empty, fields=None, ignore_field_permission=False, **kwargs):
+    def __init__(self, instance=None, data=empty, fields=None, ignore_field_permission=False, omit_fields=None,
+                 **kwargs):
         """
         :param instance:
         :param data:
         :param request: Request 对象
         :param fields: 序列化展示的字段， 默认定义的全部字段
         :param ignore_field_permission: 忽略字段权限控制
+        :param omit_fields: 不展示的字段
         """
         super().__init__(instance, data, **kwargs)
         self.request: Request = get_current_request()
+        self._allow_field_names = None
         if self.request is None:
             return
-        allowed = self.get_allow_fields(fields, ignore_field_permission)
-        for field_name in set(self.fields) - allowed:
-            self.fields.pop(field_name)
+        self._allow_field_names = self.get_allow_field_names(fields, ignore_field_permission, omit_fields)
+
+    def get_only_fields(self):
+        """
+        序列化字段需要从数据库读取的字段，用于 queryset.only()，存在无法确定来源的字段时返回 None
+        多对多和反向关联字段单独查询，只需要主键
+        """
+        opts = self.Meta.model._meta
+        only_fields = set()
+        for field in self.fields.values():
+            if field.write_only or field.source == 'pk':
+                continue
+            if field.source == '*':
+                return None
+            try:
+                model_field = opts.get_field(field.source.split('.')[0])
+            except FieldDoesNotExist:
+                return None
+            if model_field.many_to_many or model_field.one_to_many or (
+                    model_field.one_to_one and model_field.auto_created and not model_field.concrete):
+                continue
+            if not model_field.concrete:
+                return None
+            only_fields.add(model_field.name)
+        return only_fields
 
     def build_standard_field(self, field_name, model_field):
         field_class, field_kwargs = super().build_standard_field(field_name, model_field)
@@ -82,6 +177,7 @@ class BaseModelSerializer(ModelSerializer):
         if default != NOT_PROVIDED:
             # 将model中的默认值同步到序列化中
             if isfunction(default):
+                self._callable_defaults[field_name] = default
                 default = default()
             field_kwargs.setdefault("default", default)
         return field_class, field_kwargs
@@ -7,7 +7,7 @@
 import datetime
 import logging
 import re
-from collections import OrderedDict, deque, defaultdict
+from collections import OrderedDict, defaultdict
 
 from django.apps import apps
 from django.conf import settings
@@ -172,15 +172,19 @@ class PrintLogFormat(object):
             self.__print(self.bold_error(self.base_str), self._warning(msg))
 
 
-def topological_sort(data, pk='pk', parent='parent'):
+def topological_levels(data, pk='pk', parent='parent', with_index=False):
+    """
+    按照依赖层级对数据分组，同一层级的数据之间没有依赖，可以并行处理，每一层只依赖之前层级的数据
+    :param with_index: 每条数据返回 (在 data 中的序号, 数据)，用于导入时报告原始的行号
+    """
     # 构建图和入度表
     graph = defaultdict(list)
     in_degree = {item[pk]: 0 for item in data}
     nodes = set()
     new_data = {}
-    for item in data:
+    for index, item in enumerate(data):
         node_id = item[pk]
-        new_data[node_id] = item
+        new_data[node_id] = (index, item) if with_index else item
         parent_id = item[parent]
         if isinstance(parent_id, dict):
             parent_id = item[parent].get(pk)
@@ -190,23 +194,30 @@ def topological_sort(data, pk='pk', parent='parent'):
             if parent_id in in_degree:
                 in_degree[node_id] += 1
 
-    # 找到所有入度为0的节点
-    queue = deque([node for node in nodes if in_degree[node] == 0])
-    sorted_order = []
+    # 入度为0的节点为第一层，每处理完一层，入度变为0的节点为下一层
+    level = [node for node in nodes if in_degree[node] == 0]
+    levels = []
+    count = 0
+    while level:
+        levels.append([new_data[node_id] for node_id in level])
+        count += len(level)
+        next_level = []
+        for current in level:
+            for neighbor in graph[current]:
+                in_degree[neighbor] -= 1
+                if in_degree[neighbor] == 0:
+                    next_level.append(neighbor)
+        level = next_level
+
+    # 如果排序后的数量不等于原始数据数量，说明存在环
+    if count != len(nodes):
+        raise ValueError("Circular dependencies exist")
 
-    while queue:
-        current = queue.popleft()
-        sorted_order.append(current)
-        for neighbor in graph[current]:
-            in_degree[neighbor] -= 1
-            if in_degree[neighbor] == 0:
-                queue.append(neighbor)
+    return levels
 
-    # 如果排序后的列表长度不等于原始列表长度，说明存在环
-    if len(sorted_order) != len(nodes):
-        raise ValueError("Circular dependencies exist")
 
-    return [new_data[node_id] for node_id in sorted_order]
+def topological_sort(data, pk='pk', parent='parent'):
+    return [item for level in topological_levels(data, pk, parent) for item in level]
 
 
 def has_self_fields(model):
@@ -88,6 +88,13 @@ class SimpleMetadataWithFilters(SimpleMetadata):
             for choice_value, choice_label in dict(field.choices).items()
         ]
 
+    @staticmethod
+    def get_field_default(field):
+        default = getattr(field, "default", None)
+        if default is not None and default != empty:
+            if isinstance(default, (str, int, bool, float, datetime.datetime, list)):
+                return default
+
     def get_field_info(self, field):
         """
         Given an instance of a serializer field, return a dictionary
@@ -98,10 +105,9 @@ class SimpleMetadataWithFilters(SimpleMetadata):
         field_info["required"] = getattr(field, "required", False)
 
         # Default value
-        default = getattr(field, "default", None)
-        if default is not None and default != empty:
-            if isinstance(default, (str, int, bool, float, datetime.datetime, list)):
-                field_info["default"] = default
+        default = self.get_field_default(field)
+        if default is not None:
+            field_info["default"] = default
 
         for attr in self.attrs:
             value = getattr(field, attr, None)
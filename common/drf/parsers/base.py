@@ -1,8 +1,8 @@
 import abc
-import codecs
 import json
 import re
 
+from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 from rest_framework import status
@@ -22,31 +22,46 @@ class FileContentOverflowedError(APIException):
 
 
 class BaseFileParser(BaseParser):
-    FILE_CONTENT_MAX_LENGTH = 1024 * 1024 * 10
+    FILE_CONTENT_MAX_LENGTH = settings.IMPORT_FILE_MAX_LENGTH
+    FILE_CHUNK_SIZE = 64 * 1024
 
     serializer_cls = None
     serializer_fields = None
     obj_pattern = re.compile(r'^(.+)\(([a-z0-9-]+)\)$')
 
+    def raise_content_overflowed(self):
+        msg = FileContentOverflowedError.default_detail.format(self.FILE_CONTENT_MAX_LENGTH)
+        logger.error(msg)
+        raise FileContentOverflowedError(msg)
+
     def check_content_length(self, meta):
-        content_length = int(meta.get('CONTENT_LENGTH', meta.get('HTTP_CONTENT_LENGTH', 0)))
+        content_length = int(meta.get('CONTENT_LENGTH', meta.get('HTTP_CONTENT_LENGTH', 0)) or 0)
         if content_length > self.FILE_CONTENT_MAX_LENGTH:
-            msg = FileContentOverflowedError.default_detail.format(self.FILE_CONTENT_MAX_LENGTH)
-            logger.error(msg)
-            raise FileContentOverflowedError(msg)
+            self.raise_content_overflowed()
 
-    @staticmethod
-    def get_stream_data(stream):
-        stream_data = stream.read()
-        stream_data = stream_data.strip(codecs.BOM_UTF8)
-        return stream_data
+    def iter_stream_chunks(self, stream):
+        """
+        分块读取上传的文件，不一次性读取到内存中
+        """
+        length = 0
+        while True:
+            chunk = stream.read(self.FILE_CHUNK_SIZE)
+            if not chunk:
+                break
+            length += len(chunk)
+            if length > self.FILE_CONTENT_MAX_LENGTH:
+                self.raise_content_overflowed()
+            yield chunk
 
     @abc.abstractmethod
-    def generate_rows(self, stream_data):
+    def generate_rows(self, stream):
+        """
+        逐行返回文件中的数据
+        """
         raise NotImplementedError
 
     def get_column_titles(self, rows):
-        return next(rows)
+        return [str(title) if title is not None else '' for title in next(rows, [])]
 
     def convert_to_field_names(self, column_titles):
         fields_map = {}
@@ -171,7 +186,6 @@ class BaseFileParser(BaseParser):
         return new_row
 
     def generate_data(self, fields_name, rows):
-        data = []
         for row in rows:
             # 空行不处理
             if not any(row):
@@ -179,17 +193,29 @@ class BaseFileParser(BaseParser):
             row = self.load_row(row)
             row_data = dict(zip(fields_name, row))
             row_data = self.process_row_data(row_data)
-            data.append(row_data)
-        return data
+            yield row_data
 
     @staticmethod
     def pop_help_text_if_need(rows):
-        rows = list(rows)
-        if not rows:
-            return rows
-        if rows[0][0].startswith('#Help'):
-            rows.pop(0)
-        return rows
+        first_row = next(rows, None)
+        if first_row is None:
+            return
+        if not first_row or not str(first_row[0]).startswith('#Help'):
+            yield first_row
+        yield from rows
+
+    @staticmethod
+    def iter_parsed_data(data):
+        """
+        数据在视图中读取时才会解析文件，解析过程中的异常同样转换为 ParseError
+        """
+        try:
+            yield from data
+        except APIException:
+            raise
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            raise ParseError(_("Parse file error: {}").format(str(e)))
 
     def parse(self, stream, media_type=None, parser_context=None):
         assert parser_context is not None, '`parser_context` should not be `None`'
@@ -207,8 +233,7 @@ class BaseFileParser(BaseParser):
 
         self.check_content_length(meta)
         try:
-            stream_data = self.get_stream_data(stream)
-            rows = self.generate_rows(stream_data)
+            rows = iter(self.generate_rows(stream))
             column_titles = self.get_column_titles(rows)
             field_names = self.convert_to_field_names(column_titles)
 
@@ -220,8 +245,10 @@ class BaseFileParser(BaseParser):
             request.jms_context['column_title_field_pairs'] = column_title_field_pairs
 
             rows = self.pop_help_text_if_need(rows)
-            data = self.generate_data(field_names, rows)
-            return data
+            # 返回生成器，数据在导入时逐行解析，内存占用和文件大小无关
+            return self.iter_parsed_data(self.generate_data(field_names, rows))
+        except APIException:
+            raise
         except Exception as e:
             logger.error(e, exc_info=True)
             raise ParseError(_("Parse file error: {}").format(str(e)))
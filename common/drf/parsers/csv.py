@@ -1,8 +1,12 @@
 # ~*~ coding: utf-8 ~*~
 #
 
+import codecs
+import csv
+import io
+import itertools
+
 import chardet
-import unicodecsv
 
 from .base import BaseFileParser
 from ..const import CSV_FILE_ESCAPE_CHARS
@@ -11,6 +15,10 @@ from ..utils import lazyproperty
 
 class CSVFileParser(BaseFileParser):
     media_type = 'text/csv'
+    # 检测到的编码只覆盖了文件开头的部分内容，使用兼容的超集编码解码整个文件
+    ENCODING_SUPERSETS = {'ascii': 'utf-8', 'gb2312': 'gb18030', 'gbk': 'gb18030'}
+    ENCODING_SAMPLE_SIZE = 64 * 1024
+
 
     @lazyproperty
     def match_escape_chars(self):
@@ -22,13 +30,33 @@ class CSVFileParser(BaseFileParser):
             chars.append(sg_char)
         return tuple(chars)
 
-    @staticmethod
-    def _universal_newlines(stream):
+    def detect_encoding(self, sample):
+        if sample.startswith(codecs.BOM_UTF8):
+            return 'utf-8-sig'
+        encoding = (chardet.detect(sample).get("encoding") or "utf-8").lower()
+        return self.ENCODING_SUPERSETS.get(encoding, encoding)
+
+    def _universal_newlines(self, chunks):
         """
-        保证在`通用换行模式`下打开文件
+        增量解码，逐行返回，保证在`通用换行模式`下读取文件
         """
-        for line in stream.splitlines():
-            yield line
+        sample = b''
+        for chunk in chunks:
+            sample += chunk
+            if len(sample) >= self.ENCODING_SAMPLE_SIZE:
+                break
+        decoder = codecs.getincrementaldecoder(self.detect_encoding(sample))()
+        pending = ''
+        for chunk in itertools.chain([sample], chunks):
+            pending += decoder.decode(chunk)
+            # 只处理到最后一个换行符，最后不完整的一行留到下一个块中处理
+            index = pending.rfind('\n') + 1
+            if index:
+                yield from io.StringIO(pending[:index], newline='')
+                pending = pending[index:]
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            yield from io.StringIO(pending, newline='')
 
     def __parse_row(self, row):
         row_escape = []
@@ -38,11 +66,9 @@ class CSVFileParser(BaseFileParser):
             row_escape.append(d)
         return row_escape
 
-    def generate_rows(self, stream_data):
-        detect_result = chardet.detect(stream_data)
-        encoding = detect_result.get("encoding", "utf-8")
-        lines = self._universal_newlines(stream_data)
-        csv_reader = unicodecsv.reader(lines, encoding=encoding)
+    def generate_rows(self, stream):
+        lines = self._universal_newlines(self.iter_stream_chunks(stream))
+        csv_reader = csv.reader(lines)
         for row in csv_reader:
             row = self.__parse_row(row)
             yield row
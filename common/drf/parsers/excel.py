@@ -1,18 +1,29 @@
-import pyexcel
+from tempfile import SpooledTemporaryFile
+
 from django.utils.translation import gettext_lazy as _
+from openpyxl import load_workbook
 
 from .base import BaseFileParser
 
 
 class ExcelFileParser(BaseFileParser):
     media_type = 'text/xlsx'
+    # xlsx 为 zip 格式，需要可以随机读取的文件，超过该大小时写入磁盘临时文件
+    SPOOLED_MAX_SIZE = 1024 * 1024 * 10
 
-    def generate_rows(self, stream_data):
-        try:
-            workbook = pyexcel.get_book(file_type='xlsx', file_content=stream_data)
-        except Exception as e:
-            raise Exception(_('Invalid excel file {}').format(str(e)))
-        # 默认获取第一个工作表sheet
-        sheet = workbook.sheet_by_index(0)
-        rows = sheet.rows()
-        return rows
+    def generate_rows(self, stream):
+        with SpooledTemporaryFile(max_size=self.SPOOLED_MAX_SIZE) as file:
+            for chunk in self.iter_stream_chunks(stream):
+                file.write(chunk)
+            file.seek(0)
+            try:
+                workbook = load_workbook(file, read_only=True, data_only=True)
+            except Exception as e:
+                raise Exception(_('Invalid excel file {}').format(str(e)))
+            try:
+                # 默认获取第一个工作表sheet，只读模式下逐行读取，不加载整个工作表
+                sheet = workbook.worksheets[0]
+                for row in sheet.iter_rows(values_only=True):
+                    yield ['' if value is None else value for value in row]
+            finally:
+                workbook.close()
@@ -244,9 +244,45 @@ class BaseFileRenderer(BaseRenderer):
     def get_rendered_value(self):
         raise NotImplementedError
 
+    def iter_rendered_value(self, finished=False):
+        """
+        流式渲染时返回当前可以输出的内容，finished 为 True 时所有数据已经写入
+        """
+        raise NotImplementedError
+
     def after_render(self):
         pass
 
+    def initial_render(self, request, response, view):
+        self.template = request.query_params.get('template', 'export')
+        self.serializer = view.get_serializer()
+        self.set_response_disposition(response)
+
+    def stream_render(self, data_chunks, request, response, view):
+        """
+        流式渲染导出数据，data_chunks 为序列化之后的数据块迭代器，每渲染一块数据返回一次内容
+        渲染失败时直接抛出异常中断下载，不能把错误信息写入文件，否则下载看起来成功但文件已损坏
+        """
+        self.initial_render(request, response, view)
+        rendered_fields = self.get_rendered_fields()
+        self.initial_writer()
+        self.write_column_titles(self.get_column_titles(rendered_fields))
+        self.write_help_text_if_need()
+
+        def stream():
+            try:
+                yield from self.iter_rendered_value()
+                for data in data_chunks:
+                    self.write_rows(self.generate_rows(self.process_data(data), rendered_fields))
+                    yield from self.iter_rendered_value()
+                self.after_render()
+                yield from self.iter_rendered_value(finished=True)
+            except Exception as e:
+                logger.error(f"stream render failed. media:{self.media_type} error:{e}", exc_info=True)
+                raise
+
+        return stream()
+
     def render(self, data, accepted_media_type=None, renderer_context=None):
         if data is None:
             return bytes()
@@ -259,11 +295,11 @@ class BaseFileRenderer(BaseRenderer):
             request = renderer_context['request']
             response = renderer_context['response']
             view = renderer_context['view']
-            self.template = request.query_params.get('template', 'export')
-            self.serializer = view.get_serializer()
-            self.set_response_disposition(response)
+            self.initial_render(request, response, view)
         except Exception as e:
             logger.debug(e, exc_info=True)
+            if renderer_context.get('response') is not None:
+                renderer_context['response'].render_error = e
             value = f'The resource not support export! error:{e}'.encode('utf-8')
             return value
 
@@ -283,6 +319,8 @@ class BaseFileRenderer(BaseRenderer):
                 value = self.compress_into_zip_file(value, request, response)
         except Exception as e:
             logger.debug(e, exc_info=True)
+            # 记录渲染异常，后台导出任务据此判断导出失败，不保存错误文件
+            response.render_error = e
             value = f'Render error! media:{self.media_type} \r\nerror:\r\n{e}'.encode('utf-8')
             response['Content-Disposition'] = response['Content-Disposition'].replace(self.format, 'txt')
             return value
@@ -40,3 +40,10 @@ class CSVFileRenderer(BaseFileRenderer):
     def get_rendered_value(self):
         value = self.buffer.getvalue()
         return value
+
+    def iter_rendered_value(self, finished=False):
+        value = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        if value:
+            yield value
@@ -1,12 +1,13 @@
 import json
-import os
-from tempfile import NamedTemporaryFile, mktemp
+from tempfile import SpooledTemporaryFile
 
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 from openpyxl.utils import get_column_letter, quote_sheetname
 from openpyxl.worksheet.datavalidation import DataValidation
-from openpyxl.worksheet.table import Table, TableStyleInfo
+from openpyxl.worksheet.filters import AutoFilter
+from openpyxl.worksheet.table import Table, TableStyleInfo, TableColumn
 from rest_framework import serializers
 from rest_framework.utils import encoders
 
@@ -21,22 +22,84 @@ class ExcelFileRenderer(BaseFileRenderer):
     wb = None
     ws = None
     row_count = 0
+    column_count = 0
+    column_titles = None
+    write_only = False
+    sample_rows = None
+    # 导出时使用只写模式，列宽根据前 sample_size 行数据计算
+    sample_size = 100
+    # 生成的文件超过该大小时写入磁盘，单位字节
+    spooled_max_size = 1024 * 1024 * 10
+    chunk_size = 1024 * 64
 
     def initial_writer(self):
-        self.wb = Workbook()
-        self.ws = self.wb.active
+        # 导入、更新模板需要随机写入单元格添加数据验证，数据量很小，使用普通模式
+        self.write_only = self.template == 'export'
+        self.row_count = 0
+        self.column_count = 0
+        if self.write_only:
+            self.wb = Workbook(write_only=True)
+            self.ws = self.wb.create_sheet()
+            self.ws.sheet_format.defaultRowHeight = 20
+            self.ws.sheet_format.customHeight = True
+            self.sample_rows = []
+        else:
+            self.wb = Workbook()
+            self.ws = self.wb.active
+
+    @staticmethod
+    def clean_value(cell_value):
+        # 处理非法字符
+        return ILLEGAL_CHARACTERS_RE.sub(r'', str(cell_value))
 
     def write_row(self, row):
         self.row_count += 1
+        self.column_count = max(self.column_count, len(row))
+        if self.write_only:
+            row = [self.clean_value(cell_value) for cell_value in row]
+            if self.row_count == 1:
+                self.column_titles = row
+            if self.sample_rows is not None:
+                self.sample_rows.append(row)
+                if len(self.sample_rows) > self.sample_size:
+                    self.write_sample_rows()
+                return
+            self.append_row(row)
+            return
         self.ws.row_dimensions[self.row_count].height = 20
         column_count = 0
         for cell_value in row:
-            # 处理非法字符
             column_count += 1
-            cell_value = ILLEGAL_CHARACTERS_RE.sub(r'', str(cell_value))
-            cell = self.ws.cell(row=self.row_count, column=column_count, value=str(cell_value))
+            cell = self.ws.cell(row=self.row_count, column=column_count, value=self.clean_value(cell_value))
+            # 设置单元格格式为纯文本, 防止执行公式
+            cell.data_type = 's'
+
+    def append_row(self, row):
+        cells = []
+        for cell_value in row:
+            cell = WriteOnlyCell(self.ws, value=cell_value)
             # 设置单元格格式为纯文本, 防止执行公式
             cell.data_type = 's'
+            cells.append(cell)
+        self.ws.append(cells)
+
+    @staticmethod
+    def get_column_width(max_length):
+        adjusted_width = (max_length + 2) * 1.0
+        adjusted_width = 300 if adjusted_width > 300 else adjusted_width
+        adjusted_width = 30 if adjusted_width < 30 else adjusted_width
+        return adjusted_width
+
+    def write_sample_rows(self):
+        """
+        只写模式下列宽必须在写入数据之前设置，使用缓存的前几行数据计算列宽
+        """
+        sample_rows, self.sample_rows = self.sample_rows, None
+        for index in range(self.column_count):
+            max_length = max([len(row[index]) for row in sample_rows if index < len(row)] or [0])
+            self.ws.column_dimensions[get_column_letter(index + 1)].width = self.get_column_width(max_length)
+        for row in sample_rows:
+            self.append_row(row)
 
     def format_values(self, data, related=False):
         result = []
@@ -82,20 +145,18 @@ class ExcelFileRenderer(BaseFileRenderer):
                 w_data[f"{get_column_letter(index + 1)}{inx + 2}"] = ele
 
     def after_render(self):
-        count = 0
-        for col in self.ws.columns:
-            max_length = 0
-            count += 1
-            column = col[0].column_letter
-            for cell in col:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(cell.value)
-            adjusted_width = (max_length + 2) * 1.0
-            adjusted_width = 300 if adjusted_width > 300 else adjusted_width
-            adjusted_width = 30 if adjusted_width < 30 else adjusted_width
-            self.ws.column_dimensions[column].width = adjusted_width
-
-        #         self.wb.save('/tmp/test.xlsx')
+        count = self.column_count
+        if self.write_only:
+            if self.sample_rows is not None:
+                self.write_sample_rows()
+        else:
+            for col in self.ws.columns:
+                max_length = 0
+                column = col[0].column_letter
+                for cell in col:
+                    if len(str(cell.value)) > max_length:
+                        max_length = len(cell.value)
+                self.ws.column_dimensions[column].width = self.get_column_width(max_length)
 
         if count:
             row = get_column_letter(count)
@@ -108,19 +169,32 @@ class ExcelFileRenderer(BaseFileRenderer):
                 showColumnStripes=True,
             )
             tab.tableStyleInfo = style
-            self.ws.add_table(tab)
+            if self.write_only:
+                # 只写模式无法读取表头单元格，需要手动设置表格列
+                tab.tableColumns = [TableColumn(id=index + 1, name=title) for index, title in
+                                    enumerate(self.column_titles)]
+                tab.autoFilter = AutoFilter(ref=tab.ref)
+                self.ws.tables.add(tab)
+            else:
+                self.ws.add_table(tab)
+
+    def save_to_spooled_file(self):
+        tmp = SpooledTemporaryFile(max_size=self.spooled_max_size)
+        self.wb.save(tmp)
+        tmp.seek(0)
+        return tmp
 
     def get_rendered_value(self):
-        if os.name == 'nt':
-            ## 针对 windows 平台，解决 NamedTemporaryFile 方法 权限异常
-            tmp_name = mktemp()
-            self.wb.save(tmp_name)
-            with open(tmp_name, 'rb') as tmp:
-                value = tmp.read()
-            os.unlink(tmp_name)
-            return value
-        else:
-            with NamedTemporaryFile() as tmp:
-                self.wb.save(tmp.name)
-                tmp.seek(0)
-                return tmp.read()
+        with self.save_to_spooled_file() as tmp:
+            return tmp.read()
+
+    def iter_rendered_value(self, finished=False):
+        # 只写模式下数据行写入 openpyxl 的临时文件，所有数据写入之后才能生成 xlsx 文件
+        if not finished:
+            return
+        with self.save_to_spooled_file() as tmp:
+            while True:
+                value = tmp.read(self.chunk_size)
+                if not value:
+                    break
+                yield value
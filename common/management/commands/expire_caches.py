@@ -1,19 +1,81 @@
-from django.core.management.base import BaseCommand
+import re
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
 
 from common.cache.storage import RedisCacheBase
 
+# key 中的用户id，uuid，md5等部分，统计内存时按照这些部分之前的前缀进行分组
+ID_PART_RE = re.compile(r'_(?:\d+|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{32,})(?=_|$)')
+
+
+def get_key_namespace(key):
+    return ID_PART_RE.split(key, maxsplit=1)[0]
+
 
 class Command(BaseCommand):
     help = 'Expire Caches'
 
     def add_arguments(self, parser):
         parser.add_argument(
-            "args", metavar="cache key", nargs="+", help="please input cache key or '*' for delete all keys"
+            "args", metavar="cache key", nargs="*", help="please input cache key or '*' for delete all keys"
+        )
+        parser.add_argument(
+            "--report", action="store_true", help="report cache memory usage by namespace, do not delete keys"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000, help="scan and memory usage batch size for report"
         )
 
     def handle(self, *args, **options):
+        if options.get('report'):
+            return self.report(args or ['*'], options.get('batch_size'))
+        if not args:
+            raise CommandError("please input cache key or '*' for delete all keys")
         for key in args:
             if key.endswith("*"):
                 RedisCacheBase(key).del_many()
             else:
                 RedisCacheBase(key).del_storage_cache()
+
+    def report(self, patterns, batch_size):
+        client = cache.client.get_client()
+        stats = defaultdict(lambda: [0, 0])
+
+        def collect(raw_keys):
+            with client.pipeline(transaction=False) as pipe:
+                for raw_key in raw_keys:
+                    pipe.memory_usage(raw_key)
+                usages = pipe.execute()
+            for raw_key, usage in zip(raw_keys, usages):
+                key = cache.client.reverse_key(raw_key.decode('utf-8'))
+                stat = stats[get_key_namespace(key)]
+                stat[0] += 1
+                stat[1] += usage or 0
+
+        for pattern in patterns:
+            raw_keys = []
+            for raw_key in client.scan_iter(match=cache.client.make_pattern(pattern), count=batch_size):
+                raw_keys.append(raw_key)
+                if len(raw_keys) >= batch_size:
+                    collect(raw_keys)
+                    raw_keys = []
+            if raw_keys:
+                collect(raw_keys)
+
+        total_count = total_size = 0
+        self.stdout.write(f"{'namespace':<60} {'keys':>10} {'memory':>14}")
+        for namespace, (count, size) in sorted(stats.items(), key=lambda x: x[1][1], reverse=True):
+            total_count += count
+            total_size += size
+            self.stdout.write(f"{namespace:<60} {count:>10} {self.format_size(size):>14}")
+        self.stdout.write(f"{'total':<60} {total_count:>10} {self.format_size(total_size):>14}")
+
+    @staticmethod
+    def format_size(size):
+        for unit in ['B', 'KB', 'MB', 'GB']:
+            if size < 1024:
+                return f"{size:.1f}{unit}"
+            size /= 1024
+        return f"{size:.1f}TB"
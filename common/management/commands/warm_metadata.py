@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import translation
+
+from common.core.registry import warm_metadata, metadata_registry
+
+
+class Command(BaseCommand):
+    help = 'Warm or verify search-fields and search-columns metadata'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify", action="store_true", help="build metadata twice and report viewsets with unstable metadata"
+        )
+        parser.add_argument(
+            "--language", action="append", help="languages to build, default settings.LANGUAGE_CODE"
+        )
+
+    def handle(self, *args, **options):
+        languages = options.get('language') or [settings.LANGUAGE_CODE]
+        errors = []
+        for language in languages:
+            with translation.override(language):
+                for route, action, error in warm_metadata(verify=options.get('verify')):
+                    errors.append((language, route, action, error))
+
+        for language, route, action, error in errors:
+            self.stderr.write(f"[{language}] {route} {action}: {error}")
+        self.stdout.write(f"metadata registry: {len(metadata_registry.keys())} entries, {len(errors)} errors")
+        if errors and options.get('verify'):
+            raise CommandError("metadata verify failed")
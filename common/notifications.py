@@ -155,6 +155,17 @@ class ImportDataMessage(TaskMessage, UserMessage):
         self.subject = _('Import {} data {} message').format(self.task.get("view_doc"), self.task.get("status"))
 
 
+class ExportDataMessage(TaskMessage, UserMessage):
+    category = 'Task Message'
+    category_label = _('Task Message')
+    message_type_label = _('Export data message')
+
+    def __init__(self, user, task):
+        super().__init__(user)
+        self.task = task
+        self.subject = _('Export {} data {} message').format(self.task.get("view_doc"), self.task.get("status"))
+
+
 class BatchDeleteDataMessage(TaskMessage, UserMessage):
     category = 'Task Message'
     category_label = _('Task Message')
@@ -16,6 +16,7 @@ from django.core.signals import request_finished
 from django.db import connection
 from django.db.models.signals import pre_delete, pre_save
 from django.dispatch import receiver
+from django.utils import translation
 from django_celery_beat.models import PeriodicTask
 from django_celery_results.models import TaskResult
 
@@ -23,6 +24,8 @@ from common.base.utils import remove_file
 from common.celery.decorator import get_after_app_ready_tasks, get_after_app_shutdown_clean_tasks
 from common.celery.logger import CeleryThreadTaskFileHandler
 from common.celery.utils import get_celery_task_log_path
+from common.core.registry import warm_metadata
+from common.signals import django_ready
 from common.utils import get_logger
 from server.utils import get_current_request
 
@@ -59,6 +62,15 @@ def after_app_shutdown_periodic_tasks(sender=None, **kwargs):
     PeriodicTask.objects.filter(name__in=tasks).delete()
 
 
+@receiver(django_ready)
+def on_django_ready_warm_metadata(sender, **kwargs):
+    if not settings.METADATA_REGISTRY_WARMUP:
+        return
+    with translation.override(settings.LANGUAGE_CODE):
+        errors = warm_metadata()
+    logger.debug(f"Warm metadata registry finished, {len(errors)} errors")
+
+
 @receiver(pre_delete, sender=TaskResult)
 def delete_file_handler(sender, **kwargs):
     # 清理任务记录，同时并清理日志文件
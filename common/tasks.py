@@ -6,11 +6,14 @@
 # date : 7/30/2024
 import datetime
 import os
+import re
 from io import BytesIO
+from tempfile import TemporaryFile
 
 from celery import shared_task
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.core.files import File
 from django.core.handlers.wsgi import WSGIRequest
 from django.core.mail import send_mail, EmailMultiAlternatives, get_connection
 from django.utils import timezone, translation
@@ -22,10 +25,14 @@ from common.cache.redis import CacheList
 from common.celery.decorator import register_as_period_task, after_app_ready_start
 from common.celery.utils import delete_celery_periodic_task, disable_celery_periodic_task, get_celery_periodic_task, \
     create_or_update_celery_periodic_tasks
+from common.fields.utils import get_file_absolute_uri
 from common.models import Monitor
-from common.notifications import ServerPerformanceCheckUtil, ImportDataMessage, BatchDeleteDataMessage
+from common.notifications import ServerPerformanceCheckUtil, ImportDataMessage, BatchDeleteDataMessage, \
+    ExportDataMessage
 from common.utils.timezone import local_now_display
+from message.utils import push_message
 from server.celery import app
+from system.models import UploadFile
 
 logger = get_task_logger(__name__)
 
@@ -137,9 +144,61 @@ def check_server_performance_period():
     ServerPerformanceCheckUtil().check_and_publish()
 
 
+def get_view_task_cache(meta: dict):
+    return CacheList(f"view_task_{meta.get('task_id').split('_')[0]}", timeout=3600 * 24)
+
+
+def push_view_task_error(meta: dict, task_index, error):
+    """
+    分批添加任务的过程中出错时，已添加的任务无法撤回，将错误作为一个失败的批次写入任务结果，已添加的任务完成后正常发送通知
+    """
+    now = local_now_display()
+    get_view_task_cache(meta).push({
+        "start_time": now,
+        "task_id": f"{meta.get('task_id').split('_')[0]}_{task_index}",
+        "task_index": task_index,
+        "result": error,
+        "end_time": now,
+        "status": False
+    })
+
+
+def publish_view_task_result(view: str, meta: dict, user, task_count=None):
+    """
+    所有批次任务执行完成后发送通知
+    数据流式分批时，分批完成后才能确定任务数量，由分批方写入任务数量并检查一次，之后每个批次任务完成时再检查
+    """
+    cache = get_view_task_cache(meta)
+    count_key = f"{cache.key}_count"
+    with cache.lock(timeout=180):
+        if task_count is not None:
+            cache.connect.set(count_key, task_count, ex=cache.timeout)
+        else:
+            task_count = cache.connect.get(count_key)
+        if not task_count or cache.len() != int(task_count):
+            return
+        task_results = cache.get_all()
+        cache.delete()
+        cache.connect.delete(count_key)
+    state = all([task["status"] for task in task_results])
+    task_info = {
+        "task_name": view,
+        "view_doc": import_string(view).__doc__,
+        "state": state,
+        "status": _("Operation successful") if state else _("Operation failed"),
+        "tasks": sorted(task_results, key=lambda task: task["task_index"])
+    }
+    match meta["action"]:
+        case "import_data":
+            ImportDataMessage(user, task_info).publish()
+        case "batch_destroy":
+            BatchDeleteDataMessage(user, task_info).publish()
+    return task_info
+
+
 @shared_task(verbose_name=_("Run background task view set"))
 def background_task_view_set_job(view: str, meta: dict, data: str, action_map: dict):
-    cache = CacheList(f"view_task_{meta.get("task_id").split("_")[0]}", timeout=3600 * 24)
+    cache = get_view_task_cache(meta)
     task_info = {
         "start_time": local_now_display(),
         "task_id": meta.get("task_id"),
@@ -156,25 +215,87 @@ def background_task_view_set_job(view: str, meta: dict, data: str, action_map: d
     request.LANGUAGE_CODE = translation.get_language()
     result = view_func.as_view(action_map)(request, task=False)
     task_info["result"] = result.data.get("detail", result.data)
+    if result.data.get("errors"):
+        task_info["errors"] = result.data.get("errors")
     task_info["end_time"] = local_now_display()
     task_info["status"] = result.data.get("code") == 1000
     cache.push(task_info)
-    with cache.lock(timeout=180):
-        if cache.len() and cache.len() == meta["task_count"]:
-            task_results = cache.get_all()
-            cache.delete()
-            state = all([task["status"] for task in task_results])
-            task_info = {
-                "task_name": view,
-                "view_doc": view_func.__doc__,
-                "state": state,
-                "status": _("Operation successful") if state else _("Operation failed"),
-                "tasks": sorted(task_results, key=lambda task: task["task_index"])
-            }
-            match meta["action"]:
-                case "import_data":
-                    ImportDataMessage(getattr(request, "user"), task_info).publish()
-                case "batch_destroy":
-                    BatchDeleteDataMessage(getattr(request, "user"), task_info).publish()
+    return publish_view_task_result(view, meta, getattr(request, "user")) or task_info
 
+
+def save_export_response_file(request, response):
+    """
+    将导出视图的响应内容写入临时文件，并保存为临时上传文件，临时文件由定时任务自动清理
+    渲染失败时抛出异常，流式导出的异常在读取内容时抛出，不会保存错误文件
+    """
+    if response.status_code != 200 or not response.has_header('Content-Disposition'):
+        data = getattr(response, 'data', None) or {}
+        raise ValueError(data.get('detail', data) if isinstance(data, dict) else data)
+    if getattr(response, 'streaming', False):
+        chunks = response.streaming_content
+    else:
+        if not getattr(response, 'is_rendered', True):
+            response.render()
+        chunks = [response.content]
+        if getattr(response, 'render_error', None) is not None:
+            raise ValueError(f"render failed. error:{response.render_error}")
+    filename = re.search(r'filename="([^"]+)"', response['Content-Disposition']).group(1)
+    with TemporaryFile() as tmp:
+        for chunk in chunks:
+            tmp.write(chunk)
+        filesize = tmp.tell()
+        tmp.seek(0)
+        return UploadFile.objects.create(creator=request.user, filename=filename, is_tmp=True, filesize=filesize,
+                                         filepath=File(tmp, name=filename), mime_type=response['Content-Type'])
+
+
+@shared_task(verbose_name=_("Run background export view set"))
+def background_task_export_view_set_job(view: str, meta: dict, action_map: dict):
+    task_info = {
+        "start_time": local_now_display(),
+        "task_id": meta.get("task_id"),
+        "task_index": 0
+    }
+    view_func = import_string(view)
+    meta["wsgi.input"] = BytesIO(b"")
+    meta["CONTENT_LENGTH"] = 0
+    request = WSGIRequest(meta)
+    language = translation.get_language_from_request(request)
+    translation.activate(language)
+    request.LANGUAGE_CODE = translation.get_language()
+
+    def progress(count, total):
+        # 通过 websocket 推送导出进度
+        push_message(request.user.pk, {
+            'title': str(_('Export {} data').format(view_func.__doc__)),
+            'message': f"{count}/{total}",
+            'level': 'info',
+            'message_type': 'task_progress',
+            'task_id': task_info["task_id"],
+            'count': count,
+            'total': total,
+        })
+
+    result = view_func.as_view(action_map)(request, task=False, progress=progress)
+    try:
+        upload_file = save_export_response_file(request, result)
+        task_info["result"] = _("Operation successful")
+        task_info["filename"] = upload_file.filename
+        task_info["download_url"] = get_file_absolute_uri(upload_file.filepath, request)
+        task_info["status"] = True
+    except Exception as e:
+        logger.error(f"export {view} data failed. Exception:{e}")
+        task_info["result"] = str(e)
+        task_info["status"] = False
+    finally:
+        result.close()
+    task_info["end_time"] = local_now_display()
+    state = task_info["status"]
+    ExportDataMessage(getattr(request, "user"), {
+        "task_name": view,
+        "view_doc": view_func.__doc__,
+        "state": state,
+        "status": _("Operation successful") if state else _("Operation failed"),
+        "tasks": [task_info]
+    }).publish()
     return task_info
@@ -6,7 +6,7 @@
 # date : 6/6/2023
 from django.urls import re_path
 
-from common.api.common import ResourcesIDCacheAPIView, CountryListAPIView, HealthCheckAPIView
+from common.api.common import ResourcesIDCacheAPIView, CountryListAPIView, HealthCheckAPIView, MetricsAPIView
 
 app_name = "common"
 
@@ -14,4 +14,5 @@ urlpatterns = [
     re_path('^resources/cache$', ResourcesIDCacheAPIView.as_view(), name='resources-cache'),
     re_path('^countries$', CountryListAPIView.as_view(), name='countries'),
     re_path('^api/health', HealthCheckAPIView.as_view(), name='health'),
+    re_path('^api/metrics$', MetricsAPIView.as_view(), name='metrics'),
 ]
@@ -1,5 +1,5 @@
-import ipaddress
 import socket
+from functools import lru_cache
 from ipaddress import ip_network, ip_address
 
 from django.conf import settings
@@ -38,11 +38,43 @@ def is_ip_segment(ip):
 
 
 def in_ip_segment(ip, ip_segment):
-    ip1, ip2 = ip_segment.split('-')
-    ip1 = int(ip_address(ip1))
-    ip2 = int(ip_address(ip2))
-    ip = int(ip_address(ip))
-    return min(ip1, ip2) <= ip <= max(ip1, ip2)
+    ip_range = get_ip_range(ip_segment)
+    return ip_range is not None and in_ip_range(ip, ip_range)
+
+
+@lru_cache(maxsize=1024)
+def get_ip_range(ip_rule):
+    """
+    将 CIDR 或者 IP 段规则解析为整数区间 (version, start, end)，不是区间规则返回 None
+    192.168.1.0/24 -> (4, 3232235776, 3232236031)
+    10.1.1.1-10.1.1.20 -> (4, 167837953, 167837972)
+    """
+    if not isinstance(ip_rule, str):
+        return None
+    ip_rule = ip_rule.strip()
+    try:
+        if '/' in ip_rule:
+            network = ip_network(ip_rule)
+            return network.version, int(network.network_address), int(network.broadcast_address)
+        if '-' in ip_rule:
+            start_ip, end_ip = ip_rule.split('-')
+            start_ip, end_ip = ip_address(start_ip.strip()), ip_address(end_ip.strip())
+            if start_ip.version != end_ip.version:
+                return None
+            start, end = sorted([int(start_ip), int(end_ip)])
+            return start_ip.version, start, end
+    except ValueError:
+        pass
+    return None
+
+
+def in_ip_range(ip, ip_range):
+    version, start, end = ip_range
+    try:
+        ip = ip_address(ip)
+    except ValueError:
+        return False
+    return ip.version == version and start <= int(ip) <= end
 
 
 def contains_ip(ip, ip_group):
@@ -56,17 +88,10 @@ def contains_ip(ip, ip_group):
         return True
 
     for _ip in ip_group:
-        if is_ip_address(_ip):
-            # 192.168.10.1
-            if ip == _ip:
-                return True
-        elif is_ip_network(_ip) and is_ip_address(ip):
-            # 192.168.1.0/24
-            if ip_address(ip) in ip_network(_ip):
-                return True
-        elif is_ip_segment(_ip) and is_ip_address(ip):
-            # 10.1.1.1-10.1.1.20
-            if in_ip_segment(ip, _ip):
+        ip_range = get_ip_range(_ip)
+        if ip_range is not None:
+            # 192.168.1.0/24 or 10.1.1.1-10.1.1.20
+            if in_ip_range(ip, ip_range):
                 return True
         else:
             # address / host
@@ -79,14 +104,9 @@ def contains_ip(ip, ip_group):
 def is_ip(ip, rule_value):
     if rule_value == '*':
         return True
-    elif '/' in rule_value:
-        network = ipaddress.ip_network(rule_value)
-        return ip in network.hosts()
-    elif '-' in rule_value:
-        start_ip, end_ip = rule_value.split('-')
-        start_ip = ipaddress.ip_address(start_ip)
-        end_ip = ipaddress.ip_address(end_ip)
-        return start_ip <= ip <= end_ip
+    elif '/' in rule_value or '-' in rule_value:
+        ip_range = get_ip_range(rule_value)
+        return ip_range is not None and in_ip_range(ip, ip_range)
     elif len(rule_value.split('.')) == 4:
         return ip == rule_value
     else:
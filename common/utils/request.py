@@ -69,6 +69,9 @@ def get_request_data(request):
     if request.META.get('CONTENT_TYPE', '').startswith("multipart/"):
         # 避免字段检查直接报错，axios中form-data数据字段和json字段不统一
         return 'multipart/form-data'
+    if request.META.get('CONTENT_TYPE', '').startswith(("text/csv", "text/xlsx")):
+        # 导入文件在视图中流式解析，不能读取 body
+        return request.META.get('CONTENT_TYPE')
     data: dict = {**request.GET.dict(), **request.POST.dict()}
     if not data:
         try:
@@ -57,8 +57,8 @@ class BookSerializer(BaseModelSerializer):
     # # { "pk": 2, "username": "admin", "label": "admin(2)" }
     # # attrs 变量，表示展示的字段，有 pk,username 字段， 且 pk 字段是必须的， 比如 'attrs': ['pk']
     # # format 变量，表示label字段展示内容，里面的字段一定是属于 attrs 定义的字段，写错的话，可能会报错
-    # # queryset 变量， 表示数据查询对象集合，注意：search-columns 方法中，该字段会有个 choices 变量，并且包含所有queryset数据，
-    # #      如果数据量特别大的时候，一定要自定义 input_type， 否则会有问题
+    # # queryset 变量， 表示数据查询对象集合，注意：search-columns 方法中，该字段的 choices 变量为 []，并且会有个 related 变量，
+    # #      前端通过 related 中的 url 和 field 参数请求 related-choices 分页搜索queryset数据
     # # input_type 变量， 自定义，如果存在，前端解析定义的类型 api-search-user ，并且 search-columns 方法中，choices变量为 []
     # #      如果数据量特别大的时候，推荐这种写法
     # # 目前，可以注释了，在父类里面，已经定义了 serializer_related_field 字段， 建议写到 extra_kwargs 里面，使用系统会自动生成
@@ -33,9 +33,10 @@ class SiteMessageUtil:
             fields=['pk', 'level', 'title', 'notice_type', 'message'],
             instance=notify_obj, ignore_field_permission=True).data
         notice_message['message_type'] = 'notify_message'
-        online_pks = get_online_user_pks()  # 仅推送在线用户
-        for pk in set(pks) & online_pks:
-            if UserConfig(pk).PUSH_MESSAGE_NOTICE:
+        online_pks = set(pks) & get_online_user_pks()  # 仅推送在线用户
+        configs = UserConfig.get_many(['PUSH_MESSAGE_NOTICE'], online_pks, {'PUSH_MESSAGE_NOTICE': True})
+        for pk in online_pks:
+            if configs[pk]['PUSH_MESSAGE_NOTICE']:
                 push_message(pk, notice_message)
         return notify_obj
 
@@ -13,6 +13,7 @@ from rest_framework.decorators import action
 
 from common.core.filter import BaseFilterSet, PkMultipleFilter
 from common.core.modelset import BaseModelSet, ListDeleteModelSet
+from common.core.pagination import KeysetPageNumber
 from common.core.response import ApiResponse
 from common.swagger.utils import get_default_response_schema
 from notifications.models import MessageContent, MessageUserRead
@@ -33,6 +34,7 @@ class NoticeMessageViewSet(BaseModelSet):
     """消息通知"""
     queryset = MessageContent.objects.all()
     serializer_class = NoticeMessageSerializer
+    pagination_class = KeysetPageNumber
 
     ordering_fields = ['updated_time', 'created_time']
     filterset_class = NoticeMessageFilter
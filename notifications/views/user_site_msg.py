@@ -17,6 +17,7 @@ from rest_framework.filters import OrderingFilter
 
 from common.core.filter import BaseFilterSet
 from common.core.modelset import OnlyListModelSet, CacheListResponseMixin
+from common.core.pagination import KeysetPageNumber
 from common.core.response import ApiResponse
 from common.swagger.utils import get_default_response_schema
 from notifications.models import MessageContent, MessageUserRead
@@ -63,6 +64,7 @@ class UserSiteMessageViewSet(OnlyListModelSet, CacheListResponseMixin):
     """用户消息中心"""
     queryset = MessageContent.objects.filter(publish=True).all().distinct()
     serializer_class = UserNoticeSerializer
+    pagination_class = KeysetPageNumber
     filter_backends = [filters.DjangoFilterBackend, OrderingFilter]
     ordering_fields = ['created_time']
     filterset_class = UserSiteMessageViewSetFilter
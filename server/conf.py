@@ -42,6 +42,7 @@ class Config(dict):
         'SECRET_KEY': '',
         'DEBUG': False,
         'DEBUG_DEV': False,
+        'QUERY_PLAN_DEBUG_ASSERT': False,  # 列表接口序列化的查询次数随分页数量增长时报错，用于开发时发现 N+1 查询
         'LOG_LEVEL': "WARNING",
         'XADMIN_APPS': [],
         # 表前缀 abc_
@@ -134,7 +135,14 @@ class Config(dict):
         'PERMISSION_FIELD_ENABLED': True,  # 字段权限控制
         'PERMISSION_DATA_ENABLED': True,  # 数据权限控制
         'REFERER_CHECK_ENABLED': False,  # referer 校验
+        'PAGINATION_COUNT_ESTIMATE_THRESHOLD': 10000,  # 分页估算总数时，估算结果小于该值则精确统计
+        'PAGINATION_COUNT_CACHE_TTL': 60,  # 分页缓存总数时，缓存时间，单位秒
+        'RELATED_CHOICES_CACHE_TTL': 60,  # 关联字段可选数据的缓存时间，单位秒
+        'METADATA_REGISTRY_WARMUP': False,  # 启动时预先计算 search-fields 和 search-columns 的静态数据，否则第一次请求时计算
         'EXPORT_MAX_LIMIT': 20000,  # 限制导出数据数量
+        'EXPORT_CHUNK_SIZE': 1000,  # 流式导出时，每次从数据库读取并序列化的数据数量
+        'IMPORT_BATCH_SIZE': 500,  # 导入数据时，每批次校验和写入数据库的数据数量
+        'IMPORT_FILE_MAX_LENGTH': 1024 * 1024 * 200,  # 导入文件最大长度，文件流式解析，内存占用和文件大小无关
         # 验证码配置
         'VERIFY_CODE_TTL': 5 * 60,  # Unit: second
         'VERIFY_CODE_LIMIT': 60,
@@ -181,10 +189,20 @@ class Config(dict):
             '/api/common/api/health': ['GET'],
         },
         'API_LOG_METHODS': ["POST", "DELETE", "PUT", "PATCH"],
+        # 操作日志异步批量写入，队列最大长度，每批写入条数，最长写入间隔，单位秒
+        'API_LOG_QUEUE_SIZE': 10000,
+        'API_LOG_BATCH_SIZE': 100,
+        'API_LOG_FLUSH_INTERVAL': 2,
         'API_MODEL_MAP': {
             "/api/system/refresh": "Token刷新",
             "/api/flower": "定时任务",
-        }
+        },
+        # 进程内一级缓存，最大缓存条数和最长缓存时间，单位秒
+        'MAGIC_CACHE_LOCAL_MAX_SIZE': 4096,
+        'MAGIC_CACHE_LOCAL_TIMEOUT': 300,
+        # 监控指标，各进程指标增量同步到 redis 的间隔，单位秒
+        'METRICS_ENABLE': True,
+        'METRICS_FLUSH_INTERVAL': 10,
     }
     defaults.update(base)
     defaults.update(libs)
@@ -29,6 +29,28 @@ class SQLCountMiddleware:
         return response
 
 
+class MetricsMiddleware:
+    """
+    记录每个路由的请求耗时，SQL 执行次数和时间，指标定期同步到 redis
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if not settings.METRICS_ENABLE:
+            raise MiddlewareNotUsed
+
+    def __call__(self, request):
+        from django.db import connection
+        from common.base.magic import SQLCounter
+        from common.core.metrics import metrics_registry
+        sql_counter = SQLCounter()
+        start_time = time.perf_counter()
+        with connection.execute_wrapper(sql_counter):
+            response = self.get_response(request)
+        metrics_registry.observe_request(request, response, time.perf_counter() - start_time, sql_counter)
+        return response
+
+
 class StartMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
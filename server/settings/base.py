@@ -23,6 +23,8 @@ SECRET_KEY = CONFIG.SECRET_KEY
 DEBUG = CONFIG.DEBUG
 # SECURITY WARNING: If you run with debug turned on, more debug msg with be log
 DEBUG_DEV = CONFIG.DEBUG_DEV
+# 列表接口序列化的查询次数随分页数量增长时报错，用于开发时发现 N+1 查询
+QUERY_PLAN_DEBUG_ASSERT = CONFIG.QUERY_PLAN_DEBUG_ASSERT
 
 LOG_LEVEL = CONFIG.LOG_LEVEL
 
@@ -84,6 +86,7 @@ if DEBUG or DEBUG_DEV:
 MIDDLEWARE = [
     'server.middleware.StartMiddleware',
     'server.middleware.RequestMiddleware',
+    'server.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -278,7 +281,11 @@ CACHE_KEY_TEMPLATE = {
     'user_websocket_key': 'user_websocket',
     'upload_part_info_key': 'upload_part_info',
     'black_access_token_key': 'black_access_token',
-    'common_resource_ids_key': 'common_resource_ids'
+    'common_resource_ids_key': 'common_resource_ids',
+    'data_permission_rules_key': 'data_permission_rules',
+    'cache_generation_key': 'cache_generation',
+    'metrics_key': 'metrics',
+    'queryset_count_key': 'queryset_count',
 }
 
 APPEND_SLASH = False
@@ -26,6 +26,7 @@ ROUTE_IGNORE_URL = [
     "^/api/.*search-fields$",  # 每个方法都有该路由，则忽略即可
     "^/api/.*search-columns$",  # 该路由使用list权限字段，无需重新配置
     "^/api/settings/.*search-columns$",  # 该路由使用list权限字段，无需重新配置
+    "^/api/.*related-choices$",  # 该路由使用list权限字段，无需重新配置
     "^/api/system/dashboard/",  # 忽略dashboard路由
     "^/api/system/captcha",  # 忽略图片验证码路由
 ]
@@ -48,8 +49,21 @@ PERMISSION_DATA_AUTH_APPS = [
 API_LOG_ENABLE = CONFIG.API_LOG_ENABLE
 API_LOG_METHODS = CONFIG.API_LOG_METHODS  # 'ALL'
 
+# 操作日志异步批量写入配置，队列满时丢弃日志
+API_LOG_QUEUE_SIZE = CONFIG.API_LOG_QUEUE_SIZE
+API_LOG_BATCH_SIZE = CONFIG.API_LOG_BATCH_SIZE
+API_LOG_FLUSH_INTERVAL = CONFIG.API_LOG_FLUSH_INTERVAL
+
 # 忽略日志记录, 支持model 或者 request_path, 不支持正则
 API_LOG_IGNORE = CONFIG.API_LOG_IGNORE
 
 # 在操作日志中详细记录的请求模块映射
 API_MODEL_MAP = CONFIG.API_MODEL_MAP
+
+# 进程内一级缓存配置，缓存失效通过 redis 发布订阅通知
+MAGIC_CACHE_LOCAL_MAX_SIZE = CONFIG.MAGIC_CACHE_LOCAL_MAX_SIZE
+MAGIC_CACHE_LOCAL_TIMEOUT = CONFIG.MAGIC_CACHE_LOCAL_TIMEOUT
+
+# 监控指标配置，指标通过 /api/common/api/metrics 以 prometheus 格式导出
+METRICS_ENABLE = CONFIG.METRICS_ENABLE
+METRICS_FLUSH_INTERVAL = CONFIG.METRICS_FLUSH_INTERVAL
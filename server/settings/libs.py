@@ -123,7 +123,13 @@ CORS_ALLOW_HEADERS = (
     "user-agent",
     "x-csrftoken",
     "x-requested-with",
-    "x-token"
+    "x-token",
+    "if-none-match",
+)
+
+# 缓存接口返回 ETag，前端可通过 If-None-Match 获取 304 响应
+CORS_EXPOSE_HEADERS = (
+    "etag",
 )
 
 # Celery Configuration Options
@@ -76,7 +76,14 @@ FRONT_END_WEB_WATERMARK_ENABLED = CONFIG.FRONT_END_WEB_WATERMARK_ENABLED  # 前
 PERMISSION_FIELD_ENABLED = CONFIG.PERMISSION_FIELD_ENABLED  # 字段权限控制
 PERMISSION_DATA_ENABLED = CONFIG.PERMISSION_DATA_ENABLED  # 数据权限控制
 REFERER_CHECK_ENABLED = CONFIG.REFERER_CHECK_ENABLED  # referer 校验
+PAGINATION_COUNT_ESTIMATE_THRESHOLD = CONFIG.PAGINATION_COUNT_ESTIMATE_THRESHOLD  # 分页估算总数时，估算结果小于该值则精确统计
+PAGINATION_COUNT_CACHE_TTL = CONFIG.PAGINATION_COUNT_CACHE_TTL  # 分页缓存总数时，缓存时间，单位秒
+RELATED_CHOICES_CACHE_TTL = CONFIG.RELATED_CHOICES_CACHE_TTL  # 关联字段可选数据的缓存时间，单位秒
+METADATA_REGISTRY_WARMUP = CONFIG.METADATA_REGISTRY_WARMUP  # 启动时预先计算 search-fields 和 search-columns 的静态数据
 EXPORT_MAX_LIMIT = CONFIG.EXPORT_MAX_LIMIT  # 限制导出数据数量
+EXPORT_CHUNK_SIZE = CONFIG.EXPORT_CHUNK_SIZE  # 流式导出时，每次从数据库读取并序列化的数据数量
+IMPORT_BATCH_SIZE = CONFIG.IMPORT_BATCH_SIZE  # 导入数据时，每批次校验和写入数据库的数据数量
+IMPORT_FILE_MAX_LENGTH = CONFIG.IMPORT_FILE_MAX_LENGTH  # 导入文件最大长度，文件流式解析，内存占用和文件大小无关
 
 # 验证码配置
 VERIFY_CODE_TTL = CONFIG.VERIFY_CODE_TTL  # Unit: second
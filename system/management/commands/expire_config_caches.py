@@ -6,7 +6,7 @@
 # date : 12/25/2023
 from django.core.management.base import BaseCommand
 
-from common.core.config import ConfigCacheBase
+from common.core.config import ConfigCacheBase, UserConfig
 
 
 class Command(BaseCommand):
@@ -17,4 +17,4 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         ConfigCacheBase().invalid_config_cache(options.get('key', '*'))
-        ConfigCacheBase(px='user').invalid_config_cache(options.get('key', '*'))
+        UserConfig('*').invalid_config_cache(options.get('key', '*'))
@@ -37,3 +37,5 @@ class Command(LoadCommand):
         options["exclude"] = []
         options["format"] = "json"
         super(Command, self).handle(*fixture_labels, **options)
+        # loaddata 不会调用 save 方法，需要重建部门闭包表
+        DeptInfoClosure.rebuild()
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_dept_closure(apps, schema_editor):
+    DeptInfo = apps.get_model('system', 'DeptInfo')
+    DeptInfoClosure = apps.get_model('system', 'DeptInfoClosure')
+    parents = dict(DeptInfo.objects.values_list('pk', 'parent_id'))
+    rows = []
+    for pk in parents:
+        ancestor_id, depth, seen = pk, 0, set()
+        while ancestor_id is not None and ancestor_id not in seen:
+            seen.add(ancestor_id)
+            rows.append(DeptInfoClosure(ancestor_id=ancestor_id, descendant_id=pk, depth=depth))
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+    DeptInfoClosure.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('system', '0002_operationlog_exec_time_operationlog_request_uuid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeptInfoClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField(default=0, verbose_name='Depth')),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+',
+                                               to='system.deptinfo', verbose_name='Ancestor department')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+',
+                                                 to='system.deptinfo', verbose_name='Descendant department')),
+            ],
+            options={
+                'verbose_name': 'Department closure',
+                'verbose_name_plural': 'Department closure',
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(build_dept_closure, migrations.RunPython.noop),
+    ]
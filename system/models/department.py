@@ -5,11 +5,8 @@
 # author : ly_13
 # date : 8/10/2024
 
-import json
-
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
-from rest_framework.utils import encoders
 
 from common.core.models import DbAuditModel, DbUuidModel
 from system.models import ModeTypeAbstract
@@ -28,22 +25,60 @@ class DeptInfo(DbAuditModel, ModeTypeAbstract, DbUuidModel):
                                         "If the value of the registration parameter channel is consistent with the department code, the user is automatically bound to the department"))
     is_active = models.BooleanField(verbose_name=_("Is active"), default=True)
 
+    @staticmethod
+    def _format_dept_ids(dept_ids):
+        if isinstance(dept_ids, (list, tuple, set)):
+            return list(dept_ids)
+        return [dept_ids]
+
+    @classmethod
+    def descendant_subquery(cls, dept_ids):
+        """
+        部门及下级部门的子查询，可直接用于 __in 查询
+        """
+        return DeptInfoClosure.objects.filter(ancestor_id__in=cls._format_dept_ids(dept_ids)).values('descendant_id')
+
+    @classmethod
+    def ancestor_subquery(cls, dept_ids):
+        """
+        部门及上级部门的子查询，可直接用于 __in 查询
+        """
+        return DeptInfoClosure.objects.filter(descendant_id__in=cls._format_dept_ids(dept_ids)).values('ancestor_id')
+
     @classmethod
-    def recursion_dept_info(cls, dept_id: int, dept_all_list=None, dept_list=None, is_parent=False):
-        parent = 'parent'
-        pk = 'pk'
+    def get_descendant_pks(cls, dept_ids) -> list:
+        dept_ids = cls._format_dept_ids(dept_ids)
+        pks = cls.descendant_subquery(dept_ids).values_list('descendant_id', flat=True)
+        return list({str(pk) for pk in dept_ids} | {str(pk) for pk in pks})
+
+    @classmethod
+    def get_ancestor_pks(cls, dept_ids) -> list:
+        dept_ids = cls._format_dept_ids(dept_ids)
+        pks = cls.ancestor_subquery(dept_ids).values_list('ancestor_id', flat=True)
+        return list({str(pk) for pk in dept_ids} | {str(pk) for pk in pks})
+
+    @classmethod
+    def recursion_dept_info(cls, dept_id, is_parent=False) -> list:
+        """
+        获取部门及下级部门的id，is_parent 为 True 时，获取部门及上级部门的id
+        """
         if is_parent:
-            parent, pk = pk, parent
-        if not dept_all_list:
-            dept_all_list = DeptInfo.objects.values("pk", "parent")
-        if dept_list is None:
-            dept_list = [dept_id]
-        for dept in dept_all_list:
-            if dept.get(parent) == dept_id:
-                if dept.get(pk):
-                    dept_list.append(dept.get(pk))
-                    cls.recursion_dept_info(dept.get(pk), dept_all_list, dept_list, is_parent)
-        return json.loads(json.dumps(list(set(dept_list)), cls=encoders.JSONEncoder))
+            return cls.get_ancestor_pks(dept_id)
+        return cls.get_descendant_pks(dept_id)
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        old_parent_id = self.parent_id
+        update_fields = kwargs.get('update_fields')
+        if not adding and (update_fields is None or 'parent' in update_fields):
+            old_parent_id = DeptInfo.objects.filter(pk=self.pk).values_list('parent_id', flat=True).first()
+        with transaction.atomic():
+            result = super().save(*args, **kwargs)
+            if adding:
+                DeptInfoClosure.insert_node(self)
+            elif old_parent_id != self.parent_id:
+                DeptInfoClosure.move_node(self)
+        return result
 
     class Meta:
         verbose_name = _("Department")
@@ -52,3 +87,67 @@ class DeptInfo(DbAuditModel, ModeTypeAbstract, DbUuidModel):
 
     def __str__(self):
         return f"{self.name}({self.pk})"
+
+
+class DeptInfoClosure(models.Model):
+    """
+    部门闭包表，保存所有部门的上下级关系，部门新增、移动的时候自动维护
+    """
+    ancestor = models.ForeignKey("system.DeptInfo", on_delete=models.CASCADE, related_name='+',
+                                 verbose_name=_("Ancestor department"))
+    descendant = models.ForeignKey("system.DeptInfo", on_delete=models.CASCADE, related_name='+',
+                                   verbose_name=_("Descendant department"))
+    depth = models.PositiveIntegerField(verbose_name=_("Depth"), default=0)
+
+    class Meta:
+        verbose_name = _("Department closure")
+        verbose_name_plural = verbose_name
+        unique_together = ('ancestor', 'descendant')
+
+    def __str__(self):
+        return f"{self.ancestor_id}-{self.descendant_id}({self.depth})"
+
+    @classmethod
+    def insert_node(cls, dept):
+        rows = [cls(ancestor_id=dept.pk, descendant_id=dept.pk, depth=0)]
+        if dept.parent_id:
+            for ancestor_id, depth in cls.objects.filter(descendant_id=dept.parent_id).values_list('ancestor_id',
+                                                                                                   'depth'):
+                rows.append(cls(ancestor_id=ancestor_id, descendant_id=dept.pk, depth=depth + 1))
+        cls.objects.bulk_create(rows, ignore_conflicts=True)
+
+    @classmethod
+    def move_node(cls, dept):
+        # 先取出子树，避免 mysql 不支持在删除语句中对同一张表进行子查询
+        subtree = list(cls.objects.filter(ancestor_id=dept.pk).values_list('descendant_id', 'depth'))
+        if not subtree:
+            return cls.insert_node(dept)
+        subtree_ids = [descendant_id for descendant_id, _depth in subtree]
+        # 删除原上级部门与子树的关系
+        cls.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+        if not dept.parent_id:
+            return
+        rows = []
+        for ancestor_id, depth in cls.objects.filter(descendant_id=dept.parent_id).values_list('ancestor_id', 'depth'):
+            for descendant_id, sub_depth in subtree:
+                rows.append(cls(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth + sub_depth + 1))
+        cls.objects.bulk_create(rows, batch_size=1000, ignore_conflicts=True)
+
+    @classmethod
+    def rebuild(cls):
+        """
+        根据部门数据重建闭包表，用于初始化数据导入或者批量写入部门之后
+        """
+        parents = dict(DeptInfo.objects.values_list('pk', 'parent_id'))
+        rows = []
+        for pk in parents:
+            ancestor_id, depth, seen = pk, 0, set()
+            while ancestor_id is not None and ancestor_id not in seen:
+                seen.add(ancestor_id)
+                rows.append(cls(ancestor_id=ancestor_id, descendant_id=pk, depth=depth))
+                ancestor_id = parents.get(ancestor_id)
+                depth += 1
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(rows, batch_size=1000)
+        return len(rows)
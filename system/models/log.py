@@ -50,6 +50,8 @@ class UserLoginLog(DbAuditModel):
 
 
 class OperationLog(DbAuditModel):
+    # 日志由后台线程批量写入，创建时间使用请求结束时的时间，auto_now_add 会被写入时间覆盖
+    created_time = models.DateTimeField(default=timezone.now, verbose_name=_("Created time"), null=True, blank=True)
     module = models.CharField(max_length=64, verbose_name=_("Module"), null=True, blank=True)
     path = models.CharField(max_length=400, verbose_name=_("URL path"), null=True, blank=True)
     body = models.TextField(verbose_name=_("Request body"), null=True, blank=True)
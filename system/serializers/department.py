@@ -52,7 +52,7 @@ class DeptSerializer(BaseModelSerializer):
 
     def update(self, instance, validated_data):
         parent = validated_data.get('parent')
-        if parent and str(parent.pk) in DeptInfo.recursion_dept_info(dept_id=instance.pk):
+        if parent and str(parent.pk) in DeptInfo.get_descendant_pks(instance.pk):
             raise ValidationError(_("The superior department cannot be its own subordinate department"))
         return super().update(instance, validated_data)
 
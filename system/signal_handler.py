@@ -7,37 +7,48 @@
 import itertools
 
 from django.contrib.auth import user_logged_out
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 
-from common.base.magic import cache_response, MagicCacheData
-from common.core.config import SysConfig
+from common.base.magic import MagicCacheData
+from common.cache.storage import GenerationCache
+from common.core.config import SysConfig, subscribe_config_invalid
+from common.signals import django_ready
 from common.utils import get_logger
-from system.models import Menu, UserRole, UserInfo, DeptInfo, SystemConfig
+from system.models import Menu, UserRole, UserInfo, DeptInfo, SystemConfig, DataPermission
 from system.signal import invalid_user_cache_signal
 
 logger = get_logger(__name__)
 
 
-def get_cache_data_keys(pks):
-    for pk in pks:
-        for method in ["GET", "PUT", "DELETE", "POST", "PATCH"]:
-            yield f'get_user_permission_{pk}_{method}'
+def batch_invalid_cache(pks, batch_length=1000):
+    """
+    用户相关的权限缓存和路由缓存都记录了用户命名空间版本号，失效时每个用户只需要一次 INCR
+    """
+    for data in itertools.batched(pks, batch_length):
+        MagicCacheData.invalid_generations([f'user_{pk}' for pk in data])
 
 
-def get_cache_response_keys(pks):
-    for pk in pks:
-        yield f'UserRoutesAPIView_get_{pk}'
+@receiver(django_ready)
+def subscribe_magic_cache_invalid(sender, **kwargs):
+    # 缓存版本号变化之后，通过发布订阅通知其他进程清理进程内缓存
+    logger.debug("Start subscribe magic cache invalid")
+    MagicCacheData.subscribe_invalid()
 
 
-def batch_invalid_cache(pks, batch_length=1000):
-    cleans = [
-        (MagicCacheData.invalid_caches, get_cache_data_keys(pks)),
-        (cache_response.invalid_caches, get_cache_response_keys(pks))
-    ]
-    for keys in cleans:
-        for data in itertools.batched(keys[1], batch_length):
-            keys[0](data)
+@receiver(django_ready)
+def subscribe_config_cache_invalid(sender, **kwargs):
+    # 配置缓存失效之后，通知其他进程清理配置快照
+    logger.debug("Start subscribe config cache invalid")
+    subscribe_config_invalid()
+
+
+def invalid_data_permission_cache(user_pk=None):
+    """
+    数据权限编译缓存通过版本号失效，传入 user_pk 仅使该用户的缓存失效
+    """
+    GenerationCache('data_permission' if user_pk is None else f'data_permission_{user_pk}').bump_generation()
+
 
 @receiver([post_save, pre_delete], sender=Menu)
 def clean_cache_handler(sender, instance, **kwargs):
@@ -48,7 +59,8 @@ def clean_cache_handler(sender, instance, **kwargs):
     logger.info(f"invalid cache {instance}")
 
 
-@receiver([post_save, pre_delete], sender=SystemConfig)
+# 删除之后再失效缓存，删除之前重新读取配置会读到被删除的数据
+@receiver([post_save, post_delete], sender=SystemConfig)
 def invalid_config_cache_handler(sender, instance, **kwargs):
     SysConfig.invalid_config_cache(instance.key)
     logger.info(f"invalid cache {instance}")
@@ -59,21 +71,43 @@ def invalid_role_cache_handler(sender, instance, **kwargs):
     pk1 = instance.userinfo_set.values_list('pk', flat=True).distinct()
     pk2 = DeptInfo.objects.filter(roles=instance).values_list('dept_query', flat=True).distinct()
     batch_invalid_cache(set(pk1) | set(pk2))
+    invalid_data_permission_cache()
     logger.info(f"invalid cache {instance}")
 
 
 @receiver([post_save, pre_delete], sender=DeptInfo)
 def invalid_dept_cache_handler(sender, instance, **kwargs):
     batch_invalid_cache(instance.userinfo_set.values_list('pk', flat=True).distinct())
+    invalid_data_permission_cache()
     logger.info(f"invalid cache {instance}")
 
 
 @receiver([post_save, pre_delete], sender=UserInfo)
 def invalid_user_cache_handler(sender, instance, **kwargs):
     batch_invalid_cache([instance.pk])
+    invalid_data_permission_cache(instance.pk)
     logger.info(f"invalid cache {instance}")
 
 
+@receiver([post_save, pre_delete], sender=DataPermission)
+def invalid_data_permission_handler(sender, instance, **kwargs):
+    invalid_data_permission_cache()
+    logger.info(f"invalid data permission cache {instance}")
+
+
+@receiver(m2m_changed, sender=UserInfo.rules.through)
+@receiver(m2m_changed, sender=DeptInfo.rules.through)
+@receiver(m2m_changed, sender=DataPermission.menu.through)
+def invalid_data_permission_m2m_handler(sender, instance, action, **kwargs):
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if isinstance(instance, UserInfo):
+        invalid_data_permission_cache(instance.pk)
+    else:
+        invalid_data_permission_cache()
+    logger.info(f"invalid data permission cache {instance} {action}")
+
+
 # 清理用户相关缓存，用户登出会自动清理
 @receiver([invalid_user_cache_signal, user_logged_out])
 def invalid_user_cache(sender, **kwargs):
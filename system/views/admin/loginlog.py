@@ -10,6 +10,7 @@ from django_filters import rest_framework as filters
 
 from common.core.filter import BaseFilterSet, PkMultipleFilter
 from common.core.modelset import ListDeleteModelSet, OnlyExportDataAction
+from common.core.pagination import KeysetPageNumber
 from system.models import UserLoginLog
 from system.serializers.log import LoginLogSerializer
 
@@ -30,6 +31,7 @@ class LoginLogViewSet(ListDeleteModelSet, OnlyExportDataAction):
     """登录日志"""
     queryset = UserLoginLog.objects.all()
     serializer_class = LoginLogSerializer
+    pagination_class = KeysetPageNumber
 
     ordering_fields = ['created_time']
     filterset_class = LoginLogFilter
@@ -10,6 +10,7 @@ from django_filters import rest_framework as filters
 
 from common.core.filter import BaseFilterSet, PkMultipleFilter
 from common.core.modelset import ListDeleteModelSet, OnlyExportDataAction
+from common.core.pagination import KeysetPageNumber
 from system.models import OperationLog
 from system.serializers.log import OperationLogSerializer
 
@@ -38,6 +39,7 @@ class OperationLogViewSet(ListDeleteModelSet, OnlyExportDataAction):
     """操作日志"""
     queryset = OperationLog.objects.all()
     serializer_class = OperationLogSerializer
+    pagination_class = KeysetPageNumber
 
     ordering_fields = ['created_time', 'updated_time', 'exec_time']
     filterset_class = OperationLogFilter
@@ -8,6 +8,7 @@ from rest_framework.mixins import ListModelMixin
 from rest_framework.viewsets import GenericViewSet
 
 from common.core.modelset import SearchColumnsAction
+from common.core.pagination import KeysetPageNumber
 from common.core.response import ApiResponse
 from system.models import UserLoginLog
 from system.serializers.log import UserLoginLogSerializer
@@ -17,6 +18,7 @@ class UserLoginLogViewSet(ListModelMixin, SearchColumnsAction, GenericViewSet):
     """用户登录日志"""
     queryset = UserLoginLog.objects.all()
     serializer_class = UserLoginLogSerializer
+    pagination_class = KeysetPageNumber
 
     ordering_fields = ['created_time']
 